@@ -13,4 +13,19 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ecommerce_backend.settings')
 
-application = get_asgi_application()
+# Set up Django before importing anything that touches models
+django_asgi_app = get_asgi_application()
+
+from channels.routing import ProtocolTypeRouter, URLRouter
+from users.authentication import JWTAuthMiddleware
+from products import routing
+
+application = ProtocolTypeRouter({
+    "http": django_asgi_app,
+    # Same access tokens as the REST API: ws://.../ws/orders/?token=<access token>
+    "websocket": JWTAuthMiddleware(
+        URLRouter(
+            routing.websocket_urlpatterns
+        )
+    ),
+})
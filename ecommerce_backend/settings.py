@@ -89,6 +89,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Take the write lock when a transaction starts so concurrent checkouts
+            # queue up instead of failing with "database is locked" on lock upgrade
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
@@ -138,7 +144,8 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # simplejwt's JWTAuthentication with the user served from a short-lived cache
+        'users.authentication.CachedJWTAuthentication',
     ),
  'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
@@ -165,6 +172,10 @@ SIMPLE_JWT = {
 
 AUTH_USER_MODEL = "users.User"
 
+# How long an authenticated user is served from the shared cache / from each process's memory, in seconds
+AUTH_USER_CACHE_TTL = 60
+AUTH_USER_LOCAL_TTL = 5
+
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
@@ -177,6 +188,33 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'Asia/Kolkata'
 CELERY_RESULT_BACKEND = 'django-db'
+# Async checkouts get their own queue so a burst can't starve other tasks:
+# celery -A ecommerce_backend worker -Q checkout
+CELERY_TASK_ROUTES = {
+    'products.tasks.process_queued_order': {'queue': 'checkout'},
+}
+CELERY_BEAT_SCHEDULE = {
+    # Folds new order items into hourly buckets and re-ranks featured/trending
+    'refresh-sales-rankings': {
+        'task': 'products.tasks.refresh_sales_rankings',
+        'schedule': 60 * 10,
+    },
+    # Writes carts changed in Redis back to Cart/CartItem (no-op with the database cart backend)
+    'flush-dirty-carts': {
+        'task': 'products.tasks.flush_dirty_carts',
+        'schedule': 5,
+    },
+    # Gives stock held by abandoned checkouts back
+    'release-expired-reservations': {
+        'task': 'products.tasks.release_expired_reservations',
+        'schedule': 60,
+    },
+    # Moves old delivered/cancelled orders out of the hot orders tables
+    'archive-old-orders': {
+        'task': 'products.tasks.archive_old_orders',
+        'schedule': 60 * 60 * 24,
+    },
+}
 
 
 #settings.py
@@ -204,6 +242,24 @@ CACHES = {
 # Cache timeout in seconds (5 minutes)
 CACHE_TTL = 60 * 5
 
+# Where carts are kept: 'products.carts.DatabaseCartBackend' writes every change
+# straight to Cart/CartItem, 'products.carts.RedisCartBackend' keeps them in Redis
+# hashes and writes them behind (see flush-dirty-carts above)
+CART_BACKEND = 'products.carts.DatabaseCartBackend'
+CART_REDIS_TTL = 60 * 60 * 24 * 7
+
+# How long POST /api/cart/reserve/ holds stock for, in seconds
+STOCK_RESERVATION_TTL = 60 * 10
+
+# How long a response is kept for replay to retries with the same Idempotency-Key
+IDEMPOTENCY_KEY_TTL = 60 * 60 * 24
+
+# Delivered/cancelled orders older than this many days move to the archive tables
+ORDER_ARCHIVE_AFTER_DAYS = 90
+
+# How long the order websockets remember who owns an order (owners never change)
+ORDER_OWNER_CACHE_TTL = 60 * 60
+
 
 ASGI_APPLICATION = 'ecommerce_backend.asgi.application'
 
@@ -1,6 +1,8 @@
 from django.contrib import admin
+from django.db import transaction
 from django.utils.html import format_html
-from .models import Category, Product, ProductImage, Cart, CartItem, Order, OrderItem, Coupon
+from .models import Category, Product, ProductImage, Cart, CartItem, Order, OrderItem, ArchivedOrder, Coupon
+from .reports import orders_deleted
 
 class ProductImageInline(admin.StackedInline):  # Using StackedInline for vertical layout
     model = ProductImage
@@ -24,11 +26,24 @@ class ProductAdmin(admin.ModelAdmin):
 
     stacked_images.short_description = "Images"
 
+class OrderAdmin(admin.ModelAdmin):
+    # Deleted orders are taken back out of the sales rollups and status counts
+    def delete_model(self, request, obj):
+        with transaction.atomic():
+            orders_deleted(Order.objects.filter(pk=obj.pk))
+            super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic():
+            orders_deleted(queryset)
+            super().delete_queryset(request, queryset)
+
 admin.site.register(Category)
 admin.site.register(Product, ProductAdmin)
 admin.site.register(ProductImage)
 admin.site.register(Cart)
 admin.site.register(CartItem)
-admin.site.register(Order)
+admin.site.register(Order, OrderAdmin)
 admin.site.register(OrderItem)  
+admin.site.register(ArchivedOrder)
 admin.site.register(Coupon)
@@ -0,0 +1,71 @@
+import heapq
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import Order, OrderItem, ArchivedOrder, ArchivedOrderItem
+
+# Only orders that can't change any more leave the hot tables
+ARCHIVE_STATUSES = ('delivered', 'cancelled')
+
+ORDER_FIELDS = ('id', 'user_id', 'status', 'total_amount', 'shipping_address', 'created_at', 'updated_at', 'tracking_number')
+ITEM_FIELDS = ('id', 'order_id', 'product_id', 'product_name', 'product_price', 'quantity')
+
+
+def archive_cutoff(days=None, now=None):
+    if days is None:
+        days = getattr(settings, 'ORDER_ARCHIVE_AFTER_DAYS', 90)
+    return (now or timezone.now()) - timedelta(days=days)
+
+
+def archive_orders(days=None, batch_size=500, now=None):
+    """
+    Move delivered/cancelled orders created more than `days` ago (default
+    ORDER_ARCHIVE_AFTER_DAYS) into orders_archive/order_items_archive, ids and
+    all, one transaction per batch so the hot tables are never locked for
+    long. Sales rollups and status counts are left alone: an archived order
+    still counts. Returns how many orders were moved.
+    """
+    cutoff = archive_cutoff(days, now)
+    archived = 0
+    while True:
+        with transaction.atomic():
+            ids = list(
+                Order.objects.select_for_update(skip_locked=True)
+                .filter(status__in=ARCHIVE_STATUSES, created_at__lt=cutoff)
+                .order_by('created_at', 'id')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                return archived
+
+            ArchivedOrder.objects.bulk_create([
+                ArchivedOrder(**row) for row in Order.objects.filter(pk__in=ids).values(*ORDER_FIELDS)
+            ])
+            ArchivedOrderItem.objects.bulk_create(
+                [ArchivedOrderItem(**row) for row in OrderItem.objects.filter(order_id__in=ids).values(*ITEM_FIELDS)],
+                batch_size=batch_size,
+            )
+            OrderItem.objects.filter(order_id__in=ids).delete()
+            Order.objects.filter(pk__in=ids).delete()
+        archived += len(ids)
+
+
+class OrderTiers:
+    """
+    The hot and archived orders a request may see, read as one list.
+    OrderPagination pages through both tiers with the same cursor; iterating
+    merges them newest first.
+    """
+
+    def __init__(self, hot, archived):
+        self.hot = hot
+        self.archived = archived
+
+    def __iter__(self):
+        return heapq.merge(
+            self.hot.order_by('-created_at', '-id'),
+            self.archived.order_by('-created_at', '-id'),
+            key=lambda order: (order.created_at, order.pk),
+            reverse=True,
+        )
@@ -0,0 +1,226 @@
+import hashlib
+import math
+import random
+import time
+from urllib.parse import urlencode
+from django.core.cache import cache
+from django.conf import settings
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.response import Response
+
+# Tags used to version cached catalog responses
+PRODUCT_TAG = 'product'
+# Bumped only when a price may have changed; cart quotes depend on nothing else
+PRICE_TAG = 'price'
+# Bumped when checkout or reservations move stock with update(), which skips the product signals
+STOCK_TAG = 'stock'
+CATEGORY_TAG = 'category'
+PRODUCT_IMAGE_TAG = 'product-image'
+COUPON_TAG = 'coupon'
+SALES_RANK_TAG = 'sales-rank'
+
+PRODUCT_LIST_TAGS = (PRODUCT_TAG, STOCK_TAG, CATEGORY_TAG, PRODUCT_IMAGE_TAG)
+CATEGORY_LIST_TAGS = (CATEGORY_TAG,)
+COUPON_LIST_TAGS = (COUPON_TAG,)
+
+
+def _tag_key(tag):
+    return f'tag_version_{tag}'
+
+
+def _modified_key(tag):
+    return f'tag_modified_{tag}'
+
+
+def _initial_version(timeout):
+    # Tags that expire restart from the clock, so a re-created tag never repeats
+    # a version that an entry cached before it expired is keyed on
+    return 1 if timeout is None else int(time.time() * 1000)
+
+
+def get_tag_state(tags, timeout=None):
+    """
+    Return ({tag: version}, last_modified) for the given tags, where
+    last_modified is the unix time of the most recent bump. Unseen tags start
+    at version 1, modified now. One cache round trip when every tag is known.
+    Pass `timeout` for tags that shouldn't live forever (e.g. one per user);
+    it must match the one given to bump_tags().
+    """
+    stored = cache.get_many([_tag_key(tag) for tag in tags] + [_modified_key(tag) for tag in tags])
+    versions = {}
+    last_modified = 0
+
+    for tag in tags:
+        version = stored.get(_tag_key(tag))
+        if version is None:
+            # add() keeps us from resetting a version another worker just bumped
+            cache.add(_tag_key(tag), _initial_version(timeout), timeout=timeout)
+            version = cache.get(_tag_key(tag), 1)
+        versions[tag] = version
+
+        modified = stored.get(_modified_key(tag))
+        if modified is None:
+            cache.add(_modified_key(tag), int(time.time()), timeout=timeout)
+            modified = cache.get(_modified_key(tag), int(time.time()))
+        last_modified = max(last_modified, modified)
+
+    return versions, last_modified
+
+
+def get_tag_versions(tags, timeout=None):
+    return get_tag_state(tags, timeout)[0]
+
+
+def bump_tags(*tags, timeout=None):
+    """Invalidate every cache entry built on top of the given tags."""
+    now = int(time.time())
+    for tag in tags:
+        key = _tag_key(tag)
+        try:
+            cache.incr(key)
+            if timeout is not None:
+                cache.touch(key, timeout)
+        except ValueError:
+            # Tag was never read (or was evicted), so nothing can depend on it yet
+            cache.set(key, _initial_version(timeout) + 1, timeout=timeout)
+    cache.set_many({_modified_key(tag): now for tag in tags}, timeout=timeout)
+
+
+def normalize_query_params(query_params):
+    """Build a stable string from a QueryDict, ignoring parameter and value order."""
+    items = []
+    for key in sorted(query_params.keys()):
+        for value in sorted(query_params.getlist(key)):
+            items.append((key, value))
+    return urlencode(items)
+
+
+def _digest(tags, versions, extra):
+    version_part = '.'.join(f'{tag}:{versions[tag]}' for tag in tags)
+    return hashlib.md5(f'{version_part}|{extra}'.encode()).hexdigest()
+
+
+def make_tagged_etag(tags, extra=''):
+    """Strong ETag and Last-Modified for a representation built only from `tags`."""
+    versions, last_modified = get_tag_state(tags)
+    return f'"{_digest(tags, versions, extra)}"', last_modified
+
+
+def make_tagged_key(prefix, tags, extra=''):
+    return f'{prefix}_{_digest(tags, get_tag_versions(tags), extra)}'
+
+
+def make_response_key(prefix, query_params, tags):
+    return make_tagged_key(prefix, tags, normalize_query_params(query_params))
+
+
+#==================================CONDITIONAL GET=================================================================
+
+def not_modified_response(request, etag, last_modified):
+    """
+    Return a 304 response if the request's If-None-Match / If-Modified-Since
+    headers match, otherwise None. `last_modified` is a unix timestamp.
+    """
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        set_conditional_headers(response, etag, last_modified)
+    return response
+
+
+def set_conditional_headers(response, etag, last_modified):
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+class CachedListMixin:
+    """
+    Cache serialized list responses in the default cache, keyed by the
+    normalized query string and the versions of `cache_tags`. The same key
+    doubles as a strong ETag, so conditional requests are answered with a
+    304 before the cached payload is even read.
+    """
+    cache_tags = ()
+    cache_prefix = None
+
+    def get_cache_prefix(self):
+        return self.cache_prefix or f'{self.basename}_{self.action}'
+
+    def get_cache_tags(self):
+        return self.cache_tags
+
+    def cached_response(self, request, build_response):
+        tags = self.get_cache_tags()
+        versions, last_modified = get_tag_state(tags)
+        digest = _digest(tags, versions, normalize_query_params(request.query_params))
+        cache_key = f'{self.get_cache_prefix()}_{digest}'
+        etag = f'"{digest}"'
+
+        not_modified = not_modified_response(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        cached_data = cache.get(cache_key)
+        if cached_data is not None:
+            return set_conditional_headers(Response(cached_data), etag, last_modified)
+
+        response = build_response()
+        if response.status_code == 200:
+            cache.set(cache_key, response.data, settings.CACHE_TTL)
+            set_conditional_headers(response, etag, last_modified)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(request, lambda: super(CachedListMixin, self).list(request, *args, **kwargs))
+
+
+#==================================STAMPEDE PROTECTION=============================================================
+
+def set_computed(key, value, ttl, delta=0.0):
+    """
+    Store `value` with its logical expiry and how long it took to compute.
+    The physical timeout is doubled so a stale copy can still be served while
+    a single worker recomputes it.
+    """
+    cache.set(key, (value, delta, time.time() + ttl), ttl * 2)
+
+
+def get_or_compute(key, compute, ttl, beta=1.0, lock_timeout=10, wait_timeout=2.0):
+    """
+    Read-through cache with probabilistic early expiry (XFetch) and single-flight
+    recomputation: entries are refreshed a little before they expire, by one
+    worker only, while everyone else keeps getting the cached value.
+    """
+    entry = cache.get(key)
+    lock_key = f'{key}_lock'
+    locked = cache.add(lock_key, 1, lock_timeout) if entry is None else False
+
+    if entry is not None:
+        value, delta, expires = entry
+        # -log(random()) is exponentially distributed, so slow-to-compute
+        # entries start refreshing earlier and only now and then
+        if time.time() - delta * beta * math.log(random.random() or 1e-12) < expires:
+            return value
+        locked = cache.add(lock_key, 1, lock_timeout)
+        if not locked:
+            return value
+    elif not locked:
+        # Cold key being computed elsewhere: wait for it instead of piling on the DB
+        deadline = time.time() + wait_timeout
+        while time.time() < deadline:
+            time.sleep(0.05)
+            entry = cache.get(key)
+            if entry is not None:
+                return entry[0]
+
+    try:
+        started = time.time()
+        value = compute()
+        set_computed(key, value, ttl, time.time() - started)
+        return value
+    finally:
+        if locked:
+            cache.delete(lock_key)
@@ -0,0 +1,476 @@
+import time
+import uuid
+from contextlib import contextmanager
+from decimal import Decimal
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Prefetch, prefetch_related_objects, F, Q, Case, When, Value, Sum
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .models import Cart, CartItem, Product
+from .cache import bump_tags, get_tag_versions
+
+# Dotted path of the backend CartViewSet writes through
+DEFAULT_CART_BACKEND = 'products.carts.DatabaseCartBackend'
+
+
+def cart_prefetch_plan():
+    # Everything CartSerializer walks, in a fixed number of queries
+    return (
+        Prefetch('items', queryset=CartItem.objects.select_related('product').order_by('id')),
+        'items__product__images',
+        'items__product__categories',
+    )
+
+
+def cart_tag(user_id):
+    return f'cart-{user_id}'
+
+
+def get_cart_backend():
+    return import_string(getattr(settings, 'CART_BACKEND', DEFAULT_CART_BACKEND))()
+
+
+#==================================BATCH OPERATIONS================================================================
+
+CART_OPERATIONS = ('add', 'remove', 'set')
+
+# One batch is one request; anything bigger is a bulk import, not a cart
+MAX_BATCH_OPERATIONS = 100
+
+
+class CartOperationError(ValueError):
+    pass
+
+
+def parse_operations(operations):
+    """Validate a batch into a list of (op, product_id, quantity); quantity is None for a plain remove."""
+    if not isinstance(operations, list) or not operations:
+        raise CartOperationError('operations must be a non-empty list')
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        raise CartOperationError(f'At most {MAX_BATCH_OPERATIONS} operations per batch')
+
+    parsed = []
+    for position, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get('op') not in CART_OPERATIONS:
+            raise CartOperationError(f"Operation {position}: op must be one of {', '.join(CART_OPERATIONS)}")
+        try:
+            product_id = str(uuid.UUID(str(operation.get('product_id'))))
+            quantity = operation.get('quantity')
+            if quantity is None:
+                if operation['op'] != 'remove':
+                    raise ValueError
+            else:
+                quantity = int(quantity)
+                if quantity < 0 or (quantity == 0 and operation['op'] == 'add'):
+                    raise ValueError
+        except (TypeError, ValueError):
+            raise CartOperationError(f'Operation {position}: invalid product_id or quantity')
+        parsed.append((operation['op'], product_id, quantity))
+    return parsed
+
+
+def plan_operations(operations):
+    """
+    Fold a batch into one change per product: {product_id: ('set', n)} for
+    absolute quantities (0 drops the line) or ('delta', n) for relative ones.
+    """
+    plan = {}
+    for op, product_id, quantity in operations:
+        kind, current = plan.get(product_id, ('delta', 0))
+        if op == 'set' or (op == 'remove' and quantity is None):
+            plan[product_id] = ('set', quantity or 0)
+        elif kind == 'set':
+            plan[product_id] = ('set', max(current + (quantity if op == 'add' else -quantity), 0))
+        else:
+            plan[product_id] = ('delta', current + (quantity if op == 'add' else -quantity))
+    return plan
+
+
+class DatabaseCartBackend:
+    """Carts live in Cart/CartItem and every change is written straight away."""
+
+    def __init__(self):
+        # One version tag per user, so it expires instead of piling up
+        self.ttl = getattr(settings, 'CART_REDIS_TTL', 60 * 60 * 24 * 7)
+
+    def version(self, user):
+        # Moves on every change, so anything cached per cart version (quotes) goes stale
+        return get_tag_versions([cart_tag(user.id)], timeout=self.ttl)[cart_tag(user.id)]
+
+    def changed(self, user):
+        tag = cart_tag(user.id)
+        transaction.on_commit(lambda: bump_tags(tag, timeout=self.ttl))
+
+    def subtotal(self, user):
+        totals = CartItem.objects.filter(cart__user=user).aggregate(
+            subtotal=Sum(F('quantity') * F('product__price')),
+            item_count=Sum('quantity'),
+        )
+        return {'subtotal': totals['subtotal'] or Decimal('0'), 'item_count': totals['item_count'] or 0}
+
+    def get_cart(self, user):
+        cart, created = Cart.objects.get_or_create(user=user)
+        prefetch_related_objects([cart], *cart_prefetch_plan())
+        return cart
+
+    @transaction.atomic
+    def add(self, user, product, quantity):
+        cart, created = Cart.objects.get_or_create(user=user)
+        # Increment in SQL so two taps at once both count
+        CartItem.objects.bulk_create([CartItem(cart=cart, product=product, quantity=0)], ignore_conflicts=True)
+        CartItem.objects.filter(cart=cart, product=product).update(quantity=F('quantity') + quantity)
+        self.changed(user)
+
+    @transaction.atomic
+    def remove(self, user, product_id, quantity=None):
+        """Take `quantity` off the line (or drop it). Returns False if it wasn't in the cart."""
+        items = CartItem.objects.filter(cart__user=user, product_id=product_id)
+        self.changed(user)
+        if quantity and items.filter(quantity__gt=quantity).update(quantity=F('quantity') - quantity):
+            return True
+        deleted, _ = items.delete()
+        return deleted > 0
+
+    def clear(self, user):
+        CartItem.objects.filter(cart__user=user).delete()
+        self.changed(user)
+
+    @transaction.atomic
+    def apply(self, user, plan):
+        """
+        Apply a plan_operations() plan in a fixed handful of queries, whatever
+        its size. Every change is a conditional UPDATE or an upsert, so
+        concurrent batches against the same cart never lose each other's
+        increments. Returns {product_id: new quantity} for the touched lines.
+        """
+        cart, created = Cart.objects.get_or_create(user=user)
+        items = CartItem.objects.filter(cart=cart)
+        sets = {product_id: n for product_id, (kind, n) in plan.items() if kind == 'set'}
+        deltas = {product_id: n for product_id, (kind, n) in plan.items() if kind == 'delta' and n}
+
+        # Lines a removal would take to zero go first, so the UPDATE below never underflows
+        dropped = Q(product_id__in=[product_id for product_id, n in sets.items() if n == 0])
+        for product_id, n in deltas.items():
+            if n < 0:
+                dropped |= Q(product_id=product_id, quantity__lte=-n)
+        items.filter(dropped).delete()
+
+        # Additions need a row to increment; ignore_conflicts leaves existing lines alone
+        CartItem.objects.bulk_create(
+            [CartItem(cart=cart, product_id=product_id, quantity=0) for product_id, n in deltas.items() if n > 0],
+            ignore_conflicts=True,
+        )
+        if deltas:
+            items.filter(product_id__in=deltas).update(
+                quantity=F('quantity') + Case(
+                    *[When(product_id=product_id, then=Value(n)) for product_id, n in deltas.items()],
+                    default=Value(0),
+                )
+            )
+
+        CartItem.objects.bulk_create(
+            [CartItem(cart=cart, product_id=product_id, quantity=n) for product_id, n in sets.items() if n > 0],
+            update_conflicts=True,
+            unique_fields=['cart', 'product'],
+            update_fields=['quantity'],
+        )
+        Cart.objects.filter(id=cart.id).update(updated_at=timezone.now())
+        self.changed(user)
+
+        quantities = dict.fromkeys(plan, 0)
+        quantities.update(
+            (str(product_id), quantity)
+            for product_id, quantity in items.filter(product_id__in=plan).values_list('product_id', 'quantity')
+        )
+        return quantities
+
+    def persist(self, user):
+        # Already in the database
+        pass
+
+    def forget(self, user):
+        """Called once checkout has emptied the database cart."""
+        self.changed(user)
+
+    def flush_dirty(self):
+        return 0
+
+
+#==================================REDIS BACKEND===================================================================
+
+# Hash fields starting with "_" are cart metadata, everything else is product_id -> quantity
+META_PREFIX = '_'
+
+# Copies the database cart into the hash unless another request got there first.
+# HSETNX keeps any increment that raced in after the hash expired
+HYDRATE_SCRIPT = """
+if redis.call('hexists', KEYS[1], '_id') == 0 then
+    for i = 2, #ARGV, 2 do
+        redis.call('hsetnx', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+redis.call('expire', KEYS[1], ARGV[1])
+return 1
+"""
+
+# Removes `quantity` from a line, dropping it once nothing is left. Returns -1 if it wasn't there
+REMOVE_SCRIPT = """
+local current = tonumber(redis.call('hget', KEYS[1], ARGV[1]))
+if not current then
+    return -1
+end
+local quantity = tonumber(ARGV[2])
+if quantity > 0 and quantity < current then
+    current = redis.call('hincrby', KEYS[1], ARGV[1], -quantity)
+else
+    redis.call('hdel', KEYS[1], ARGV[1])
+    current = 0
+end
+redis.call('hincrby', KEYS[1], '_version', 1)
+redis.call('hset', KEYS[1], '_updated', ARGV[3])
+redis.call('expire', KEYS[1], ARGV[4])
+return current
+"""
+
+# Deletes a lock only while it still holds our token, so an expired lock taken over by someone else survives
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Seconds a flush may hold a user's flush lock before it's presumed dead
+FLUSH_LOCK_TIMEOUT = 10
+
+
+class RedisCartBackend:
+    """
+    Carts live in a Redis hash per user and are written behind to Cart/CartItem.
+
+    Adding or removing an item is a single atomic HINCRBY (or script) with no
+    database write. Changed carts are put in a dirty set that the
+    `flush_dirty_carts` task drains every few seconds; checkout and coupon
+    validation call persist() so they always read an up to date cart.
+    """
+    dirty_key = 'cart:dirty'
+
+    def __init__(self, connection=None):
+        if connection is None:
+            from django_redis import get_redis_connection
+            connection = get_redis_connection('default')
+        self.redis = connection
+        self.ttl = getattr(settings, 'CART_REDIS_TTL', 60 * 60 * 24 * 7)
+        self.hydrate_script = self.redis.register_script(HYDRATE_SCRIPT)
+        self.remove_script = self.redis.register_script(REMOVE_SCRIPT)
+        self.release_script = self.redis.register_script(RELEASE_SCRIPT)
+
+    def cart_key(self, user_id):
+        return f'cart:{user_id}'
+
+    def load(self, user):
+        """Return the hash contents, pulling the cart in from the database on first use."""
+        key = self.cart_key(user.id)
+        state = self.decode(self.redis.hgetall(key))
+        if '_id' in state:
+            return state
+
+        cart, created = Cart.objects.get_or_create(user=user)
+        fields = {
+            '_id': cart.id,
+            '_created': cart.created_at.timestamp(),
+            '_updated': cart.updated_at.timestamp(),
+            # Not 1: a re-hydrated cart must not reuse versions from before it expired
+            '_version': int(time.time() * 1000),
+        }
+        fields.update(
+            (str(product_id), quantity)
+            for product_id, quantity in cart.items.values_list('product_id', 'quantity')
+        )
+        args = [value for pair in fields.items() for value in pair]
+        self.hydrate_script(keys=[key], args=[self.ttl] + args)
+        return self.decode(self.redis.hgetall(key))
+
+    def decode(self, state):
+        return {field.decode(): value.decode() for field, value in state.items()}
+
+    def quantities(self, state):
+        return {field: int(value) for field, value in state.items() if not field.startswith(META_PREFIX)}
+
+    def version(self, user):
+        return self.load(user)['_version']
+
+    def subtotal(self, user):
+        quantities = self.quantities(self.load(user))
+        prices = Product.objects.filter(id__in=quantities).values_list('id', 'price')
+        return {
+            'subtotal': sum((price * quantities[str(product_id)] for product_id, price in prices), Decimal('0')),
+            'item_count': sum(quantities[str(product_id)] for product_id, _ in prices),
+        }
+
+    def get_cart(self, user):
+        """An unsaved-looking Cart with its items attached, shaped for CartSerializer."""
+        state = self.load(user)
+        quantities = self.quantities(state)
+        cart = Cart(
+            id=int(state['_id']),
+            user=user,
+            created_at=datetime.fromtimestamp(float(state['_created']), tz=dt_timezone.utc),
+            updated_at=datetime.fromtimestamp(float(state['_updated']), tz=dt_timezone.utc),
+        )
+        products = Product.objects.filter(id__in=quantities).prefetch_related('images', 'categories')
+        # Lines that were never flushed have no CartItem id yet
+        items = [
+            CartItem(cart=cart, product=product, quantity=quantities[str(product.id)])
+            for product in sorted(products, key=lambda product: product.title)
+        ]
+        queryset = CartItem.objects.none()
+        queryset._result_cache = items
+        queryset._prefetch_done = True
+        cart._prefetched_objects_cache = {'items': queryset}
+        return cart
+
+    def touch(self, pipe, user_id):
+        key = self.cart_key(user_id)
+        pipe.hincrby(key, '_version', 1)
+        pipe.hset(key, '_updated', time.time())
+        pipe.expire(key, self.ttl)
+        pipe.sadd(self.dirty_key, user_id)
+
+    def add(self, user, product, quantity):
+        self.load(user)
+        pipe = self.redis.pipeline()
+        pipe.hincrby(self.cart_key(user.id), str(product.id), quantity)
+        self.touch(pipe, user.id)
+        pipe.execute()
+
+    def remove(self, user, product_id, quantity=None):
+        self.load(user)
+        remaining = self.remove_script(
+            keys=[self.cart_key(user.id)],
+            args=[str(product_id), quantity or 0, time.time(), self.ttl],
+        )
+        if remaining == -1:
+            return False
+        self.redis.sadd(self.dirty_key, user.id)
+        return True
+
+    def clear(self, user):
+        state = self.load(user)
+        key = self.cart_key(user.id)
+        # One MULTI so a concurrent add never sees the hash missing and re-hydrates old items
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.hset(key, mapping={
+            '_id': state['_id'],
+            '_created': state['_created'],
+            '_updated': time.time(),
+            '_version': int(state['_version']) + 1,
+        })
+        pipe.expire(key, self.ttl)
+        pipe.sadd(self.dirty_key, user.id)
+        pipe.execute()
+
+    def apply(self, user, plan):
+        """Apply a plan_operations() plan in one pipelined round trip. Returns the touched lines' quantities."""
+        self.load(user)
+        key = self.cart_key(user.id)
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=True)
+        for product_id, (kind, n) in plan.items():
+            if kind == 'set' and n == 0:
+                pipe.hdel(key, product_id)
+            elif kind == 'set':
+                pipe.hset(key, product_id, n)
+            elif n > 0:
+                pipe.hincrby(key, product_id, n)
+            elif n < 0:
+                self.remove_script(keys=[key], args=[product_id, -n, now, self.ttl], client=pipe)
+        self.touch(pipe, user.id)
+        pipe.hmget(key, list(plan))
+        quantities = pipe.execute()[-1]
+        return {product_id: int(quantity or 0) for product_id, quantity in zip(plan, quantities)}
+
+    def forget(self, user):
+        """Called once checkout has emptied the database cart; the next use re-hydrates an empty one."""
+        # Under the flush lock, so a flush already running finishes first and none reads the hash after
+        with self.flush_lock(user.id, wait=FLUSH_LOCK_TIMEOUT):
+            pipe = self.redis.pipeline(transaction=True)
+            pipe.delete(self.cart_key(user.id))
+            pipe.srem(self.dirty_key, user.id)
+            pipe.execute()
+
+    @contextmanager
+    def flush_lock(self, user_id, wait=0):
+        """
+        Hold cart:flush:<user_id> (SET NX) for the block, waiting up to `wait`
+        seconds for it; yields whether it was taken. A cart only leaves the
+        dirty set under its lock, so whoever takes the lock after a flush
+        sees the database copy that flush wrote.
+        """
+        key = f'cart:flush:{user_id}'
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + wait
+        locked = self.redis.set(key, token, nx=True, ex=FLUSH_LOCK_TIMEOUT)
+        while not locked and time.monotonic() < deadline:
+            time.sleep(0.01)
+            locked = self.redis.set(key, token, nx=True, ex=FLUSH_LOCK_TIMEOUT)
+        try:
+            yield bool(locked)
+        finally:
+            if locked:
+                self.release_script(keys=[key], args=[token])
+
+    def persist(self, user):
+        """Flush this user's cart now if it has unflushed changes, waiting out a flush already running."""
+        with self.flush_lock(user.id, wait=FLUSH_LOCK_TIMEOUT):
+            if self.redis.srem(self.dirty_key, user.id):
+                self.flush(user.id)
+
+    def flush_dirty(self, batch_size=500):
+        """Write every dirty cart back to the database. Returns how many were flushed."""
+        flushed = 0
+        for user_id in self.redis.sscan_iter(self.dirty_key, count=batch_size):
+            user_id = user_id.decode()
+            # A held lock means checkout (or another flusher) is writing this cart already.
+            # Removing it under the lock means a change made mid-flush marks the cart dirty again,
+            # and a cart forgotten by checkout since the scan is no longer in the set
+            with self.flush_lock(user_id) as locked:
+                if locked and self.redis.srem(self.dirty_key, user_id):
+                    self.flush(user_id)
+                    flushed += 1
+        return flushed
+
+    @transaction.atomic
+    def flush(self, user_id):
+        state = self.decode(self.redis.hgetall(self.cart_key(user_id)))
+        if '_id' not in state:
+            # Expired before it was flushed; the database copy is all there is
+            return
+        quantities = self.quantities(state)
+
+        cart, created = Cart.objects.get_or_create(user_id=user_id)
+        existing = {str(item.product_id): item for item in cart.items.all()}
+
+        cart.items.exclude(product_id__in=quantities).delete()
+        to_update = []
+        for product_id, quantity in quantities.items():
+            item = existing.get(product_id)
+            if item is not None and item.quantity != quantity:
+                item.quantity = quantity
+                to_update.append(item)
+        CartItem.objects.bulk_update(to_update, ['quantity'])
+        # Products deleted since they were added are skipped rather than failing the flush
+        live = set(
+            str(product_id)
+            for product_id in Product.objects.filter(id__in=[p for p in quantities if p not in existing]).values_list('id', flat=True)
+        )
+        CartItem.objects.bulk_create(
+            [CartItem(cart=cart, product_id=product_id, quantity=quantities[product_id]) for product_id in live],
+            ignore_conflicts=True,
+        )
+        Cart.objects.filter(id=cart.id).update(
+            updated_at=datetime.fromtimestamp(float(state['_updated']), tz=dt_timezone.utc)
+        )
@@ -0,0 +1,45 @@
+from django.core.cache import cache
+from django.conf import settings
+from .cache import make_tagged_key, CATEGORY_LIST_TAGS
+from .models import Category
+
+
+def build_category_tree():
+    """Serialize every category into a nested tree with a single query."""
+    nodes = {}
+    roots = []
+    paths = {}
+
+    # Parents always sort before their descendants because their path is a prefix
+    for category in Category.objects.order_by('path').values('id', 'title', 'slug', 'description', 'parent_id', 'path'):
+        node = {
+            'id': category['id'],
+            'title': category['title'],
+            'slug': category['slug'],
+            'description': category['description'],
+            'children': [],
+        }
+        nodes[category['id']] = node
+        paths[category['slug']] = category['path']
+
+        parent = nodes.get(category['parent_id'])
+        (parent['children'] if parent else roots).append(node)
+
+    return {'tree': roots, 'paths': paths}
+
+
+def get_cached_category_tree():
+    cache_key = make_tagged_key('category_tree', CATEGORY_LIST_TAGS)
+    data = cache.get(cache_key)
+    if data is None:
+        data = build_category_tree()
+        cache.set(cache_key, data, settings.CACHE_TTL)
+    return data
+
+
+def get_category_tree():
+    return get_cached_category_tree()['tree']
+
+
+def get_category_path(slug):
+    return get_cached_category_tree()['paths'].get(slug)
@@ -0,0 +1,254 @@
+from collections import Counter
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q, Case, When, Value
+from django.utils import timezone
+from rest_framework import status
+from .models import Cart, CartItem, Product, Order, OrderItem, StockReservation
+from .carts import get_cart_backend
+from .pricing import quote_from_items, get_cart_quote
+from .reports import record_sales, count_status_change
+from .order_updates import queue_order_change, status_change
+from .cache import bump_tags, STOCK_TAG
+from .detail_cache import refresh_product_details
+from .tasks import send_order_confirmation_email, process_queued_order
+
+
+class CheckoutError(Exception):
+    def __init__(self, message, status_code=status.HTTP_400_BAD_REQUEST):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def lines_by_product(items):
+    return {item.product_id: item.quantity for item in items}
+
+
+def per_product(wanted):
+    return Case(
+        *[When(pk=product_id, then=Value(quantity)) for product_id, quantity in wanted.items()],
+        default=Value(0),
+    )
+
+
+def available_for(wanted):
+    # stock - reserved >= n, written so the database can evaluate it under the row lock
+    enough = Q()
+    for product_id, quantity in wanted.items():
+        enough |= Q(pk=product_id, stock__gte=F('reserved') + quantity)
+    return enough
+
+
+def update_if_available(items, **changes):
+    """
+    Apply `changes` to every product in `items` in one UPDATE conditioned on
+    each line's quantity still being available (stock - reserved >= n).
+    Concurrent buyers of the same SKU queue on the row lock and re-check the
+    condition, so stock can never be oversold. If any line is short the
+    UPDATE is rolled back and CheckoutError names the product.
+    """
+    wanted = lines_by_product(items)
+    with transaction.atomic():
+        if Product.objects.filter(available_for(wanted)).update(**changes) == len(wanted):
+            return
+        # Undo the lines that did fit, so the availability read below is the real one
+        transaction.set_rollback(True)
+
+    available = {
+        product_id: stock - reserved
+        for product_id, stock, reserved in Product.objects.filter(pk__in=wanted).values_list('pk', 'stock', 'reserved')
+    }
+    short = next(item.product for item in items if available.get(item.product_id, 0) < item.quantity)
+    raise CheckoutError(f"Not enough stock for {short.title}")
+
+
+def take_stock(items):
+    """Decrement stock for every cart line (stock = stock - n WHERE stock - reserved >= n)."""
+    wanted = lines_by_product(items)
+    update_if_available(items, stock=F('stock') - per_product(wanted), updated_at=timezone.now())
+
+
+#==================================RESERVATIONS====================================================================
+
+def reservation_ttl():
+    return timedelta(seconds=getattr(settings, 'STOCK_RESERVATION_TTL', 60 * 10))
+
+
+def release_reservations(reservations):
+    """Give the held units back to their products and delete the holds. Returns {product_id: units}."""
+    rows = list(reservations.values_list('id', 'product_id', 'quantity'))
+    if not rows:
+        return {}
+    released = Counter()
+    for _, product_id, quantity in rows:
+        released[product_id] += quantity
+    Product.objects.filter(pk__in=released).update(reserved=F('reserved') - per_product(released))
+    StockReservation.objects.filter(id__in=[row[0] for row in rows]).delete()
+    return released
+
+
+def refresh_stock(product_ids):
+    """
+    update() skips the product signals, so once a stock or reservation change
+    commits, write the touched products' detail entries back (hot SKUs never
+    miss) and bump STOCK_TAG, which moves the product list keys and ETags on.
+    Only the list tags move: detail entries of other products, cart quotes
+    (PRICE_TAG) and the category tree stay cached.
+    """
+    product_ids = list(product_ids)
+    if product_ids:
+        def refresh():
+            bump_tags(STOCK_TAG)
+            refresh_product_details(product_ids)
+
+        transaction.on_commit(refresh)
+
+
+def reserve_cart(user):
+    """
+    Hold every line of the user's cart for STOCK_RESERVATION_TTL seconds,
+    replacing any earlier holds. All or nothing: raises CheckoutError if any
+    line can't be held. Returns (expires_at, items).
+    """
+    cart_backend = get_cart_backend()
+    cart_backend.persist(user)
+
+    with transaction.atomic():
+        released = release_reservations(StockReservation.objects.select_for_update().filter(user=user))
+        items = list(CartItem.objects.filter(cart__user=user).select_related('product').order_by('product_id'))
+        if not items:
+            raise CheckoutError("Cannot reserve an empty cart")
+
+        wanted = lines_by_product(items)
+        update_if_available(items, reserved=F('reserved') + per_product(wanted))
+
+        expires_at = timezone.now() + reservation_ttl()
+        StockReservation.objects.bulk_create([
+            StockReservation(user=user, product_id=product_id, quantity=quantity, expires_at=expires_at)
+            for product_id, quantity in wanted.items()
+        ])
+        refresh_stock(set(wanted) | set(released))
+    return expires_at, items
+
+
+def release_expired_reservations(batch_size=1000, now=None):
+    """Sweep holds past their expiry in batches. Returns how many were released."""
+    now = now or timezone.now()
+    swept = 0
+    while True:
+        with transaction.atomic():
+            # skip_locked: holds a checkout is consuming right now are left to it
+            batch = list(
+                StockReservation.objects.select_for_update(skip_locked=True)
+                .filter(expires_at__lte=now)
+                .order_by('expires_at')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not batch:
+                return swept
+            released = release_reservations(StockReservation.objects.filter(id__in=batch))
+            refresh_stock(released)
+        swept += len(batch)
+
+
+def place_order(user, shipping_address, notify=True, order=None):
+    """
+    Turn the user's cart into an order in a single transaction: a fixed
+    number of queries however many lines the cart has. Pass a queued `order`
+    to fill it in instead of creating one (async checkout). Raises CheckoutError.
+    """
+    cart_backend = get_cart_backend()
+    # Write-behind carts may have changes that haven't reached the database yet
+    cart_backend.persist(user)
+
+    with transaction.atomic():
+        if order is not None and not Order.objects.select_for_update().filter(pk=order.pk, status='queued').exists():
+            # Another worker got to this queued order first
+            return order
+
+        cart = Cart.objects.filter(user=user).first()
+        if cart is None:
+            raise CheckoutError("Cart not found", status.HTTP_404_NOT_FOUND)
+
+        items = list(cart.items.select_related('product').order_by('product_id'))
+        if not items:
+            raise CheckoutError("Cannot create order with empty cart")
+
+        # The user's own holds are given back first, so they count as available below
+        released = release_reservations(StockReservation.objects.select_for_update().filter(user=user))
+        take_stock(items)
+
+        total_amount = quote_from_items(items)['subtotal']
+        if order is None:
+            order = Order.objects.create(
+                user=user, total_amount=total_amount, shipping_address=shipping_address, sales_recorded=True
+            )
+        OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order,
+                product=item.product,
+                product_name=item.product.title,
+                product_price=item.product.price,
+                quantity=item.quantity,
+            )
+            for item in items
+        ])
+        if order.status == 'queued':
+            # The status change is what tells the client its queued order went through,
+            # and what records its sales (see reports.order_status_changed). created_at
+            # becomes the time it was really placed, which is what the sales rankings'
+            # commit lag and the reports go by
+            order.total_amount, order.status, order.created_at = total_amount, 'pending', timezone.now()
+            order.save(update_fields=['total_amount', 'status', 'created_at', 'updated_at'])
+        else:
+            record_sales(order, [(item.product_id, item.quantity, item.product.price * item.quantity) for item in items])
+        cart.items.all().delete()
+
+        refresh_stock(set(lines_by_product(items)) | set(released))
+        transaction.on_commit(lambda: cart_backend.forget(user))
+        if notify:
+            transaction.on_commit(lambda: send_order_confirmation_email.delay(order.id, user.email))
+    return order
+
+
+#==================================ASYNC CHECKOUT==================================================================
+
+def queue_order(user, shipping_address):
+    """
+    The request-side half of async checkout: a cheap check against the cached
+    cart quote, then a 'queued' order for a checkout worker to fill in.
+    """
+    quote = get_cart_quote(user, get_cart_backend())
+    if not quote['item_count']:
+        raise CheckoutError("Cannot create order with empty cart")
+
+    with transaction.atomic():
+        order = Order.objects.create(
+            user=user, status='queued', total_amount=quote['subtotal'], shipping_address=shipping_address
+        )
+        transaction.on_commit(lambda: process_queued_order.delay(order.id))
+    return order
+
+
+def complete_queued_order(order_id):
+    """The worker-side half: run the real checkout, or mark the order failed and tell the client why."""
+    order = Order.objects.select_related('user').filter(pk=order_id, status='queued').first()
+    if order is None:
+        return None
+    try:
+        return place_order(order.user, order.shipping_address, order=order)
+    except CheckoutError as exc:
+        fail_queued_order(order_id, str(exc))
+        return None
+
+
+def fail_queued_order(order_id, error):
+    """Move a still-queued order to failed and push `error` to its subscribers. False if it had moved on."""
+    now = timezone.now()
+    with transaction.atomic():
+        if not Order.objects.filter(pk=order_id, status='queued').update(status='failed', updated_at=now):
+            return False
+        count_status_change('queued', 'failed')
+        queue_order_change(order_id, dict(status_change('queued', 'failed', now), error=error))
+    return True
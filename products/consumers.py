@@ -1,54 +1,195 @@
+import asyncio
 import json
-from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.generic.websocket import AsyncWebsocketConsumer, AsyncJsonWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import cache
 from .models import Order
+from .order_updates import order_group, user_orders_group
+
+# Orders one socket can follow at a time
+MAX_ORDER_SUBSCRIPTIONS = 100
+
+# Orders that won't change any more aren't subscribed to on connect
+FINAL_STATUSES = ('delivered', 'cancelled', 'failed')
+
+
+def order_owner_key(order_id):
+    return f'order_owner_{order_id}'
+
+
+def order_owners(order_ids):
+    """
+    {order_id: user_id} for the orders in `order_ids` that exist. Owners never
+    change, so they're cached for ORDER_OWNER_CACHE_TTL and a (re)connect
+    storm mostly costs cache reads.
+    """
+    keys = {order_owner_key(order_id): order_id for order_id in order_ids}
+    owners = {keys[key]: owner for key, owner in cache.get_many(list(keys)).items()}
+    missing = [order_id for order_id in order_ids if order_id not in owners]
+    if missing:
+        found = dict(Order.objects.filter(pk__in=missing).values_list('id', 'user_id'))
+        cache.set_many(
+            {order_owner_key(order_id): owner for order_id, owner in found.items()},
+            getattr(settings, 'ORDER_OWNER_CACHE_TTL', 60 * 60),
+        )
+        owners.update(found)
+    return owners
+
+
+def authorized_orders(user, order_ids, owners=None):
+    """The subset of `order_ids` the user may follow: their own orders, or any order for admins."""
+    if owners is None:
+        owners = order_owners(order_ids)
+    return [
+        order_id for order_id in order_ids
+        if order_id in owners and (owners[order_id] == user.id or user.role == 'admin')
+    ]
+
+
+def open_orders(user):
+    """The user's orders that can still change, newest first, caching their owner on the way."""
+    order_ids = list(
+        Order.objects.filter(user=user).exclude(status__in=FINAL_STATUSES)
+        .order_by('-created_at', '-id').values_list('id', flat=True)[:MAX_ORDER_SUBSCRIPTIONS]
+    )
+    cache.set_many(
+        {order_owner_key(order_id): user.id for order_id in order_ids},
+        getattr(settings, 'ORDER_OWNER_CACHE_TTL', 60 * 60),
+    )
+    return order_ids
+
 
 class OrderConsumer(AsyncWebsocketConsumer):
+    """One order per socket (ws/orders/<order_id>/). OrderUpdatesConsumer follows them all on one."""
+
     async def connect(self):
         self.user = self.scope["user"]
-        
+        self.room_group_name = None
+
         if not self.user.is_authenticated:
             await self.close()
             return
-            
-        self.order_id = self.scope['url_route']['kwargs']['order_id']
-        self.room_group_name = f'order_{self.order_id}'
-        
-        # Join room group
+
+        try:
+            self.order_id = int(self.scope['url_route']['kwargs']['order_id'])
+        except ValueError:
+            await self.close()
+            return
+
+        # Check if user has permission to access this order before joining its group
+        if not await self.can_access_order(self.user, self.order_id):
+            await self.close()
+            return
+
+        self.room_group_name = order_group(self.order_id)
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
-        
-        # Check if user has permission to access this order
-        if await self.can_access_order(self.user, self.order_id):
-            await self.accept()
-        else:
-            await self.close()
-    
+        await self.accept()
+
     async def disconnect(self, close_code):
         # Leave room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
-    
+        if self.room_group_name:
+            await self.channel_layer.group_discard(
+                self.room_group_name,
+                self.channel_name
+            )
+
     @database_sync_to_async
     def can_access_order(self, user, order_id):
-        try:
-            order = Order.objects.get(id=order_id)
-            return user.id == order.user.id or user.user_type == 'admin'
-        except Order.DoesNotExist:
-            return False
-    
+        return bool(authorized_orders(user, [order_id]))
+
     # Receive message from WebSocket
     async def receive(self, text_data):
         pass  # Client doesn't send data, just receives updates
-    
+
     # Receive message from room group
     async def order_update(self, event):
         # Send message to WebSocket
         await self.send(text_data=json.dumps({
             'type': 'order_update',
             'data': event['data']
-        }))
\ No newline at end of file
+        }))
+
+
+class OrderUpdatesConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Every order update for the signed-in user over one socket (ws/orders/).
+
+    The socket joins the user's group, which gets an update for each of the
+    user's orders, including ones placed after it connected (one query lists
+    the open ones in the first message). The client can then send
+    {"action": "subscribe" | "unsubscribe", "orders": [ids]} to follow other
+    orders it may see (admins: any order, through the order's group) or mute
+    some; the server answers with {"type": "subscribed", "orders": [...],
+    "denied": [...]} or {"type": "unsubscribed", "orders": [...]}. Updates
+    arrive as {"type": "order_update", "data": {...}}, the same as the
+    per-order socket.
+    """
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        # Orders followed, other users' orders among them through their order group, and own orders muted
+        self.order_ids, self.joined, self.muted = set(), set(), set()
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        await self.accept()
+        await self.channel_layer.group_add(user_orders_group(self.user.id), self.channel_name)
+        self.order_ids.update(await database_sync_to_async(open_orders)(self.user))
+        await self.send_json({'type': 'subscribed', 'orders': sorted(self.order_ids), 'denied': []})
+
+    async def disconnect(self, close_code):
+        if self.user.is_authenticated:
+            await self.channel_layer.group_discard(user_orders_group(self.user.id), self.channel_name)
+        await self.leave(list(self.joined))
+
+    async def join(self, order_ids):
+        await asyncio.gather(*(self.channel_layer.group_add(order_group(order_id), self.channel_name) for order_id in order_ids))
+        self.joined.update(order_ids)
+
+    async def leave(self, order_ids):
+        await asyncio.gather(*(self.channel_layer.group_discard(order_group(order_id), self.channel_name) for order_id in order_ids))
+        self.joined.difference_update(order_ids)
+
+    async def receive_json(self, content, **kwargs):
+        action = content.get('action') if isinstance(content, dict) else None
+        order_ids = content.get('orders') if isinstance(content, dict) else None
+        if action not in ('subscribe', 'unsubscribe'):
+            await self.send_json({'type': 'error', 'error': 'action must be subscribe or unsubscribe'})
+            return
+        if not isinstance(order_ids, list) or not all(isinstance(order_id, int) for order_id in order_ids):
+            await self.send_json({'type': 'error', 'error': 'orders must be a list of order ids'})
+            return
+
+        if action == 'unsubscribe':
+            dropped = [order_id for order_id in set(order_ids) if order_id in self.order_ids]
+            await self.leave([order_id for order_id in dropped if order_id in self.joined])
+            self.order_ids.difference_update(dropped)
+            # Own orders keep coming through the user's group, including ones not followed yet
+            self.muted.update(order_ids)
+            await self.send_json({'type': 'unsubscribed', 'orders': sorted(dropped)})
+            return
+
+        wanted = [order_id for order_id in dict.fromkeys(order_ids) if order_id not in self.order_ids]
+        if len(self.order_ids) + len(wanted) > MAX_ORDER_SUBSCRIPTIONS:
+            await self.send_json({'type': 'error', 'error': f'At most {MAX_ORDER_SUBSCRIPTIONS} orders can be followed per socket'})
+            return
+        owners = await database_sync_to_async(order_owners)(wanted) if wanted else {}
+        allowed = authorized_orders(self.user, wanted, owners)
+        # The user's own orders already reach the socket through its user group
+        await self.join([order_id for order_id in allowed if owners[order_id] != self.user.id])
+        self.order_ids.update(allowed)
+        self.muted.difference_update(allowed)
+        await self.send_json({
+            'type': 'subscribed',
+            'orders': sorted(allowed),
+            'denied': sorted(set(wanted) - set(allowed)),
+        })
+
+    async def order_update(self, event):
+        if event['data']['id'] not in self.muted:
+            await self.send_json({'type': 'order_update', 'data': event['data']})
@@ -0,0 +1,71 @@
+import hashlib
+import json
+import time
+from django.conf import settings
+from django.core.cache import cache
+from .cache import get_or_compute, set_computed
+from .models import Product
+from .serializers import ProductSerializer
+from .images import VARIANT_FORMATS
+
+# Cached in place of a payload when a slug has no product, so bogus slugs don't reach the DB
+MISSING = 'missing'
+MISSING_TTL = 60
+
+
+def product_detail_key(slug):
+    return f'product_detail_{slug}'
+
+
+def serialize_product(product):
+    """
+    Build the cache entry for a product: its payload plus the ETag and
+    Last-Modified used to answer conditional requests without re-serializing.
+    """
+    # No request in the context: cached payloads keep relative media URLs
+    # and are made absolute per request by absolutize_media_urls()
+    data = ProductSerializer(product).data
+    digest = hashlib.md5(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+    return {'data': data, 'etag': f'"{digest}"', 'last_modified': int(time.time())}
+
+
+def load_product_detail(slug):
+    product = Product.objects.prefetch_related('images', 'categories').filter(slug=slug).first()
+    return serialize_product(product) if product else MISSING
+
+
+def get_product_detail(slug):
+    """Cache entry (see serialize_product) for `slug`, or None. Warm hits never touch the DB."""
+    data = get_or_compute(product_detail_key(slug), lambda: load_product_detail(slug), settings.CACHE_TTL)
+    return None if data == MISSING else data
+
+
+def refresh_product_detail(product_id):
+    """Write-through: re-serialize a product straight into the cache after it changes."""
+    refresh_product_details([product_id])
+
+
+def refresh_product_details(product_ids):
+    """refresh_product_detail() for many products, in a fixed number of queries."""
+    for product in Product.objects.prefetch_related('images', 'categories').filter(pk__in=product_ids):
+        if product.slug:
+            set_computed(product_detail_key(product.slug), serialize_product(product), settings.CACHE_TTL)
+
+
+def forget_product_details(slugs):
+    cache.delete_many([product_detail_key(slug) for slug in slugs if slug])
+
+
+def absolutize_media_urls(request, data):
+    for image in data.get('images', []):
+        if image.get('image'):
+            image['image'] = request.build_absolute_uri(image['image'])
+        srcset = image.get('srcset')
+        if srcset:
+            srcset['thumbnail'] = request.build_absolute_uri(srcset['thumbnail'])
+            for ext in VARIANT_FORMATS:
+                srcset[ext] = ', '.join(
+                    f'{request.build_absolute_uri(url)} {width}'
+                    for url, width in (candidate.rsplit(' ', 1) for candidate in srcset[ext].split(', '))
+                )
+    return data
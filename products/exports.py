@@ -0,0 +1,111 @@
+import csv
+import heapq
+import json
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from .models import Order
+
+EXPORT_FORMATS = ('csv', 'ndjson')
+EXPORT_CHUNK_SIZE = 2000
+
+CSV_COLUMNS = (
+    'order_id', 'tracking_number', 'user_id', 'status', 'created_at', 'total_amount',
+    'shipping_address', 'product_id', 'product_name', 'product_price', 'quantity',
+)
+
+
+class ExportError(ValueError):
+    pass
+
+
+class Echo:
+    """File-like object whose write() hands the line back, for csv.writer in a generator."""
+
+    def write(self, value):
+        return value
+
+
+def _parse_bound(value, end_of_day=False):
+    try:
+        day = parse_date(value)
+        moment = None if day else parse_datetime(value)
+    except ValueError:
+        day = moment = None
+
+    if day is not None:
+        # A bare date includes that whole day
+        return {'created_at__date__lte' if end_of_day else 'created_at__date__gte': day}
+    if moment is None:
+        raise ExportError(f'Invalid date: {value}')
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return {'created_at__lte' if end_of_day else 'created_at__gte': moment}
+
+
+def filter_orders(query_params, model=Order):
+    """Orders matching ?date_from=&date_to=&status= (status may repeat). Pass model=ArchivedOrder for the archive tier."""
+    filters = {}
+    if query_params.get('date_from'):
+        filters.update(_parse_bound(query_params['date_from']))
+    if query_params.get('date_to'):
+        filters.update(_parse_bound(query_params['date_to'], end_of_day=True))
+
+    statuses = query_params.getlist('status')
+    invalid = set(statuses) - set(dict(Order.STATUS_CHOICES))
+    if invalid:
+        raise ExportError(f"Invalid status: {', '.join(sorted(invalid))}")
+    if statuses:
+        filters['status__in'] = statuses
+    return model.objects.filter(**filters)
+
+
+def iter_orders(*querysets):
+    # iterator() with a chunk size keeps memory flat (server-side cursors where
+    # the database has them) and still prefetches items one chunk at a time.
+    # Several querysets (the hot and archived tiers) are merged oldest first
+    return heapq.merge(
+        *(
+            queryset.order_by('created_at', 'id').prefetch_related('items').iterator(chunk_size=EXPORT_CHUNK_SIZE)
+            for queryset in querysets
+        ),
+        key=lambda order: (order.created_at, order.id),
+    )
+
+
+def order_as_dict(order):
+    return {
+        'id': order.id,
+        'tracking_number': order.tracking_number,
+        'user_id': order.user_id,
+        'status': order.status,
+        'created_at': order.created_at.isoformat(),
+        'total_amount': str(order.total_amount),
+        'shipping_address': order.shipping_address,
+        'items': [
+            {
+                'product_id': str(item.product_id) if item.product_id else None,
+                'product_name': item.product_name,
+                'product_price': str(item.product_price),
+                'quantity': item.quantity,
+            }
+            for item in order.items.all()
+        ],
+    }
+
+
+def export_ndjson(*querysets):
+    for order in iter_orders(*querysets):
+        yield json.dumps(order_as_dict(order)) + '\n'
+
+
+def export_csv(*querysets):
+    """One row per order item; orders without items still get a row."""
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    for order in iter_orders(*querysets):
+        data = order_as_dict(order)
+        head = [data['id'], data['tracking_number'], data['user_id'], data['status'],
+                data['created_at'], data['total_amount'], data['shipping_address']]
+        items = data['items'] or [{'product_id': '', 'product_name': '', 'product_price': '', 'quantity': ''}]
+        for item in items:
+            yield writer.writerow(head + [item['product_id'], item['product_name'], item['product_price'], item['quantity']])
@@ -0,0 +1,73 @@
+from django.core.cache import cache
+from django.conf import settings
+from django.db.models import Count, F, Q
+from .cache import make_response_key, PRODUCT_LIST_TAGS
+from .models import Product
+
+# Upper edges of the price histogram; the last bucket is open-ended
+PRICE_BUCKETS = (0, 500, 1000, 5000, 10000, 50000)
+
+# Parameters that change the page but not the filtered set
+NON_FILTER_PARAMS = ('cursor', 'page_size', 'ordering', 'facets')
+
+
+def wants_facets(request):
+    return request.query_params.get('facets') in ('1', 'true', 'True')
+
+
+def get_filter_signature(query_params):
+    params = query_params.copy()
+    for param in NON_FILTER_PARAMS:
+        params.pop(param, None)
+    return params
+
+
+def compute_facets(queryset):
+    """Category counts, price histogram and stock availability for a filtered queryset."""
+    product_ids = queryset.order_by().values('pk')
+
+    # Price buckets, stock availability and total in one aggregate query
+    aggregates = {'total': Count('pk'), 'in_stock': Count('pk', filter=Q(stock__gt=F('reserved')))}
+    edges = list(PRICE_BUCKETS) + [None]
+    for i, (low, high) in enumerate(zip(edges, edges[1:])):
+        price_range = Q(price__gte=low) if high is None else Q(price__gte=low, price__lt=high)
+        aggregates[f'price_{i}'] = Count('pk', filter=price_range)
+    totals = Product.objects.filter(pk__in=product_ids).aggregate(**aggregates)
+
+    # A product can sit in several categories, so category counts need their own GROUP BY
+    category_counts = (
+        Product.categories.through.objects
+        .filter(product_id__in=product_ids)
+        .values('category_id', 'category__title', 'category__slug')
+        .annotate(count=Count('product_id'))
+        .order_by('-count', 'category__title')
+    )
+
+    return {
+        'total': totals['total'],
+        'in_stock': totals['in_stock'],
+        'out_of_stock': totals['total'] - totals['in_stock'],
+        'price': [
+            {'min': low, 'max': high, 'count': totals[f'price_{i}']}
+            for i, (low, high) in enumerate(zip(edges, edges[1:]))
+        ],
+        'categories': [
+            {
+                'id': row['category_id'],
+                'title': row['category__title'],
+                'slug': row['category__slug'],
+                'count': row['count'],
+            }
+            for row in category_counts
+        ],
+    }
+
+
+def get_product_facets(request, queryset):
+    """Facets cached by filter signature, so paging through a filtered set aggregates once."""
+    cache_key = make_response_key('product_facets', get_filter_signature(request.query_params), PRODUCT_LIST_TAGS)
+    facets = cache.get(cache_key)
+    if facets is None:
+        facets = compute_facets(queryset)
+        cache.set(cache_key, facets, settings.CACHE_TTL)
+    return facets
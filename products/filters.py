@@ -0,0 +1,28 @@
+from django_filters import rest_framework as django_filters
+from django.db.models import F
+from .models import Category, Product
+from .category_tree import get_category_path
+
+
+class ProductFilter(django_filters.FilterSet):
+    # All products in a category and its descendants, e.g. ?category_tree=electronics
+    category_tree = django_filters.CharFilter(method='filter_category_tree')
+    min_price = django_filters.NumberFilter(field_name='price', lookup_expr='gte')
+    max_price = django_filters.NumberFilter(field_name='price', lookup_expr='lte')
+    in_stock = django_filters.BooleanFilter(method='filter_in_stock')
+
+    class Meta:
+        model = Product
+        fields = ['categories', 'price', 'is_active']
+
+    def filter_category_tree(self, queryset, name, value):
+        path = get_category_path(value)
+        if not path:
+            return queryset.none()
+
+        links = Product.categories.through.objects.filter(Category.subtree_q(path, prefix='category__'))
+        return queryset.filter(id__in=links.values('product_id'))
+
+    def filter_in_stock(self, queryset, name, value):
+        # In stock means available_stock > 0: units held by reservations can't be sold
+        return queryset.filter(stock__gt=F('reserved')) if value else queryset.filter(stock__lte=F('reserved'))
@@ -0,0 +1,102 @@
+import hashlib
+import json
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import status
+from rest_framework.response import Response
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+# A request that crashes without a response keeps its key locked this long
+LOCK_TIMEOUT = 30
+
+
+class IdempotencyError(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class IdempotentReplay(Exception):
+    def __init__(self, stored):
+        super().__init__('replay')
+        self.stored = stored
+
+
+def request_fingerprint(request):
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.md5(f'{request.method} {request.path} {body}'.encode()).hexdigest()
+
+
+class IdempotencyMixin:
+    """
+    Makes the actions in `idempotent_actions` safe to retry.
+
+    A request carrying an `Idempotency-Key` header runs once; its response is
+    stored for IDEMPOTENCY_KEY_TTL seconds and replayed (with an
+    `Idempotent-Replayed: true` header) for every retry with the same key, so
+    a retried checkout costs a cache read instead of a second order. While the
+    first request is still running, retries get 409. Reusing a key for a
+    different request body gets 422. Keys are scoped per user and action.
+    """
+    idempotent_actions = ()
+
+    def get_idempotency_cache_key(self, request, key):
+        digest = hashlib.md5(key.encode()).hexdigest()
+        return f'idempotency_{request.user.pk or "anon"}_{self.basename}_{self.action}_{digest}'
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key or self.action not in self.idempotent_actions:
+            return
+        if len(key) > MAX_KEY_LENGTH:
+            raise IdempotencyError(f"{IDEMPOTENCY_HEADER} is limited to {MAX_KEY_LENGTH} characters", status.HTTP_400_BAD_REQUEST)
+
+        cache_key = self.get_idempotency_cache_key(request, key)
+        fingerprint = request_fingerprint(request)
+        stored = cache.get(cache_key)
+        if stored is None:
+            if not cache.add(f'{cache_key}_lock', 1, timeout=LOCK_TIMEOUT):
+                raise IdempotencyError(
+                    f"A request with this {IDEMPOTENCY_HEADER} is still being processed", status.HTTP_409_CONFLICT
+                )
+            # The first request may have finished between the read and taking the lock
+            stored = cache.get(cache_key)
+            if stored is None:
+                self.idempotency_pending = (cache_key, fingerprint)
+                return
+            cache.delete(f'{cache_key}_lock')
+
+        if stored['fingerprint'] != fingerprint:
+            raise IdempotencyError(
+                f"This {IDEMPOTENCY_HEADER} was already used for a different request",
+                status.HTTP_422_UNPROCESSABLE_ENTITY,
+            )
+        raise IdempotentReplay(stored)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, IdempotentReplay):
+            response = Response(exc.stored['data'], status=exc.stored['status'])
+            response['Idempotent-Replayed'] = 'true'
+            return response
+        if isinstance(exc, IdempotencyError):
+            return Response({"error": str(exc)}, status=exc.status_code)
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        pending = getattr(self, 'idempotency_pending', None)
+        if pending:
+            cache_key, fingerprint = pending
+            # Server errors aren't stored so the client's retry gets a real second attempt
+            if response.status_code < 500 and not response.streaming:
+                cache.set(
+                    cache_key,
+                    {'fingerprint': fingerprint, 'status': response.status_code, 'data': response.data},
+                    timeout=getattr(settings, 'IDEMPOTENCY_KEY_TTL', 60 * 60 * 24),
+                )
+            cache.delete(f'{cache_key}_lock')
+            self.idempotency_pending = None
+        return response
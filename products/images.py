@@ -0,0 +1,115 @@
+import hashlib
+import io
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps, UnidentifiedImageError
+from .models import ProductImage
+
+# Widths of the generated derivatives; the smallest doubles as the list-page thumbnail
+VARIANT_WIDTHS = (160, 320, 640, 1280)
+VARIANT_FORMATS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 6},
+    'jpeg': {'format': 'JPEG', 'quality': 82, 'optimize': True, 'progressive': True},
+}
+VARIANT_ROOT = 'product_images/variants'
+
+
+def hash_file(field_file):
+    digest = hashlib.sha256()
+    with field_file.open('rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def variant_path(content_hash, width, ext):
+    # Content-addressed, so identical uploads share one set of files
+    return f'{VARIANT_ROOT}/{content_hash[:2]}/{content_hash}/{width}.{ext}'
+
+
+def encode(image, ext):
+    options = dict(VARIANT_FORMATS[ext])
+    if ext == 'jpeg' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    # No exif/icc arguments are passed, so the output carries no metadata
+    image.save(buffer, **options)
+    return buffer.getvalue()
+
+
+def build_variants(field_file, content_hash):
+    """Write metadata-free resized JPEG and WebP copies; return {width: {ext: path}}."""
+    with field_file.open('rb') as f:
+        original = Image.open(f)
+        original = ImageOps.exif_transpose(original)
+        original.load()
+    if original.mode not in ('RGB', 'RGBA', 'L'):
+        original = original.convert('RGBA' if 'A' in original.getbands() else 'RGB')
+
+    # Never upscale, but always produce at least the thumbnail size
+    widths = [width for width in VARIANT_WIDTHS if width <= original.width] or [VARIANT_WIDTHS[0]]
+    variants = {}
+    for width in widths:
+        resized = original.copy()
+        resized.thumbnail((width, width * 10), Image.LANCZOS)
+        variants[str(width)] = {}
+        for ext in VARIANT_FORMATS:
+            path = variant_path(content_hash, width, ext)
+            if not default_storage.exists(path):
+                path = default_storage.save(path, ContentFile(encode(resized, ext)))
+            variants[str(width)][ext] = path
+    return variants
+
+
+def process_product_image(image_id):
+    """
+    Hash the upload, reuse the files of an identical earlier upload if there is
+    one, otherwise generate the derivatives. Returns the updated ProductImage,
+    or None if it vanished or is not a readable image.
+    """
+    image = ProductImage.objects.filter(pk=image_id).first()
+    if image is None or not image.image:
+        return None
+
+    try:
+        content_hash = hash_file(image.image)
+    except FileNotFoundError:
+        return None
+
+    duplicate = (
+        ProductImage.objects
+        .filter(content_hash=content_hash)
+        .exclude(pk=image.pk)
+        .exclude(variants={})
+        .first()
+    )
+    if duplicate is not None:
+        name, variants = duplicate.image.name, duplicate.variants
+        if image.image.name != name:
+            # Keep one copy of the original on disk
+            image.image.delete(save=False)
+    else:
+        try:
+            variants = build_variants(image.image, content_hash)
+        except (UnidentifiedImageError, OSError):
+            return None
+        name = image.image.name
+
+    # update() rather than save() so this doesn't re-trigger the post_save pipeline
+    ProductImage.objects.filter(pk=image.pk).update(image=name, content_hash=content_hash, variants=variants)
+    image.image.name, image.content_hash, image.variants = name, content_hash, variants
+    return image
+
+
+def build_srcset(variants, build_url):
+    """
+    Compact srcset strings per format plus the thumbnail URL, e.g.
+    {'thumbnail': url, 'webp': 'url 160w, url 320w', 'jpeg': '...'}.
+    """
+    if not variants:
+        return None
+    widths = sorted(variants, key=int)
+    srcset = {'thumbnail': build_url(variants[widths[0]]['webp'])}
+    for ext in VARIANT_FORMATS:
+        srcset[ext] = ', '.join(f'{build_url(variants[width][ext])} {width}w' for width in widths)
+    return srcset
@@ -0,0 +1,222 @@
+import csv
+import json
+from decimal import Decimal, InvalidOperation
+from django.db import transaction
+from django.utils import timezone
+from django.utils.text import slugify
+from .models import Category, Product, allocate_unique_slugs
+from .cache import bump_tags, PRODUCT_TAG, PRICE_TAG, CATEGORY_TAG
+from .search import index_products
+from .detail_cache import forget_product_details
+
+IMPORT_FORMATS = ('ndjson', 'csv')
+UPDATE_FIELDS = ('title', 'description', 'price', 'stock', 'is_active')
+SLUG_MAX_LENGTH = Product._meta.get_field('slug').max_length
+
+# Only the first few bad rows are reported back in detail
+MAX_REPORTED_ERRORS = 50
+
+
+class ImportRowError(ValueError):
+    pass
+
+
+def iter_rows(stream, fmt):
+    """Yield (line_number, row dict) from a text stream without reading it all in."""
+    if fmt == 'csv':
+        for line_number, row in enumerate(csv.DictReader(stream), start=2):
+            yield line_number, row
+    elif fmt == 'ndjson':
+        for line_number, line in enumerate(stream, start=1):
+            if line.strip():
+                try:
+                    yield line_number, json.loads(line)
+                except ValueError:
+                    yield line_number, None
+    else:
+        raise ValueError(f'Unsupported import format: {fmt}')
+
+
+def _parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y')
+
+
+def parse_row(row):
+    """Validate one feed row into clean product values."""
+    if not isinstance(row, dict):
+        raise ImportRowError('Row is not an object')
+
+    title = (row.get('title') or '').strip()
+    slug = (row.get('slug') or '').strip()
+    if not title and not slug:
+        raise ImportRowError('Row needs a title or a slug')
+    if slug:
+        slug = slugify(slug)
+        if not slug or len(slug) > SLUG_MAX_LENGTH:
+            raise ImportRowError(f'Invalid slug (letters, digits and hyphens, at most {SLUG_MAX_LENGTH} characters)')
+
+    values = {'slug': slug or None}
+    if title:
+        values['title'] = title
+    if row.get('description') not in (None, ''):
+        values['description'] = row['description']
+    try:
+        if row.get('price') not in (None, ''):
+            values['price'] = Decimal(str(row['price']))
+        if row.get('stock') not in (None, ''):
+            values['stock'] = int(row['stock'])
+            if values['stock'] < 0:
+                raise ValueError
+    except (InvalidOperation, ValueError):
+        raise ImportRowError('Invalid price or stock')
+    if row.get('is_active') not in (None, ''):
+        values['is_active'] = _parse_bool(row['is_active'])
+
+    categories = row.get('categories')
+    if isinstance(categories, str):
+        # CSV feeds use "Phones|Tablets"
+        categories = [title for title in categories.split('|')]
+    if categories is not None:
+        values['categories'] = [title.strip() for title in categories if title and slugify(title)]
+    return values
+
+
+class CatalogImporter:
+    """
+    Upserts products, categories and category links from a feed in batches.
+
+    Rows with a `slug` update the product with that slug (or create it);
+    rows without one always create a product and get a unique slug allocated
+    from the title. Each batch costs a fixed handful of queries and runs in its
+    own transaction, so a failed batch does not undo earlier ones.
+    """
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.stats = {'processed': 0, 'created': 0, 'updated': 0, 'failed': 0, 'errors': []}
+        self.category_ids = {}
+        self.reserved_slugs = set()
+
+    def run(self, rows):
+        """Consume (line_number, row) pairs, yielding the running stats after each batch."""
+        batch = []
+        for line_number, row in rows:
+            self.stats['processed'] += 1
+            try:
+                batch.append(parse_row(row))
+            except ImportRowError as exc:
+                self.record_error(line_number, str(exc))
+
+            if len(batch) >= self.batch_size:
+                self.import_batch(batch)
+                batch = []
+                yield self.stats
+        if batch:
+            self.import_batch(batch)
+        yield self.stats
+
+    def record_error(self, line_number, message):
+        self.stats['failed'] += 1
+        if len(self.stats['errors']) < MAX_REPORTED_ERRORS:
+            self.stats['errors'].append({'line': line_number, 'error': message})
+
+    def resolve_categories(self, titles):
+        missing = {slugify(title): title for title in titles if slugify(title) not in self.category_ids}
+        if missing:
+            self.category_ids.update(
+                Category.objects.filter(slug__in=missing).values_list('slug', 'id')
+            )
+            for slug, title in missing.items():
+                if slug not in self.category_ids:
+                    # New categories are rare, save() keeps their tree path right
+                    category = Category.objects.create(title=title, slug=slug)
+                    self.category_ids[slug] = category.id
+
+    @transaction.atomic
+    def import_batch(self, batch):
+        # Later rows for the same slug win
+        keyed = {}
+        new_rows = []
+        for values in batch:
+            if values['slug']:
+                keyed[values['slug']] = values
+            else:
+                new_rows.append(values)
+
+        existing = {product.slug: product for product in Product.objects.filter(slug__in=keyed)}
+        now = timezone.now()
+        to_create, to_update = [], []
+
+        for slug, values in keyed.items():
+            product = existing.get(slug)
+            if product is None:
+                new_rows.append(values)
+                continue
+            for field in UPDATE_FIELDS:
+                if field in values:
+                    setattr(product, field, values[field])
+            product.updated_at = now
+            to_update.append((product, values))
+
+        creatable = []
+        for values in new_rows:
+            if 'price' not in values or 'title' not in values:
+                self.record_error(None, f"New product {values['slug'] or values.get('title')!r} needs a title and a price")
+                continue
+            creatable.append(values)
+
+        self.reserved_slugs.update(values['slug'] for values in creatable if values['slug'])
+        fresh_slugs = allocate_unique_slugs(
+            Product, [slugify(values['title']) for values in creatable if not values['slug']], self.reserved_slugs
+        )
+        fresh_slugs = iter(fresh_slugs)
+        for values in creatable:
+            product = Product(
+                slug=values['slug'] or next(fresh_slugs),
+                **{field: values[field] for field in UPDATE_FIELDS if field in values},
+            )
+            to_create.append((product, values))
+
+        Product.objects.bulk_create([product for product, _ in to_create], batch_size=self.batch_size)
+        # Only write the fields each row supplied, so e.g. a price-only feed doesn't
+        # put back a stock value checkouts have decremented since it was read
+        by_fields = {}
+        for product, values in to_update:
+            fields = tuple(field for field in UPDATE_FIELDS if field in values)
+            by_fields.setdefault(fields, []).append(product)
+        for fields, products in by_fields.items():
+            Product.objects.bulk_update(products, list(fields) + ['updated_at'], batch_size=self.batch_size)
+
+        self.link_categories(to_create + to_update)
+
+        touched = [product.id for product, _ in to_create + to_update]
+        # bulk_* skip signals, so refresh derived data for the whole batch at once
+        index_products(touched)
+        updated_slugs = [product.slug for product, _ in to_update]
+        transaction.on_commit(lambda: forget_product_details(updated_slugs))
+        transaction.on_commit(lambda: bump_tags(PRODUCT_TAG, CATEGORY_TAG))
+        if any('price' in values for _, values in to_update):
+            transaction.on_commit(lambda: bump_tags(PRICE_TAG))
+
+        self.stats['created'] += len(to_create)
+        self.stats['updated'] += len(to_update)
+
+    def link_categories(self, pairs):
+        pairs = [(product, values) for product, values in pairs if 'categories' in values]
+        if not pairs:
+            return
+
+        self.resolve_categories({title for _, values in pairs for title in values['categories']})
+        Link = Product.categories.through
+        Link.objects.filter(product_id__in=[product.id for product, _ in pairs]).delete()
+        Link.objects.bulk_create(
+            [
+                Link(product_id=product.id, category_id=self.category_ids[slugify(title)])
+                for product, values in pairs
+                for title in set(values['categories'])
+            ],
+            batch_size=self.batch_size,
+            ignore_conflicts=True,
+        )
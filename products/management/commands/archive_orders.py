@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from products.archive import archive_orders
+
+
+class Command(BaseCommand):
+    help = 'Move delivered/cancelled orders older than --days into the archive tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None, help='Defaults to ORDER_ARCHIVE_AFTER_DAYS')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        archived = archive_orders(days=options['days'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Archived {archived} orders'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from products.reports import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily sales, product sales and order status rollups from the order history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        days = rebuild_rollups(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Sales rollups rebuilt for {days} days'))
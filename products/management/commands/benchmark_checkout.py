@@ -0,0 +1,77 @@
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import connection, OperationalError
+from users.models import User
+from products.models import Product, Cart, CartItem, Order
+from products.checkout import place_order, CheckoutError
+from products.reports import orders_deleted
+
+
+class Command(BaseCommand):
+    help = 'Race many buyers for the same SKU through checkout and report throughput and oversell'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=200)
+        parser.add_argument('--stock', type=int, default=100)
+        parser.add_argument('--quantity', type=int, default=1, help='Units of the SKU in each cart')
+        parser.add_argument('--lines', type=int, default=1, help='Cart lines per buyer, the raced SKU included')
+        parser.add_argument('--threads', type=int, default=8)
+
+    def handle(self, *args, **options):
+        run = uuid.uuid4().hex[:8]
+        sku = Product.objects.create(title=f'Benchmark SKU {run}', price=10, stock=options['stock'])
+        extras = [
+            Product.objects.create(title=f'Benchmark extra {run} {i}', price=1, stock=10 ** 6)
+            for i in range(options['lines'] - 1)
+        ]
+        users = User.objects.bulk_create([
+            User(username=f'bench-{run}-{i}', email=f'bench-{run}-{i}@example.com')
+            for i in range(options['buyers'])
+        ])
+        users = list(User.objects.filter(username__startswith=f'bench-{run}-'))
+        Cart.objects.bulk_create([Cart(user=user) for user in users])
+        carts = Cart.objects.filter(user__in=users)
+        CartItem.objects.bulk_create(
+            [CartItem(cart=cart, product=sku, quantity=options['quantity']) for cart in carts] +
+            [CartItem(cart=cart, product=extra, quantity=1) for cart in carts for extra in extras]
+        )
+
+        def buy(user):
+            try:
+                place_order(user, 'Benchmark', notify=False)
+                return 'placed'
+            except CheckoutError:
+                return 'rejected'
+            except OperationalError:
+                # e.g. SQLite's "database is locked" under heavy write contention
+                return 'failed'
+            finally:
+                connection.close()
+
+        try:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+                results = list(pool.map(buy, users))
+            elapsed = time.perf_counter() - started
+
+            sku.refresh_from_db()
+            placed = results.count('placed')
+            sold = options['stock'] - sku.stock
+            self.stdout.write(
+                f"buyers={len(users)} placed={placed} rejected={results.count('rejected')} "
+                f"failed={results.count('failed')} elapsed={elapsed:.2f}s "
+                f"throughput={len(users) / elapsed:.1f} checkouts/s"
+            )
+            if sku.stock < 0 or sold != placed * options['quantity']:
+                self.stderr.write(self.style.ERROR(f'Oversold: stock={sku.stock}, sold={sold}, placed={placed}'))
+            else:
+                self.stdout.write(self.style.SUCCESS(f'No oversell: {sold} of {options["stock"]} units sold'))
+        finally:
+            # Checkout wrote these orders into the sales rollups; take them out again with the orders
+            orders = Order.objects.filter(user__in=users)
+            orders_deleted(orders)
+            orders.delete()
+            User.objects.filter(pk__in=[user.pk for user in users]).delete()
+            Product.objects.filter(pk__in=[sku.pk] + [extra.pk for extra in extras]).delete()
@@ -0,0 +1,33 @@
+import io
+from django.core.management.base import BaseCommand, CommandError
+from products.importer import CatalogImporter, iter_rows, IMPORT_FORMATS
+
+
+class Command(BaseCommand):
+    help = 'Upsert products and categories from an NDJSON or CSV supplier feed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Feed file, or - for stdin')
+        parser.add_argument('--format', choices=IMPORT_FORMATS, help='Defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('csv' if path.endswith('.csv') else 'ndjson')
+
+        try:
+            stream = self.stdin if path == '-' else io.open(path, encoding='utf-8', newline='')
+        except OSError as exc:
+            raise CommandError(str(exc))
+
+        importer = CatalogImporter(batch_size=options['batch_size'])
+        with stream:
+            for stats in importer.run(iter_rows(stream, fmt)):
+                self.stdout.write(
+                    f"processed={stats['processed']} created={stats['created']} "
+                    f"updated={stats['updated']} failed={stats['failed']}"
+                )
+
+        for error in importer.stats['errors']:
+            self.stderr.write(f"line {error['line']}: {error['error']}")
+        self.stdout.write(self.style.SUCCESS('Catalog import finished'))
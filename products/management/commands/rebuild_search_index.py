@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from products.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Regenerate the product full-text search index from the catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        rebuild_index(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS('Product search index rebuilt'))
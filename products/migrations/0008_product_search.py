@@ -0,0 +1,96 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:46
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+FTS_SQL = [
+    """
+    CREATE VIRTUAL TABLE product_search USING fts5(
+        title, description, categories,
+        content='product_search_documents', content_rowid='id',
+        tokenize='porter unicode61'
+    )
+    """,
+    """
+    CREATE TRIGGER product_search_ai AFTER INSERT ON product_search_documents BEGIN
+        INSERT INTO product_search(rowid, title, description, categories)
+        VALUES (new.id, new.title, new.description, new.categories);
+    END
+    """,
+    """
+    CREATE TRIGGER product_search_ad AFTER DELETE ON product_search_documents BEGIN
+        INSERT INTO product_search(product_search, rowid, title, description, categories)
+        VALUES ('delete', old.id, old.title, old.description, old.categories);
+    END
+    """,
+    """
+    CREATE TRIGGER product_search_au AFTER UPDATE ON product_search_documents BEGIN
+        INSERT INTO product_search(product_search, rowid, title, description, categories)
+        VALUES ('delete', old.id, old.title, old.description, old.categories);
+        INSERT INTO product_search(rowid, title, description, categories)
+        VALUES (new.id, new.title, new.description, new.categories);
+    END
+    """,
+]
+
+DROP_SQL = [
+    'DROP TRIGGER IF EXISTS product_search_au',
+    'DROP TRIGGER IF EXISTS product_search_ad',
+    'DROP TRIGGER IF EXISTS product_search_ai',
+    'DROP TABLE IF EXISTS product_search',
+]
+
+
+def create_fts_index(apps, schema_editor):
+    # FTS5 is SQLite only; other databases fall back to icontains search
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for sql in FTS_SQL:
+        schema_editor.execute(sql)
+
+
+def drop_fts_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for sql in DROP_SQL:
+        schema_editor.execute(sql)
+
+
+def build_documents(apps, schema_editor):
+    Product = apps.get_model('products', 'Product')
+    ProductSearchDocument = apps.get_model('products', 'ProductSearchDocument')
+    documents = [
+        ProductSearchDocument(
+            product=product,
+            title=product.title,
+            description=product.description or '',
+            categories=' '.join(category.title for category in product.categories.all()),
+        )
+        for product in Product.objects.prefetch_related('categories').iterator(chunk_size=2000)
+    ]
+    ProductSearchDocument.objects.bulk_create(documents, batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0007_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=200)),
+                ('description', models.TextField(blank=True)),
+                ('categories', models.TextField(blank=True)),
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='search_document', to='products.product')),
+            ],
+            options={
+                'db_table': 'product_search_documents',
+            },
+        ),
+        migrations.RunPython(create_fts_index, drop_fts_index),
+        migrations.RunPython(build_documents, migrations.RunPython.noop),
+    ]
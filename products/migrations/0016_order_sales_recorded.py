@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:24
+
+from django.db import migrations, models
+
+# products.reports.SALES_STATUSES when this migration was written
+SALES_STATUSES = ('pending', 'processing', 'shipped', 'delivered')
+
+
+def mark_recorded_orders(apps, schema_editor):
+    # The rollups (filled by checkout or backfill_sales_rollups) count every order in a sales status
+    Order = apps.get_model('products', 'Order')
+    Order.objects.filter(status__in=SALES_STATUSES).update(sales_recorded=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0015_order_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='sales_recorded',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.RunPython(mark_recorded_orders, migrations.RunPython.noop),
+    ]
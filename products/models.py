@@ -1,20 +1,116 @@
-from django.db import models
+from django.db import models, transaction
 from django.utils.text import slugify
+from django.db.models import Q, Value
+from django.db.models.functions import Concat, Substr
 import uuid
 from users.models import User
 import random
 import string
+from collections import Counter
+
+
+def allocate_unique_slugs(model, bases, reserved=None):
+    """
+    Return one unused slug per base, suffixing "-2", "-3"... on collisions.
+    Costs one query, plus one more if anything collides, however many bases
+    are passed. `reserved` holds slugs already handed out but not yet saved
+    and is updated in place.
+    """
+    reserved = set() if reserved is None else reserved
+    max_length = model._meta.get_field('slug').max_length
+    # Leave room for a numeric suffix
+    bases = [(base or 'item')[:max_length - 8].strip('-') or 'item' for base in bases]
+
+    taken = set(model.objects.filter(slug__in=set(bases)).values_list('slug', flat=True)) | reserved
+    counts = Counter(bases)
+    colliding = {base for base in counts if base in taken or counts[base] > 1}
+
+    next_suffix = {}
+    if colliding:
+        query = Q()
+        for base in colliding:
+            query |= Q(slug__startswith=f'{base}-')
+        taken |= set(model.objects.filter(query).values_list('slug', flat=True))
+        for base in colliding:
+            suffixes = [
+                int(slug[len(base) + 1:]) for slug in taken
+                if slug.startswith(f'{base}-') and slug[len(base) + 1:].isdigit()
+            ]
+            next_suffix[base] = max(suffixes, default=1) + 1
+
+    slugs = []
+    for base in bases:
+        slug = base
+        if slug in taken:
+            slug = f'{base}-{next_suffix[base]}'
+            next_suffix[base] += 1
+        taken.add(slug)
+        reserved.add(slug)
+        slugs.append(slug)
+    return slugs
+
+
+def fields_except(instance, *excluded):
+    """
+    update_fields for a plain save() of an existing row, leaving out
+    `excluded`: columns only ever moved by UPDATEs, which a save of the copy
+    loaded earlier would otherwise undo.
+    """
+    deferred = instance.get_deferred_fields()
+    return [
+        field.attname for field in instance._meta.concrete_fields
+        if not field.primary_key and field.name not in excluded and field.attname not in deferred
+    ]
+
+
+def is_plain_update(instance, kwargs):
+    return not instance._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None
+
+
 # Create your models here.
 class Category(models.Model):
     title = models.CharField(max_length=100)
     slug = models.SlugField(unique=True,null=True, blank=True)
     description = models.TextField(blank=True)
     parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='children')
+    # Materialized path of ids from the root, e.g. "1/4/9/". Maintained by save()
+    path = models.CharField(max_length=255, blank=True, default='', db_index=True, editable=False)
     
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.title)
-        super(Category, self).save(*args, **kwargs)
+        
+        # Paths are settled before super().save() so post_save listeners
+        # (e.g. the category tree cache) never see a half-moved subtree
+        with transaction.atomic():
+            if self.pk:
+                old_path, self.path = self.path, self.build_path()
+                if old_path and old_path != self.path:
+                    # Re-root the whole subtree in one UPDATE
+                    Category.objects.filter(Category.subtree_q(old_path)).exclude(pk=self.pk).update(
+                        path=Concat(Value(self.path), Substr('path', len(old_path) + 1))
+                    )
+            super(Category, self).save(*args, **kwargs)
+            
+            if not self.path:
+                # New rows only get their id on insert
+                self.path = self.build_path()
+                Category.objects.filter(pk=self.pk).update(path=self.path)
+    
+    def build_path(self):
+        parent_path = self.parent.path if self.parent_id else ''
+        return f'{parent_path}{self.pk}/'
+    
+    def in_subtree_of(self, other):
+        return bool(other.path) and self.path.startswith(other.path)
+    
+    @staticmethod
+    def subtree_q(path, prefix=''):
+        """
+        Range lookup matching `path` and everything below it. '0' sorts right
+        after '/', so this is an index range scan rather than a LIKE.
+        """
+        return Q(**{f'{prefix}path__gte': path, f'{prefix}path__lt': path[:-1] + '0'})
     
     class Meta:
         db_table = 'categories'
@@ -30,6 +126,8 @@ class Product(models.Model):
     description = models.TextField(null=True, blank=True)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     stock = models.PositiveIntegerField(default=0)
+    # Units held by unexpired checkout reservations; stock - reserved is what can still be sold
+    reserved = models.PositiveIntegerField(default=0, editable=False)
     categories = models.ManyToManyField(Category, related_name='products')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -37,19 +135,50 @@ class Product(models.Model):
     
     def save(self, *args, **kwargs):
         if not self.slug:
-            self.slug = slugify(self.title)
+            self.slug = allocate_unique_slugs(Product, [slugify(self.title)])[0]
+        if is_plain_update(self, kwargs):
+            # reserved only ever moves through F() updates
+            kwargs['update_fields'] = fields_except(self, 'reserved')
         super(Product, self).save(*args, **kwargs)
     
     class Meta:
         db_table = 'products'
+        indexes = [
+            # Keyset pagination: (ordering field, id) range scans
+            models.Index(fields=['created_at', 'id'], name='products_created_idx'),
+            models.Index(fields=['is_active', 'created_at', 'id'], name='products_active_created_idx'),
+            models.Index(fields=['is_active', 'price', 'id'], name='products_active_price_idx'),
+            models.Index(fields=['is_active', 'stock', 'id'], name='products_active_stock_idx'),
+        ]
+    
+    @property
+    def available_stock(self):
+        return max(self.stock - self.reserved, 0)
     
     def __str__(self):
         return self.title
 
+class ProductSearchDocument(models.Model):
+    """
+    Flattened text of a product used by the full-text index. On SQLite the
+    `product_search` FTS5 table is an external-content index over this table
+    and is kept in sync by triggers (see migration 0008).
+    """
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, related_name='search_document')
+    title = models.CharField(max_length=200)
+    description = models.TextField(blank=True)
+    categories = models.TextField(blank=True)
+
+    class Meta:
+        db_table = 'product_search_documents'
+
 class ProductImage(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='images')
     image = models.ImageField(upload_to='product_images/')
     is_primary = models.BooleanField(default=False)
+    # Filled in by the generate_image_variants task (see products/images.py)
+    content_hash = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    variants = models.JSONField(default=dict, blank=True)
     
     class Meta:
         db_table = 'product_images'
@@ -73,6 +202,18 @@ class CartItem(models.Model):
     class Meta:
         db_table = 'cart_items'
         unique_together = ('cart', 'product')
+
+class StockReservation(models.Model):
+    """Stock held for a user between starting checkout and placing the order."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='stock_reservations')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        db_table = 'stock_reservations'
+        unique_together = ('user', 'product')
         
 #================================================ORDER MODELS======================================================
 
@@ -82,7 +223,11 @@ def generate_tracking_number():
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
 
 class Order(models.Model):
+    is_archived = False
+
     STATUS_CHOICES = (
+        ('queued', 'Queued'),  # async checkout accepted, waiting for a checkout worker
+        ('failed', 'Failed'),  # async checkout rejected, e.g. out of stock
         ('pending', 'Pending'),
         ('processing', 'Processing'),
         ('shipped', 'Shipped'),
@@ -97,14 +242,23 @@ class Order(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     tracking_number = models.CharField(max_length=15, unique=True, blank=True, null=True)
+    # Whether the order and its items are counted in the sales rollups (products.reports)
+    sales_recorded = models.BooleanField(default=False, editable=False)
 
     class Meta:
         db_table = 'orders'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='orders_created_idx'),
+            models.Index(fields=['user', 'created_at', 'id'], name='orders_user_created_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.tracking_number:
             self.tracking_number = generate_tracking_number()
+        if is_plain_update(self, kwargs):
+            # sales_recorded is kept by products.reports with UPDATEs
+            kwargs['update_fields'] = fields_except(self, 'sales_recorded')
         super().save(*args, **kwargs)
 
 class OrderItem(models.Model):
@@ -118,6 +272,122 @@ class OrderItem(models.Model):
         db_table = 'order_items'
         
 
+#===========================================ORDER ARCHIVE==========================================================
+
+# Cold tier: delivered/cancelled orders past ORDER_ARCHIVE_AFTER_DAYS are moved here by products.archive,
+# keeping their ids, so orders/order_items (and their indexes) only hold recent and open orders
+
+class ArchivedOrder(models.Model):
+    is_archived = True
+
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_orders')
+    status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    total_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    shipping_address = models.TextField()
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    tracking_number = models.CharField(max_length=15, unique=True, blank=True, null=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'orders_archive'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='orders_archive_created_idx'),
+            models.Index(fields=['user', 'created_at', 'id'], name='orders_archive_user_idx'),
+        ]
+
+
+class ArchivedOrderItem(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    order = models.ForeignKey(ArchivedOrder, on_delete=models.CASCADE, related_name='items')
+    product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True, related_name='+')
+    product_name = models.CharField(max_length=200)
+    product_price = models.DecimalField(max_digits=10, decimal_places=2)
+    quantity = models.PositiveIntegerField()
+
+    class Meta:
+        db_table = 'order_items_archive'
+
+
+#===========================================SALES RANKING==========================================================
+
+
+class JobCheckpoint(models.Model):
+    """Last position processed by an incremental background job."""
+    name = models.CharField(max_length=100, unique=True)
+    position = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'job_checkpoints'
+
+
+class ProductSalesHourly(models.Model):
+    """Units sold per product per hour, folded in incrementally from new order items."""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    hour = models.DateTimeField()
+    units = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        db_table = 'product_sales_hourly'
+        unique_together = ('product', 'hour')
+        indexes = [models.Index(fields=['hour'], name='sales_hourly_hour_idx')]
+
+
+class ProductSalesRank(models.Model):
+    """Materialized best-seller ranking per sliding window, rebuilt by a periodic task."""
+    WINDOW_CHOICES = (
+        ('24h', 'Last 24 hours'),
+        ('7d', 'Last 7 days'),
+    )
+    
+    window = models.CharField(max_length=5, choices=WINDOW_CHOICES)
+    rank = models.PositiveIntegerField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    units = models.PositiveIntegerField()
+    
+    class Meta:
+        db_table = 'product_sales_ranks'
+        unique_together = ('window', 'rank')
+
+
+#================================================SALES ROLLUPS=====================================================
+
+# Kept up to date as orders are placed and change status, so reports never scan orders/order_items
+
+# Only orders with sales_recorded set are in the sales counters, so taking one back never goes below zero
+
+class DailySales(models.Model):
+    day = models.DateField(unique=True)
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    
+    class Meta:
+        db_table = 'daily_sales'
+
+
+class DailyProductSales(models.Model):
+    day = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    
+    class Meta:
+        db_table = 'daily_product_sales'
+        unique_together = ('day', 'product')
+
+
+class OrderStatusCount(models.Model):
+    status = models.CharField(max_length=20, unique=True)
+    count = models.IntegerField(default=0)
+    
+    class Meta:
+        db_table = 'order_status_counts'
+
+
 #===========================================DISCOUNT AND COUPON====================================================
 
 
@@ -155,6 +425,9 @@ class Coupon(models.Model):
             return False 
 
         if self.first_time_users_only:
+            # Delivered orders move to the archive tier after a while, so both tiers count
             if Order.objects.filter(user=user, status='delivered').exists(): 
                 return False
+            if ArchivedOrder.objects.filter(user=user, status='delivered').exists():
+                return False
         return True
\ No newline at end of file
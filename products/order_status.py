@@ -0,0 +1,108 @@
+from django.db import transaction
+from django.utils import timezone
+from django.utils.datastructures import MultiValueDict
+from .models import Order
+from .exports import filter_orders, ExportError
+from .reports import orders_status_changed
+from .order_updates import queue_order_change, status_change
+
+# Status -> statuses an admin may move it to, one by one or in bulk. queued/failed belong to checkout
+ORDER_TRANSITIONS = {
+    'pending': ('processing', 'cancelled'),
+    'processing': ('shipped', 'cancelled'),
+    'shipped': ('delivered',),
+}
+
+# Orders one bulk request may move, across all of its transitions
+MAX_BULK_ORDERS = 5000
+
+
+class OrderStatusError(ValueError):
+    pass
+
+
+def transition_sources(status):
+    """Statuses an order can be moved to `status` from."""
+    return [source for source, targets in ORDER_TRANSITIONS.items() if status in targets]
+
+
+def parse_transitions(data):
+    """
+    [(status, orders, requested)] from a bulk request body: either one
+    transition ({"status", "ids"} or {"status", "filter"}) or a list of them
+    under "transitions". `requested` is the number of ids asked for, or None
+    for a filter.
+    """
+    transitions = data.get('transitions', [data])
+    if not isinstance(transitions, list) or not transitions:
+        raise OrderStatusError("transitions must be a non-empty list")
+
+    parsed = []
+    for transition in transitions:
+        if not isinstance(transition, dict):
+            raise OrderStatusError("Each transition must be an object")
+        status = transition.get('status')
+        if status not in dict(Order.STATUS_CHOICES):
+            raise OrderStatusError("Invalid status value")
+        if not transition_sources(status):
+            raise OrderStatusError(f"Orders can't be moved to {status} in bulk")
+        if status in (parsed_status for parsed_status, _, _ in parsed):
+            raise OrderStatusError(f"{status} appears in more than one transition")
+
+        ids, order_filter = transition.get('ids'), transition.get('filter')
+        if (ids is None) == (order_filter is None):
+            raise OrderStatusError("Each transition needs either ids or a filter")
+        if ids is not None:
+            if not isinstance(ids, list) or not ids or not all(isinstance(pk, int) for pk in ids):
+                raise OrderStatusError("ids must be a non-empty list of order ids")
+            if len(ids) > MAX_BULK_ORDERS:
+                raise OrderStatusError(f"At most {MAX_BULK_ORDERS} orders can be updated at once")
+            parsed.append((status, Order.objects.filter(pk__in=ids), len(set(ids))))
+            continue
+
+        if not isinstance(order_filter, dict) or not order_filter:
+            raise OrderStatusError("filter must be an object with date_from, date_to and/or status")
+        params = MultiValueDict({
+            key: value if isinstance(value, list) else [value] for key, value in order_filter.items()
+        })
+        try:
+            parsed.append((status, filter_orders(params), None))
+        except ExportError as exc:
+            raise OrderStatusError(str(exc))
+    return parsed
+
+
+def apply_transitions(transitions):
+    """
+    Apply parsed transitions with one UPDATE per target status. Only orders
+    whose current status may move to the target are touched (the others are
+    reported as skipped), an order moved by one transition is left alone by
+    the later ones, nothing is saved or serialized one by one, and the
+    rollups are adjusted in a few aggregate queries. The order_update
+    messages go out after commit from the background publisher, in batches.
+    """
+    now = timezone.now()
+    updated, skipped, moved_ids = {}, 0, []
+    with transaction.atomic():
+        for status, orders, requested in transitions:
+            rows = list(
+                orders.select_for_update()
+                .filter(status__in=transition_sources(status))
+                .exclude(pk__in=moved_ids)
+                .order_by('pk')
+                .values_list('id', 'status', 'sales_recorded')[:MAX_BULK_ORDERS - len(moved_ids) + 1]
+            )
+            if len(moved_ids) + len(rows) > MAX_BULK_ORDERS:
+                raise OrderStatusError(f"At most {MAX_BULK_ORDERS} orders can be updated at once")
+
+            ids = [order_id for order_id, _, _ in rows]
+            if ids:
+                recorded = orders_status_changed(rows, status)
+                Order.objects.filter(pk__in=ids).update(status=status, updated_at=now, sales_recorded=recorded)
+                for order_id, old, _ in rows:
+                    queue_order_change(order_id, status_change(old, status, now))
+            updated[status] = len(ids)
+            if requested is not None:
+                skipped += requested - len(ids)
+            moved_ids.extend(ids)
+    return {'updated': updated, 'skipped': skipped}
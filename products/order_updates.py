@@ -0,0 +1,124 @@
+import asyncio
+import itertools
+import threading
+from functools import partial
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+from django.db import transaction
+from .models import Order
+from .tasks import publish_order_changes
+
+# group_sends in flight at once when fanning out many order updates
+FANOUT_BATCH_SIZE = 200
+
+_local = threading.local()
+
+
+def order_group(order_id):
+    return f'order_{order_id}'
+
+
+def user_orders_group(user_id):
+    return f'user_orders_{user_id}'
+
+
+def order_update_message(data):
+    return {'type': 'order_update', 'data': data}
+
+
+def publish_order_updates(payloads, batch_size=FANOUT_BATCH_SIZE):
+    """
+    Send one order_update per payload to its order's group and to its owner's
+    group (one query looks the owners up), so a ws/orders/ socket sees every
+    order of its user, including ones placed after it connected. The sends go
+    out in batches of `batch_size` awaited together, so the channel layer's
+    round trips overlap instead of running one after another, all from a
+    single event loop. Returns how many updates were sent.
+    """
+    layer = get_channel_layer()
+    payloads = list(payloads)
+    owners = dict(Order.objects.filter(pk__in={data['id'] for data in payloads}).values_list('id', 'user_id')) if payloads else {}
+    sends = [(order_group(data['id']), data) for data in payloads] + [
+        (user_orders_group(owners[data['id']]), data) for data in payloads if data['id'] in owners
+    ]
+
+    async def fan_out():
+        for start in range(0, len(sends), batch_size):
+            await asyncio.gather(*(
+                layer.group_send(group, order_update_message(data))
+                for group, data in sends[start:start + batch_size]
+            ))
+
+    if sends:
+        async_to_sync(fan_out)()
+    return len(payloads)
+
+
+#==================================CHANGE NOTIFICATIONS============================================================
+
+class OrderChangeBatch:
+    """
+    Order changes queued in one atomic block, keyed by order. Each change is
+    its own on_commit callback, so Django drops it if its savepoint (or the
+    transaction) rolls back. Callbacks registered in the same block sit under
+    the same savepoints and so run or are dropped together: the block's last
+    one publishes every change that committed, with several changes to one
+    order collapsed into one message (pending -> processing -> shipped is
+    sent as pending -> shipped).
+    """
+
+    def __init__(self):
+        self.changes = {}
+        self.numbers = itertools.count()
+        self.last = None
+
+    def add(self, order_id, diff):
+        self.last = next(self.numbers)
+        transaction.on_commit(partial(self.commit, self.last, order_id, diff))
+
+    def commit(self, number, order_id, diff):
+        change = self.changes.get(order_id)
+        if change is None:
+            self.changes[order_id] = {'id': order_id, **diff}
+        else:
+            # Keep where the order started from, take everything else from the latest change
+            change.update({key: value for key, value in diff.items() if key != 'previous_status'})
+        if number == self.last:
+            payloads, self.changes = self.payloads(), {}
+            publish_changes(payloads)
+
+    def payloads(self):
+        # A change that was undone in the same transaction isn't a change
+        return [
+            change for change in self.changes.values()
+            if change.get('status') != change.get('previous_status') or 'error' in change
+        ]
+
+
+def publish_changes(payloads):
+    if payloads:
+        publish_order_changes.delay(payloads)
+
+
+def queue_order_change(order_id, diff):
+    """
+    Notify the order's subscribers of `diff` (e.g. {'status', 'previous_status',
+    'updated_at'}) once the current transaction commits, from the background
+    publisher. Outside a transaction it's handed over right away.
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        publish_changes([{'id': order_id, **diff}])
+        return
+
+    # One batch per atomic block, keyed on the savepoints it runs under. Blocks that
+    # have exited take no new changes; their callbacks still run, or were dropped
+    block = tuple(connection.savepoint_ids)
+    _local.batches = {
+        key: batch for key, batch in getattr(_local, 'batches', {}).items() if block[:len(key)] == key
+    }
+    _local.batches.setdefault(block, OrderChangeBatch()).add(order_id, diff)
+
+
+def status_change(old, new, updated_at):
+    return {'status': new, 'previous_status': old, 'updated_at': updated_at.isoformat()}
@@ -0,0 +1,128 @@
+import json
+from django.core.exceptions import ValidationError, FieldDoesNotExist
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, Cursor
+from .search import SEARCH_RANK
+from .archive import OrderTiers
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination keyed on (ordering field, pk).
+
+    DRF's CursorPagination only keys on the ordering field and falls back to
+    OFFSET inside groups of equal values (e.g. many products with the same
+    price). Adding the primary key as a tie-breaker makes every page a single
+    indexed range scan, so deep pages cost the same as the first one.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = '-created_at'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)[:1]
+        self.cursor = self.decode_cursor(request)
+
+        field = self.ordering[0]
+        self.descending = field.startswith('-')
+        self.field_name = field.lstrip('-')
+        reverse = self.cursor is not None and self.cursor.reverse
+
+        results = self.fetch_page(queryset)
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+
+        if reverse:
+            self.page.reverse()
+            self.has_next = True
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = self.cursor is not None
+
+        return self.page
+
+    def walks_down(self):
+        # Walking backwards flips the sort, then the page is flipped back in paginate_queryset()
+        return self.descending != (self.cursor is not None and self.cursor.reverse)
+
+    def fetch_page(self, queryset):
+        """Up to page_size + 1 rows after the cursor, in walking order."""
+        if self.walks_down():
+            queryset = queryset.order_by(f'-{self.field_name}', '-pk')
+        else:
+            queryset = queryset.order_by(self.field_name, 'pk')
+
+        if self.cursor is not None:
+            value, pk = self.cursor.position
+            lookup = 'lt' if self.walks_down() else 'gt'
+            try:
+                queryset = queryset.filter(
+                    Q(**{f'{self.field_name}__{lookup}': value}) |
+                    Q(**{self.field_name: value, f'pk__{lookup}': pk})
+                )
+            except (ValidationError, ValueError, TypeError):
+                raise NotFound(self.invalid_cursor_message)
+
+        return list(queryset[:self.page_size + 1])
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        position = self._get_position_from_instance(self.page[-1], self.ordering)
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        position = self._get_position_from_instance(self.page[0], self.ordering)
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+    def decode_cursor(self, request):
+        cursor = super().decode_cursor(request)
+        if cursor is None:
+            return None
+        try:
+            value, pk = json.loads(cursor.position)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        return Cursor(offset=0, reverse=cursor.reverse, position=(value, pk))
+
+    def _get_position_from_instance(self, instance, ordering):
+        try:
+            value = instance._meta.get_field(self.field_name).value_to_string(instance)
+        except FieldDoesNotExist:
+            # Annotated ordering such as the search rank
+            value = str(getattr(instance, self.field_name))
+        return json.dumps([value, str(instance.pk)])
+
+
+class ProductPagination(KeysetPagination):
+    ordering = '-created_at'
+
+    def get_ordering(self, request, queryset, view):
+        # Search results come back by relevance unless the client picked an ordering
+        if SEARCH_RANK in queryset.query.annotations and not request.query_params.get('ordering'):
+            return (SEARCH_RANK,)
+        return super().get_ordering(request, queryset, view)
+
+
+class OrderPagination(KeysetPagination):
+    # Matches Order.Meta.ordering
+    ordering = '-created_at'
+
+    def fetch_page(self, queryset):
+        if not isinstance(queryset, OrderTiers):
+            return super().fetch_page(queryset)
+        # One page from each tier with the same cursor, merged: order ids are shared, so (created_at, id) stays unique
+        rows = super().fetch_page(queryset.hot) + super().fetch_page(queryset.archived)
+        rows.sort(key=lambda order: (order.created_at, order.pk), reverse=self.walks_down())
+        return rows[:self.page_size + 1]
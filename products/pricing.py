@@ -0,0 +1,47 @@
+from decimal import Decimal
+from django.conf import settings
+from django.core.cache import cache
+from .cache import make_tagged_key, PRICE_TAG
+
+CENT = Decimal('0.01')
+
+
+def quote_from_items(items):
+    """Quote for cart items whose products are already loaded (no queries)."""
+    subtotal = sum((item.quantity * item.product.price for item in items), Decimal('0'))
+    return {'subtotal': subtotal, 'item_count': sum(item.quantity for item in items)}
+
+
+def get_cart_quote(user, backend, cart=None, version=None):
+    """
+    Subtotal and item count of the user's cart, cached per cart version.
+
+    The key moves on whenever the cart changes (backend.version()) or a
+    price may have (PRICE_TAG); stock changes leave it alone, so cart views,
+    coupon validation and checkout all share one computation. Pass `cart`
+    when its items are already loaded to price them without a query, along
+    with the `version` read *before* loading it, so a change made in between
+    is never cached under the newer version.
+    """
+    if version is None:
+        version = backend.version(user)
+    key = make_tagged_key('cart_quote', (PRICE_TAG,), f'{user.id}:{version}')
+    quote = cache.get(key)
+    if quote is None:
+        quote = quote_from_items(cart.items.all()) if cart is not None else backend.subtotal(user)
+        cache.set(key, quote, settings.CACHE_TTL)
+    return quote
+
+
+def coupon_discount(coupon, subtotal):
+    """Discount `coupon` gives on `subtotal`, capped at max_discount_amount."""
+    discount = (subtotal * coupon.discount_percent) / 100
+    if coupon.max_discount_amount:
+        discount = min(discount, coupon.max_discount_amount)
+    return discount.quantize(CENT)
+
+
+def apply_coupon(quote, coupon):
+    """The quote with `coupon` applied; call only once coupon.is_valid() passed."""
+    discount = coupon_discount(coupon, quote['subtotal'])
+    return dict(quote, coupon=coupon.code, discount=discount, total=quote['subtotal'] - discount)
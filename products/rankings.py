@@ -0,0 +1,108 @@
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import Sum, Max, Min
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+from .models import OrderItem, JobCheckpoint, ProductSalesHourly, ProductSalesRank
+from .cache import bump_tags, SALES_RANK_TAG
+
+RANKING_WINDOWS = {
+    '24h': timedelta(hours=24),
+    '7d': timedelta(days=7),
+}
+RANKING_SIZE = 100
+
+# Items of orders younger than this (and every item after them) are left for
+# the next run, so a slow checkout transaction that commits a lower id late is
+# not skipped over
+COMMIT_LAG = timedelta(minutes=1)
+
+CHECKPOINT_NAME = 'sales_hourly'
+
+
+def fold_new_order_items(now=None):
+    """Add order items created since the last run into the hourly buckets."""
+    now = now or timezone.now()
+    JobCheckpoint.objects.get_or_create(name=CHECKPOINT_NAME)
+
+    with transaction.atomic():
+        # Locking the checkpoint keeps two overlapping runs from counting items twice
+        checkpoint = JobCheckpoint.objects.select_for_update().get(name=CHECKPOINT_NAME)
+        new_items = OrderItem.objects.filter(id__gt=checkpoint.position)
+        # Stop short of the first item of a too-recent order: the checkpoint only
+        # moves past ids that were all counted, so later ones are never skipped
+        first_recent = new_items.filter(order__created_at__gt=now - COMMIT_LAG).aggregate(first=Min('id'))['first']
+        if first_recent is not None:
+            new_items = new_items.filter(id__lt=first_recent)
+        last_id = new_items.aggregate(last=Max('id'))['last']
+        if last_id is None:
+            return 0
+
+        rows = (
+            new_items.filter(id__lte=last_id, product__isnull=False)
+            .annotate(hour=TruncHour('order__created_at'))
+            .values('product_id', 'hour')
+            .annotate(units=Sum('quantity'))
+            .order_by()
+        )
+        totals = {(row['product_id'], row['hour']): row['units'] for row in rows}
+
+        existing = ProductSalesHourly.objects.filter(
+            product_id__in={product_id for product_id, _ in totals},
+            hour__in={hour for _, hour in totals},
+        )
+        to_update = []
+        for row in existing:
+            key = (row.product_id, row.hour)
+            if key in totals:
+                row.units += totals.pop(key)
+                to_update.append(row)
+        ProductSalesHourly.objects.bulk_update(to_update, ['units'], batch_size=1000)
+        ProductSalesHourly.objects.bulk_create(
+            [ProductSalesHourly(product_id=product_id, hour=hour, units=units) for (product_id, hour), units in totals.items()],
+            batch_size=1000,
+        )
+
+        checkpoint.position = last_id
+        checkpoint.save(update_fields=['position', 'updated_at'])
+    return len(to_update) + len(totals)
+
+
+def rebuild_rankings(now=None):
+    """Re-rank every window from the hourly buckets (never from raw order items)."""
+    now = now or timezone.now()
+    with transaction.atomic():
+        for window, span in RANKING_WINDOWS.items():
+            best_sellers = (
+                ProductSalesHourly.objects.filter(hour__gte=now - span)
+                .values('product_id')
+                .annotate(units=Sum('units'))
+                .order_by('-units', 'product_id')[:RANKING_SIZE]
+            )
+            ranks = [
+                ProductSalesRank(window=window, rank=position, product_id=row['product_id'], units=row['units'])
+                for position, row in enumerate(best_sellers, start=1)
+            ]
+            ProductSalesRank.objects.filter(window=window).delete()
+            ProductSalesRank.objects.bulk_create(ranks)
+
+        # Buckets older than the widest window can never count again
+        ProductSalesHourly.objects.filter(hour__lt=now - max(RANKING_WINDOWS.values())).delete()
+
+    transaction.on_commit(lambda: bump_tags(SALES_RANK_TAG))
+
+
+def refresh_rankings(now=None):
+    fold_new_order_items(now)
+    rebuild_rankings(now)
+
+
+def ranked_products(window, limit):
+    """Active products in rank order for `window`: one indexed read plus prefetches."""
+    ranks = (
+        ProductSalesRank.objects.filter(window=window, product__is_active=True)
+        .select_related('product')
+        .prefetch_related('product__images', 'product__categories')
+        .order_by('rank')[:limit]
+    )
+    return [rank.product for rank in ranks]
@@ -0,0 +1,291 @@
+from collections import defaultdict
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import F, Sum, Count, Case, When, Value, BooleanField, DecimalField, IntegerField
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from .models import Order, OrderItem, ArchivedOrder, ArchivedOrderItem, DailySales, DailyProductSales, OrderStatusCount
+
+# Orders in these statuses count towards revenue and units sold
+SALES_STATUSES = ('pending', 'processing', 'shipped', 'delivered')
+
+# Top-products reports are capped at this many rows
+MAX_TOP_PRODUCTS = 100
+
+
+def _per_row(key, values, output_field):
+    return Case(
+        *[When(**{key: row_key, 'then': Value(value)}) for row_key, value in values.items()],
+        default=Value(0),
+        output_field=output_field,
+    )
+
+
+def _add_sales(day, orders, units, revenue, product_units, product_revenue):
+    DailySales.objects.bulk_create([DailySales(day=day)], ignore_conflicts=True)
+    DailySales.objects.filter(day=day).update(
+        orders=F('orders') + orders,
+        units=F('units') + units,
+        revenue=F('revenue') + revenue,
+    )
+    if not product_units:
+        return
+
+    DailyProductSales.objects.bulk_create(
+        [DailyProductSales(day=day, product_id=product_id) for product_id in product_units],
+        ignore_conflicts=True,
+    )
+    DailyProductSales.objects.filter(day=day, product_id__in=product_units).update(
+        units=F('units') + _per_row('product_id', product_units, IntegerField()),
+        revenue=F('revenue') + _per_row('product_id', product_revenue, DecimalField(max_digits=14, decimal_places=2)),
+    )
+
+
+def _line_totals(lines, sign=1):
+    """(units, revenue, product_units, product_revenue) of (product_id, units, revenue) lines."""
+    units = defaultdict(int)
+    revenue = defaultdict(Decimal)
+    for product_id, quantity, amount in lines:
+        if product_id is not None:
+            units[product_id] += sign * quantity
+            revenue[product_id] += sign * amount
+    return (
+        sign * sum(quantity for _, quantity, _ in lines),
+        sign * sum((amount for _, _, amount in lines), Decimal('0')),
+        units,
+        revenue,
+    )
+
+
+def record_sales(order, lines, sign=1):
+    """
+    Add (sign=1) or take back (sign=-1) an order's sales in the day's rollups.
+    `lines` are (product_id, units, revenue). Costs four queries however many
+    lines there are: every counter moves with an F() expression, so concurrent
+    checkouts never overwrite each other. Callers keep order.sales_recorded in
+    step, so only sales that were recorded are ever taken back.
+    """
+    _add_sales(timezone.localdate(order.created_at), sign, *_line_totals(lines, sign))
+
+
+def record_orders_sales(order_ids, sign=1):
+    """record_sales() for many orders at once, aggregated in the database: three queries plus four per day."""
+    orders = Order.objects.filter(pk__in=order_ids)
+    items = OrderItem.objects.filter(order__in=orders).annotate(day=TruncDate('order__created_at'))
+    line_revenue = Sum(F('quantity') * F('product_price'))
+    totals = {
+        row['day']: row
+        for row in items.values('day').annotate(units=Sum('quantity'), revenue=line_revenue).order_by()
+    }
+    products = defaultdict(list)
+    for row in items.filter(product__isnull=False).values('day', 'product_id').annotate(
+        units=Sum('quantity'), revenue=line_revenue
+    ).order_by():
+        products[row['day']].append(row)
+
+    for row in orders.annotate(day=TruncDate('created_at')).values('day').annotate(orders=Count('id')).order_by():
+        day = row['day']
+        day_totals = totals.get(day, {})
+        _add_sales(
+            day,
+            sign * row['orders'],
+            sign * (day_totals.get('units') or 0),
+            sign * (day_totals.get('revenue') or Decimal('0')),
+            {line['product_id']: sign * line['units'] for line in products[day]},
+            {line['product_id']: sign * line['revenue'] for line in products[day]},
+        )
+
+
+def order_lines(order_id):
+    return [
+        (product_id, quantity, price * quantity)
+        for product_id, quantity, price in OrderItem.objects.filter(order_id=order_id)
+        .values_list('product_id', 'quantity', 'product_price')
+    ]
+
+
+def move_status_counts(changes):
+    """Apply {status: delta} to the per-status counters in two queries."""
+    changes = {status: delta for status, delta in changes.items() if delta}
+    if not changes:
+        return
+    OrderStatusCount.objects.bulk_create([OrderStatusCount(status=status) for status in changes], ignore_conflicts=True)
+    OrderStatusCount.objects.filter(status__in=changes).update(
+        count=F('count') + _per_row('status', changes, IntegerField())
+    )
+
+
+def count_status_change(old=None, new=None):
+    """Move one order between the per-status counters (old=None for a new order)."""
+    changes = defaultdict(int)
+    if old:
+        changes[old] -= 1
+    if new:
+        changes[new] += 1
+    move_status_counts(changes)
+
+
+def _moves_sales(old, new, recorded):
+    """+1 to record an order's sales, -1 to take them back, 0 to leave them."""
+    if new not in SALES_STATUSES and recorded:
+        # e.g. cancelled: its sales no longer count
+        return -1
+    if new in SALES_STATUSES and old not in SALES_STATUSES and not recorded:
+        # Un-cancelled, a queued order placed, or one created outside checkout
+        return 1
+    return 0
+
+
+def order_status_changed(order, old, new, recorded):
+    """Keep the rollups in step with a status change on an existing order; `recorded` is its sales_recorded before."""
+    count_status_change(old, new)
+    sign = _moves_sales(old, new, recorded)
+    if sign:
+        record_sales(order, order_lines(order.id), sign=sign)
+        order.sales_recorded = sign > 0
+        Order.objects.filter(pk=order.pk).update(sales_recorded=order.sales_recorded)
+
+
+def orders_status_changed(rows, new):
+    """
+    order_status_changed() for a bulk UPDATE: `rows` are the
+    (order_id, old_status, sales_recorded) it moves to `new`. Returns the
+    value for that same UPDATE to set sales_recorded to.
+    """
+    changes = defaultdict(int)
+    moved = defaultdict(list)
+    for order_id, old, recorded in rows:
+        changes[old] -= 1
+        changes[new] += 1
+        sign = _moves_sales(old, new, recorded)
+        if sign:
+            moved[sign].append(order_id)
+    move_status_counts(changes)
+    for sign, order_ids in moved.items():
+        record_orders_sales(order_ids, sign=sign)
+
+    if new not in SALES_STATUSES:
+        return Value(False)
+    if moved[1]:
+        return Case(When(pk__in=moved[1], then=Value(True)), default=F('sales_recorded'))
+    return F('sales_recorded')
+
+
+def orders_deleted(orders):
+    """Take orders that are about to be deleted out of the rollups: their status counts and any recorded sales."""
+    move_status_counts({
+        status: -count for status, count in orders.values_list('status').annotate(count=Count('id')).order_by()
+    })
+    record_orders_sales(list(orders.filter(sales_recorded=True).values_list('id', flat=True)), sign=-1)
+
+
+def order_item_changed(item, old_line=None):
+    """
+    Keep the rollups in step with an order item saved outside checkout (the
+    admin, the ORM): `old_line` is the item's (product_id, units, revenue)
+    before an edit, None for a new item. An order in a sales status starts
+    counting with its first item; other orders are counted once they get
+    one (see order_status_changed()).
+    """
+    order = Order.objects.only('status', 'created_at', 'sales_recorded').get(pk=item.order_id)
+    if order.status not in SALES_STATUSES:
+        return
+    new_line = (item.product_id, item.quantity, item.product_price * item.quantity)
+    if not order.sales_recorded:
+        record_sales(order, order_lines(order.pk))
+        Order.objects.filter(pk=order.pk).update(sales_recorded=True)
+    elif old_line is None:
+        _add_sales(timezone.localdate(order.created_at), 0, *_line_totals([new_line]))
+    else:
+        day = timezone.localdate(order.created_at)
+        _add_sales(day, 0, *_line_totals([old_line], sign=-1))
+        _add_sales(day, 0, *_line_totals([new_line]))
+
+
+def _tier_sales(orders, items, daily, products, statuses):
+    """Add one order tier's (hot or archived) totals to the rebuild's running sums."""
+    for row in (
+        orders.filter(status__in=SALES_STATUSES)
+        .annotate(day=TruncDate('created_at')).values('day').annotate(orders=Count('id')).order_by()
+    ):
+        daily[row['day']]['orders'] += row['orders']
+
+    placed_items = items.filter(order__status__in=SALES_STATUSES).annotate(day=TruncDate('order__created_at'))
+    line_revenue = Sum(F('quantity') * F('product_price'))
+    for row in placed_items.values('day').annotate(units=Sum('quantity'), revenue=line_revenue).order_by():
+        daily[row['day']]['units'] += row['units'] or 0
+        daily[row['day']]['revenue'] += row['revenue'] or 0
+    for row in placed_items.filter(product__isnull=False).values('day', 'product_id').annotate(
+        units=Sum('quantity'), revenue=line_revenue
+    ).order_by().iterator():
+        totals = products[row['day'], row['product_id']]
+        totals['units'] += row['units']
+        totals['revenue'] += row['revenue']
+
+    for row in orders.values('status').annotate(count=Count('id')).order_by():
+        statuses[row['status']] += row['count']
+
+
+@transaction.atomic
+def rebuild_rollups(batch_size=1000):
+    """
+    Recompute every rollup from both order tiers (orders/order_items and
+    their archive tables). Used by the backfill_sales_rollups command.
+    """
+    DailySales.objects.all().delete()
+    DailyProductSales.objects.all().delete()
+    OrderStatusCount.objects.all().delete()
+
+    def new_totals():
+        return {'orders': 0, 'units': 0, 'revenue': Decimal('0')}
+
+    daily, products, statuses = defaultdict(new_totals), defaultdict(new_totals), defaultdict(int)
+    _tier_sales(Order.objects.all(), OrderItem.objects.all(), daily, products, statuses)
+    _tier_sales(ArchivedOrder.objects.all(), ArchivedOrderItem.objects.all(), daily, products, statuses)
+
+    DailySales.objects.bulk_create(
+        [DailySales(day=day, **totals) for day, totals in daily.items()],
+        batch_size=batch_size,
+    )
+    DailyProductSales.objects.bulk_create(
+        (
+            DailyProductSales(day=day, product_id=product_id, units=totals['units'], revenue=totals['revenue'])
+            for (day, product_id), totals in products.items()
+        ),
+        batch_size=batch_size,
+    )
+    OrderStatusCount.objects.bulk_create([
+        OrderStatusCount(status=status, count=count) for status, count in statuses.items()
+    ])
+    Order.objects.update(sales_recorded=Case(
+        When(status__in=SALES_STATUSES, then=Value(True)), default=Value(False), output_field=BooleanField(),
+    ))
+    return len(daily)
+
+
+#==================================REPORT QUERIES==================================================================
+
+def daily_revenue(date_from=None, date_to=None):
+    rows = DailySales.objects.order_by('day')
+    if date_from:
+        rows = rows.filter(day__gte=date_from)
+    if date_to:
+        rows = rows.filter(day__lte=date_to)
+    return list(rows.values('day', 'orders', 'units', 'revenue'))
+
+
+def top_products(date_from=None, date_to=None, limit=10):
+    rows = DailyProductSales.objects.all()
+    if date_from:
+        rows = rows.filter(day__gte=date_from)
+    if date_to:
+        rows = rows.filter(day__lte=date_to)
+    return list(
+        rows.values('product_id', title=F('product__title'))
+        .annotate(units=Sum('units'), revenue=Sum('revenue'))
+        .order_by('-units', 'product_id')[:limit]
+    )
+
+
+def status_counts():
+    return dict(OrderStatusCount.objects.filter(count__gt=0).values_list('status', 'count'))
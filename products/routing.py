@@ -2,5 +2,7 @@ from django.urls import re_path
 from . import consumers
 
 websocket_urlpatterns = [
+    # All of the user's order updates over one socket, with subscribe/unsubscribe
+    re_path(r'ws/orders/$', consumers.OrderUpdatesConsumer.as_asgi()),
     re_path(r'ws/orders/(?P<order_id>[\w-]+)/$', consumers.OrderConsumer.as_asgi()),
-]
\ No newline at end of file
+]
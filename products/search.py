@@ -0,0 +1,121 @@
+import re
+from django.db import connection
+from django.db.models import FloatField
+from django.db.models.expressions import RawSQL
+from rest_framework import filters
+from .models import Product, ProductSearchDocument
+
+SEARCH_RANK = 'search_rank'
+
+# bm25 column weights: title, description, categories
+SEARCH_WEIGHTS = (10.0, 1.0, 4.0)
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def fts_enabled():
+    return connection.vendor == 'sqlite'
+
+
+def build_match_query(terms):
+    """Quote every token so user input can never break FTS5 query syntax."""
+    tokens = [token for term in terms for token in TOKEN_RE.findall(term)]
+    if not tokens:
+        return None
+    # Prefix-match the last token so results show up while the user types
+    return ' '.join(f'"{token}"' for token in tokens[:-1]) + f' "{tokens[-1]}"*'
+
+
+def matching_product_ids(match):
+    """Subquery of the ids of products matching the FTS5 query `match`."""
+    return RawSQL(
+        '''
+        SELECT d.product_id
+        FROM product_search
+        JOIN product_search_documents d ON d.id = product_search.rowid
+        WHERE product_search MATCH %s
+        ''',
+        [match],
+    )
+
+
+def search_rank(match):
+    """bm25 score of each product against `match`; lower is more relevant."""
+    weights = ', '.join(str(weight) for weight in SEARCH_WEIGHTS)
+    return RawSQL(
+        f'''
+        SELECT bm25(product_search, {weights})
+        FROM product_search
+        WHERE product_search MATCH %s
+          AND product_search.rowid = (
+            SELECT d.id FROM product_search_documents d WHERE d.product_id = "{Product._meta.db_table}"."id"
+          )
+        ''',
+        [match],
+        output_field=FloatField(),
+    )
+
+
+#==================================INDEXING========================================================================
+
+def index_products(product_ids):
+    """Rebuild the search documents for the given products in bulk."""
+    products = Product.objects.filter(id__in=product_ids).prefetch_related('categories')
+    existing = dict(
+        ProductSearchDocument.objects.filter(product_id__in=product_ids).values_list('product_id', 'id')
+    )
+    to_create, to_update = [], []
+
+    for product in products:
+        document = ProductSearchDocument(
+            id=existing.get(product.id),
+            product=product,
+            title=product.title,
+            description=product.description or '',
+            categories=' '.join(category.title for category in product.categories.all()),
+        )
+        (to_update if document.id else to_create).append(document)
+
+    ProductSearchDocument.objects.bulk_create(to_create, batch_size=1000)
+    ProductSearchDocument.objects.bulk_update(to_update, ['title', 'description', 'categories'], batch_size=1000)
+
+
+def rebuild_index(chunk_size=2000):
+    """Regenerate every search document. Used by the rebuild_search_index command."""
+    ids = Product.objects.values_list('id', flat=True).order_by('id')
+    batch = []
+    for product_id in ids.iterator(chunk_size=chunk_size):
+        batch.append(product_id)
+        if len(batch) >= chunk_size:
+            index_products(batch)
+            batch = []
+    if batch:
+        index_products(batch)
+
+    if fts_enabled():
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO product_search(product_search) VALUES ('optimize')")
+
+
+#==================================FILTER BACKEND==================================================================
+
+class ProductSearchFilter(filters.SearchFilter):
+    """
+    `?search=` backed by the FTS5 index. The MATCH runs inside the product
+    query, so category/price filters, ordering and pagination apply to every
+    hit, and matches are annotated with their bm25 `search_rank` (lower is
+    more relevant) so the paginator can order by relevance.
+    Databases without FTS5 fall back to DRF's icontains search over `search_fields`.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        if not terms:
+            return queryset
+        if not fts_enabled():
+            return super().filter_queryset(request, queryset, view)
+
+        match = build_match_query(terms)
+        if match is None:
+            return queryset.none()
+        return queryset.filter(pk__in=matching_product_ids(match)).annotate(**{SEARCH_RANK: search_rank(match)})
@@ -1,17 +1,34 @@
 from rest_framework import serializers
 from .models import Category, Product, ProductImage, Cart, CartItem, Coupon
 from users.serializers import UserSerializer
+from django.core.files.storage import default_storage
+from .images import build_srcset
 
 
 class CategorySerializer(serializers.ModelSerializer):
     class Meta:
         model = Category
         fields = ('id', 'title', 'slug', 'description', 'parent')
+    
+    def validate_parent(self, value):
+        if self.instance and value and value.in_subtree_of(self.instance):
+            raise serializers.ValidationError("A category cannot be moved under itself or its descendants.")
+        return value
 
 class ProductImageSerializer(serializers.ModelSerializer):
+    srcset = serializers.SerializerMethodField()
+    
     class Meta:
         model = ProductImage
-        fields = ('id', 'image', 'is_primary')
+        fields = ('id', 'image', 'is_primary', 'srcset')
+    
+    def get_srcset(self, obj):
+        # None until the background pipeline has generated the variants
+        request = self.context.get('request')
+        def build_url(path):
+            url = default_storage.url(path)
+            return request.build_absolute_uri(url) if request else url
+        return build_srcset(obj.variants, build_url)
 
 class ProductSerializer(serializers.ModelSerializer):
     images = ProductImageSerializer(many=True, read_only=True)
@@ -19,10 +36,12 @@ class ProductSerializer(serializers.ModelSerializer):
     category_ids = serializers.PrimaryKeyRelatedField(
         many=True, write_only=True, queryset=Category.objects.all(), source='categories'
     )
+    # Stock not held by checkout reservations, read straight off the row
+    available_stock = serializers.ReadOnlyField()
     
     class Meta:
         model = Product
-        fields = ('id', 'title', 'slug', 'description', 'price', 'stock', 
+        fields = ('id', 'title', 'slug', 'description', 'price', 'stock', 'available_stock',
                   'categories', 'category_ids', 'images', 'created_at', 
                   'updated_at', 'is_active')
         
@@ -50,6 +69,9 @@ class CartSerializer(serializers.ModelSerializer):
         fields = ('id', 'items', 'total', 'created_at', 'updated_at','user')
     
     def get_total(self, obj):
+        # CartViewSet passes the shared quote so the total isn't summed twice
+        if 'quote' in self.context:
+            return self.context['quote']['subtotal']
         return sum(item.quantity * item.product.price for item in obj.items.all())
     
     
@@ -66,11 +88,13 @@ class OrderItemSerializer(serializers.ModelSerializer):
 
 class OrderSerializer(serializers.ModelSerializer):
     items = OrderItemSerializer(many=True, read_only=True)
+    # Also serializes ArchivedOrder, which has the same fields; archived orders are read-only
+    archived = serializers.BooleanField(source='is_archived', read_only=True)
     
     class Meta:
         model = Order
         fields = ('id', 'user', 'status', 'total_amount', 'shipping_address', 
-                  'created_at', 'updated_at', 'tracking_number', 'items')
+                  'created_at', 'updated_at', 'tracking_number', 'items', 'archived')
         
 #=========================================DISCOUNT & COUPON========================================================
 
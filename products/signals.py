@@ -1,20 +1,185 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
-import json
-from .models import Order
-from .serializers import OrderSerializer
+from django.db import transaction
+from .models import Order, OrderItem, Product, Category, ProductImage, Coupon
+from .cache import bump_tags, PRODUCT_TAG, PRICE_TAG, CATEGORY_TAG, PRODUCT_IMAGE_TAG, COUPON_TAG
+from .search import index_products
+from .detail_cache import refresh_product_detail, forget_product_details
+from .tasks import generate_image_variants
+from .reports import count_status_change, order_status_changed, order_item_changed
+from .order_updates import queue_order_change, status_change
+
+#=================================CATALOG CACHE INVALIDATION=======================================================
+
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_product_cache(sender, instance, **kwargs):
+    bump_tags(PRODUCT_TAG)
+
+@receiver(post_save, sender=Product)
+def invalidate_price_cache(sender, instance, created, **kwargs):
+    # Cart quotes only depend on prices, and a new product can't be in a cart yet
+    if not created and getattr(instance, '_old_price', None) != instance.price:
+        bump_tags(PRICE_TAG)
+
+@receiver(post_delete, sender=Product)
+def invalidate_deleted_product_price(sender, instance, **kwargs):
+    # Its cart lines went with it
+    bump_tags(PRICE_TAG)
+
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_category_cache(sender, instance, **kwargs):
+    bump_tags(CATEGORY_TAG)
+
+@receiver([post_save, post_delete], sender=ProductImage)
+def invalidate_product_image_cache(sender, instance, **kwargs):
+    bump_tags(PRODUCT_IMAGE_TAG)
+
+@receiver([post_save, post_delete], sender=Coupon)
+def invalidate_coupon_cache(sender, instance, **kwargs):
+    bump_tags(COUPON_TAG)
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def invalidate_product_categories_cache(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_tags(PRODUCT_TAG)
+
+
+#=================================SEARCH INDEX=====================================================================
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    index_products([instance.id])
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def index_product_categories(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear', 'post_clear'):
+        return
+    if not reverse:
+        if action != 'pre_clear':
+            index_products([instance.id])
+        return
+
+    # category.products.add()/remove()/clear(): reindex the affected products
+    if action == 'pre_clear':
+        instance._search_product_ids = list(instance.products.values_list('id', flat=True))
+    elif action == 'post_clear':
+        index_products(getattr(instance, '_search_product_ids', []))
+    else:
+        index_products(pk_set)
+
+@receiver(post_save, sender=Category)
+def index_category_products(sender, instance, created, **kwargs):
+    if not created:
+        index_products(list(instance.products.values_list('id', flat=True)))
+
+@receiver(pre_delete, sender=Category)
+def collect_category_products(sender, instance, **kwargs):
+    instance._search_product_ids = list(instance.products.values_list('id', flat=True))
+
+@receiver(post_delete, sender=Category)
+def index_deleted_category_products(sender, instance, **kwargs):
+    index_products(getattr(instance, '_search_product_ids', []))
+
+
+#=================================PRODUCT DETAIL WRITE-THROUGH=====================================================
+
+@receiver(pre_save, sender=Product)
+def remember_product_slug(sender, instance, **kwargs):
+    if not instance._state.adding:
+        instance._old_slug, instance._old_price = (
+            Product.objects.filter(pk=instance.pk).values_list('slug', 'price').first() or (None, None)
+        )
+
+@receiver(post_save, sender=Product)
+def write_through_product(sender, instance, **kwargs):
+    old_slug = getattr(instance, '_old_slug', None)
+    if old_slug and old_slug != instance.slug:
+        transaction.on_commit(lambda: forget_product_details([old_slug]))
+    transaction.on_commit(lambda: refresh_product_detail(instance.pk))
+
+@receiver(post_delete, sender=Product)
+def forget_deleted_product(sender, instance, **kwargs):
+    transaction.on_commit(lambda: forget_product_details([instance.slug]))
+
+@receiver(post_save, sender=ProductImage)
+def queue_image_variants(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(lambda: generate_image_variants.delay(instance.pk))
+
+@receiver([post_save, post_delete], sender=ProductImage)
+def write_through_product_image(sender, instance, **kwargs):
+    product_id = instance.product_id
+    transaction.on_commit(lambda: refresh_product_detail(product_id))
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def write_through_product_categories(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        instance._detail_slugs = list(instance.products.values_list('slug', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        transaction.on_commit(lambda: refresh_product_detail(instance.pk))
+    elif action == 'post_clear':
+        slugs = getattr(instance, '_detail_slugs', [])
+        transaction.on_commit(lambda: forget_product_details(slugs))
+    else:
+        slugs = list(Product.objects.filter(pk__in=pk_set).values_list('slug', flat=True))
+        transaction.on_commit(lambda: forget_product_details(slugs))
+
+@receiver(post_save, sender=Category)
+def forget_category_product_details(sender, instance, created, **kwargs):
+    # Category titles are embedded in product payloads
+    if not created:
+        slugs = list(instance.products.values_list('slug', flat=True))
+        transaction.on_commit(lambda: forget_product_details(slugs))
+
+@receiver(pre_delete, sender=Category)
+def collect_category_product_slugs(sender, instance, **kwargs):
+    instance._detail_slugs = list(instance.products.values_list('slug', flat=True))
+
+@receiver(post_delete, sender=Category)
+def forget_deleted_category_product_details(sender, instance, **kwargs):
+    slugs = getattr(instance, '_detail_slugs', [])
+    transaction.on_commit(lambda: forget_product_details(slugs))
+
+
+#=================================SALES ROLLUPS====================================================================
+
+@receiver(pre_save, sender=Order)
+def remember_order_status(sender, instance, **kwargs):
+    if not instance._state.adding:
+        instance._old_status, instance._old_sales_recorded = (
+            Order.objects.filter(pk=instance.pk).values_list('status', 'sales_recorded').first() or (None, False)
+        )
 
 @receiver(post_save, sender=Order)
-def order_status_update(sender, instance, **kwargs):
-    channel_layer = get_channel_layer()
-    serializer = OrderSerializer(instance)
-    
-    async_to_sync(channel_layer.group_send)(
-        f'order_{instance.id}',
-        {
-            'type': 'order_update',
-            'data': serializer.data
-        }
-    )
\ No newline at end of file
+def roll_up_order_status(sender, instance, created, **kwargs):
+    # Sales themselves are recorded once the order's items exist
+    if created:
+        count_status_change(new=instance.status)
+        return
+    old_status = getattr(instance, '_old_status', None)
+    if old_status and old_status != instance.status:
+        order_status_changed(instance, old_status, instance.status, instance._old_sales_recorded)
+
+@receiver(pre_save, sender=OrderItem)
+def remember_order_item_line(sender, instance, **kwargs):
+    if not instance._state.adding:
+        old = OrderItem.objects.filter(pk=instance.pk).values_list('product_id', 'quantity', 'product_price').first()
+        instance._old_line = (old[0], old[1], old[2] * old[1]) if old else None
+
+@receiver(post_save, sender=OrderItem)
+def roll_up_order_item(sender, instance, created, **kwargs):
+    # Checkout bulk-creates its items and records them itself; this covers the admin and the ORM
+    order_item_changed(instance, None if created else getattr(instance, '_old_line', None))
+
+
+#=================================ORDER UPDATES====================================================================
+
+@receiver(post_save, sender=Order)
+def notify_order_status_change(sender, instance, created, **kwargs):
+    # Only real status changes are pushed, as a small diff, once the save commits
+    old_status = getattr(instance, '_old_status', None)
+    if not created and old_status and old_status != instance.status:
+        queue_order_change(instance.id, status_change(old_status, instance.status, instance.updated_at))
+
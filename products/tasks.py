@@ -30,4 +30,76 @@ def send_order_confirmation_email(order_id, recipient_email):
         return f"Order {order_id} not found"
     except Exception as e:
         return f"Failed to send email: {str(e)}"
-    
+
+
+@shared_task
+def generate_image_variants(image_id):
+    from .images import process_product_image
+    from .cache import bump_tags, PRODUCT_IMAGE_TAG
+    from .detail_cache import refresh_product_detail
+
+    image = process_product_image(image_id)
+    if image is None:
+        return f"Image {image_id} could not be processed"
+
+    # The pipeline writes with update(), so refresh what the signals would have
+    bump_tags(PRODUCT_IMAGE_TAG)
+    refresh_product_detail(image.product_id)
+    return f"Generated {len(image.variants)} sizes for image {image_id}"
+
+
+@shared_task
+def refresh_sales_rankings():
+    from .rankings import refresh_rankings
+
+    refresh_rankings()
+    return "Sales rankings refreshed"
+
+
+@shared_task
+def flush_dirty_carts():
+    from .carts import get_cart_backend
+
+    flushed = get_cart_backend().flush_dirty()
+    return f"Flushed {flushed} carts"
+
+
+@shared_task
+def release_expired_reservations():
+    from .checkout import release_expired_reservations as sweep
+
+    released = sweep()
+    return f"Released {released} expired stock reservations"
+
+
+@shared_task(bind=True, acks_late=True, max_retries=5)
+def process_queued_order(self, order_id):
+    from .checkout import complete_queued_order, fail_queued_order
+
+    try:
+        order = complete_queued_order(order_id)
+    except Exception as exc:
+        # e.g. a locked or unreachable database: back off 1, 2, 4, 8, 16s, then give up
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=exc, countdown=2 ** self.request.retries)
+        fail_queued_order(order_id, "Checkout could not be completed, please try again")
+        return f"Order {order_id} failed: {exc}"
+    if order is None or order.status != 'pending':
+        return f"Order {order_id} was not placed"
+    return f"Order {order_id} placed"
+
+
+@shared_task
+def publish_order_changes(changes):
+    from .order_updates import publish_order_updates
+
+    sent = publish_order_updates(changes)
+    return f"Sent {sent} order updates"
+
+
+@shared_task
+def archive_old_orders():
+    from .archive import archive_orders
+
+    archived = archive_orders()
+    return f"Archived {archived} orders"
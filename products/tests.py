@@ -1,7 +1,57 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, transaction, OperationalError
 from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
 from django.urls import reverse
-from .models import Product
+from django.utils import timezone
+from rest_framework.test import APIClient
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from PIL import Image as PILImage
+from users.models import User
+from .cache import get_or_compute, get_tag_versions, PRODUCT_TAG, PRODUCT_LIST_TAGS
+from .detail_cache import product_detail_key
+from .tasks import generate_image_variants
+from .rankings import refresh_rankings
+from .carts import RedisCartBackend
+from .models import (
+    Product, Category, ProductImage, Cart, CartItem, Order, OrderItem, Coupon, ProductSalesRank, StockReservation,
+    DailySales, DailyProductSales, OrderStatusCount, ArchivedOrder, ArchivedOrderItem,
+)
+from . import checkout
+from .checkout import release_expired_reservations
+from .archive import archive_orders
+from .reports import orders_deleted
+from .consumers import OrderConsumer, OrderUpdatesConsumer, order_owner_key
+from .order_updates import publish_order_updates, OrderChangeBatch, status_change
+from ecommerce_backend.celery import app as celery_app
+
+
+class EagerTasksMixin:
+    """Run .delay()ed Celery tasks in-process, as a worker would, whatever the settings say."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.addClassCleanup(setattr, celery_app.conf, "task_always_eager", celery_app.conf.task_always_eager)
+        celery_app.conf.task_always_eager = True
+
 
 class RedisCacheTest(TestCase):
     def setUp(self):
@@ -17,9 +67,1671 @@ class RedisCacheTest(TestCase):
         self.assertEqual(response.status_code, 200)
         
         # Check if product is now cached
-        cached_data = cache.get(f"product_{self.product.id}")
+        cached_data = cache.get(product_detail_key(self.product.slug))
         self.assertIsNotNone(cached_data)  # Ensure cache is populated
         
-        # Second access: should hit the cache
+        # Second access: should hit the cache without touching the database
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse("products-detail", args=[self.product.slug]))
+        self.assertEqual(response.status_code, 200)
+
+    def test_write_through_on_save(self):
+        self.client.get(reverse("products-detail", args=[self.product.slug]))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = 12.50
+            self.product.save()
+
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse("products-detail", args=[self.product.slug]))
+        self.assertEqual(response.data["price"], "12.50")
+
+    def test_image_upload_refreshes_detail(self):
+        self.client.get(reverse("products-detail", args=[self.product.slug]))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ProductImage.objects.create(product=self.product, image="product_images/image.jpg")
+
         response = self.client.get(reverse("products-detail", args=[self.product.slug]))
+        self.assertTrue(response.data["images"][0]["image"].startswith("http://testserver/media/"))
+
+    def test_slug_change_and_delete(self):
+        old_slug = self.product.slug
+        self.client.get(reverse("products-detail", args=[old_slug]))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.slug = "new-slug"
+            self.product.save()
+        self.assertEqual(self.client.get(reverse("products-detail", args=[old_slug])).status_code, 404)
+        self.assertEqual(self.client.get(reverse("products-detail", args=["new-slug"])).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.delete()
+        self.assertEqual(self.client.get(reverse("products-detail", args=["new-slug"])).status_code, 404)
+
+    def test_missing_slug_is_negatively_cached(self):
+        self.assertEqual(self.client.get(reverse("products-detail", args=["nope"])).status_code, 404)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(reverse("products-detail", args=["nope"])).status_code, 404)
+
+
+class StampedeProtectionTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_single_flight_serves_stale_value_while_locked(self):
+        calls = []
+        compute = lambda: calls.append(1) or len(calls)
+
+        self.assertEqual(get_or_compute("stampede", compute, ttl=60), 1)
+        # Force the entry past its logical expiry with another worker holding the lock
+        cache.set("stampede", (1, 0.0, time.time() - 1), 60)
+        cache.add("stampede_lock", 1, 10)
+        self.assertEqual(get_or_compute("stampede", compute, ttl=60), 1)
+        self.assertEqual(len(calls), 1)
+
+        cache.delete("stampede_lock")
+        self.assertEqual(get_or_compute("stampede", compute, ttl=60), 2)
+
+
+class ProductListCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(title="Laptops")
+        self.product = Product.objects.create(title="Test Laptop", price=10.00)
+        self.product.categories.add(self.category)
+
+    def test_warm_list_runs_no_queries(self):
+        url = reverse("products-list")
+        response = self.client.get(url, {"ordering": "price", "is_active": "true"})
+        self.assertEqual(response.status_code, 200)
+
+        # Same parameters in a different order should hit the same cache entry
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {"is_active": "true", "ordering": "price"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["results"]), 1)
+
+    def test_list_invalidated_on_product_save(self):
+        url = reverse("products-list")
+        self.client.get(url)
+
+        self.product.title = "Renamed Laptop"
+        self.product.save()
+
+        response = self.client.get(url)
+        self.assertEqual(response.data["results"][0]["title"], "Renamed Laptop")
+
+    def test_list_invalidated_on_category_change(self):
+        url = reverse("products-list")
+        self.client.get(url)
+
+        self.category.title = "Notebooks"
+        self.category.save()
+
+        response = self.client.get(url)
+        self.assertEqual(response.data["results"][0]["categories"][0]["title"], "Notebooks")
+
+
+
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        # Lots of ties on price so the pk tie-breaker has to do its job
+        for i in range(25):
+            Product.objects.create(title=f"Pan {i}", price=[10, 20, 30][i % 3], stock=i)
+
+    def walk(self, url, params):
+        # Fresh cache per walk keeps us under the anonymous throttle
+        cache.clear()
+        seen = []
+        response = self.client.get(url, params)
+        while True:
+            seen.extend(item["id"] for item in response.data["results"])
+            if not response.data["next"]:
+                return seen, response
+            response = self.client.get(response.data["next"])
+
+    def test_pages_cover_every_product_once(self):
+        for ordering in ("price", "-price", "created_at", "-stock"):
+            seen, _ = self.walk(reverse("products-list"), {"ordering": ordering, "page_size": 4})
+            self.assertEqual(len(seen), 25)
+            self.assertEqual(len(set(seen)), 25)
+
+    def test_previous_link_returns_previous_page(self):
+        url = reverse("products-list")
+        first = self.client.get(url, {"ordering": "price", "page_size": 5})
+        second = self.client.get(first.data["next"])
+        back = self.client.get(second.data["previous"])
+        self.assertEqual(
+            [item["id"] for item in back.data["results"]],
+            [item["id"] for item in first.data["results"]],
+        )
+
+    def test_no_count_query(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse("products-list"), {"page_size": 5})
+        self.assertFalse(any("COUNT(" in query["sql"] for query in ctx.captured_queries))
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse("products-list"), {"cursor": "bm9wZQ=="})
+        self.assertEqual(response.status_code, 404)
+
+
+class QueryBudgetTest(TestCase):
+    """Responses must cost the same number of queries whether they hold 1 row or 30."""
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username="buyer", password="pass", role="customer")
+        self.admin = User.objects.create_user(username="boss", password="pass", role="admin")
+        self.category = Category.objects.create(title="Kitchen")
+
+    def create_products(self, count):
+        products = []
+        for i in range(count):
+            product = Product.objects.create(title=f"Product {Product.objects.count()}", price=5, stock=100)
+            product.categories.add(self.category)
+            ProductImage.objects.create(product=product, image="product_images/image.jpg")
+            products.append(product)
+        return products
+
+    def create_order(self, user, products):
+        order = Order.objects.create(user=user, total_amount=10, shipping_address="Somewhere")
+        for product in products:
+            OrderItem.objects.create(order=order, product=product, product_name=product.title,
+                                     product_price=product.price, quantity=1)
+        return order
+
+    def count_queries(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def assertConstantQueries(self, url, grow, budget):
+        small = self.count_queries(url)
+        grow()
+        large = self.count_queries(url)
+        self.assertEqual(small, large)
+        self.assertLessEqual(large, budget)
+
+    def test_product_list_budget(self):
+        self.create_products(1)
+        self.assertConstantQueries(reverse("products-list"), lambda: self.create_products(30), budget=3)
+
+    def test_featured_budget(self):
+        self.create_products(1)
+        # Empty sales ranking read + newest-products fallback
+        self.assertConstantQueries(reverse("products-featured"), lambda: self.create_products(10), budget=4)
+
+    def test_cart_budget(self):
+        self.client.force_authenticate(self.user)
+        cart = Cart.objects.create(user=self.user)
+
+        def fill_cart():
+            for product in self.create_products(30):
+                CartItem.objects.create(cart=cart, product=product, quantity=2)
+
+        CartItem.objects.create(cart=cart, product=self.create_products(1)[0])
+        self.assertConstantQueries(reverse("cart-list"), fill_cart, budget=6)
+
+    def test_order_list_budget(self):
+        self.client.force_authenticate(self.admin)
+        self.create_order(self.user, self.create_products(1))
+
+        def more_orders():
+            products = self.create_products(5)
+            for _ in range(10):
+                self.create_order(self.user, products)
+
+        self.assertConstantQueries(reverse("order-list"), more_orders, budget=3)
+
+
+class ProductSearchTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.kitchen = Category.objects.create(title="Kitchen")
+        self.cooker = Product.objects.create(title="Pressure Cooker", description="Steel, 5 litre", price=2000)
+        self.cooker.categories.add(self.kitchen)
+        self.pan = Product.objects.create(title="Frying Pan", description="Pairs well with any pressure cooker", price=500)
+        self.lamp = Product.objects.create(title="Desk Lamp", description="LED", price=800)
+
+    def search(self, term):
+        cache.clear()
+        response = self.client.get(reverse("products-list"), {"search": term})
+        self.assertEqual(response.status_code, 200)
+        return [item["title"] for item in response.data["results"]]
+
+    def test_title_match_ranks_first(self):
+        self.assertEqual(self.search("pressure cooker"), ["Pressure Cooker", "Frying Pan"])
+
+    def test_category_titles_are_searchable(self):
+        self.assertEqual(self.search("kitchen"), ["Pressure Cooker"])
+
+    def test_index_follows_updates(self):
+        self.lamp.title = "Reading Lamp"
+        self.lamp.save()
+        self.kitchen.title = "Cookware"
+        self.kitchen.save()
+
+        self.assertEqual(self.search("reading"), ["Reading Lamp"])
+        self.assertEqual(self.search("cookware"), ["Pressure Cooker"])
+        self.assertEqual(self.search("kitchen"), [])
+
+    def test_prefix_and_syntax_safe(self):
+        self.assertEqual(self.search("lam"), ["Desk Lamp"])
+        self.assertEqual(self.search('"unbalanced AND ('), [])
+
+    def test_deleted_product_leaves_index(self):
+        self.lamp.delete()
+        self.assertEqual(self.search("lamp"), [])
+
+    def test_filters_and_pages_cover_every_match(self):
+        pots = [Product.objects.create(title=f"Pot {i}", description="pressure cooker lid", price=100 + i) for i in range(5)]
+        cache.clear()
+        response = self.client.get(reverse("products-list"), {"search": "cooker", "max_price": 500, "ordering": "price"})
+        self.assertEqual([item["title"] for item in response.data["results"]], [pot.title for pot in pots] + ["Frying Pan"])
+
+        titles, params = [], {"search": "cooker", "page_size": 2}
+        while True:
+            response = self.client.get(reverse("products-list"), params)
+            titles += [item["title"] for item in response.data["results"]]
+            if not response.data["next"]:
+                break
+            params = dict(params, cursor=parse_qs(urlparse(response.data["next"]).query)["cursor"][0])
+        self.assertEqual(titles[0], "Pressure Cooker")
+        self.assertCountEqual(titles, ["Pressure Cooker", "Frying Pan"] + [pot.title for pot in pots])
+
+    def test_rebuild_command(self):
+        from .models import ProductSearchDocument
+        ProductSearchDocument.objects.all().delete()
+        call_command("rebuild_search_index", stdout=open(os.devnull, "w"))
+        self.assertEqual(self.search("cooker"), ["Pressure Cooker", "Frying Pan"])
+
+
+class CategoryTreeTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.electronics = Category.objects.create(title="Electronics")
+        self.computers = Category.objects.create(title="Computers", parent=self.electronics)
+        self.laptops = Category.objects.create(title="Laptops", parent=self.computers)
+        self.garden = Category.objects.create(title="Garden")
+
+        self.laptop = Product.objects.create(title="Laptop", price=900)
+        self.laptop.categories.add(self.laptops)
+        self.radio = Product.objects.create(title="Radio", price=40)
+        self.radio.categories.add(self.electronics)
+        self.hose = Product.objects.create(title="Hose", price=15)
+        self.hose.categories.add(self.garden)
+
+    def subtree_titles(self, slug):
+        cache.clear()
+        response = self.client.get(reverse("products-list"), {"category_tree": slug, "ordering": "price"})
+        return [item["title"] for item in response.data["results"]]
+
+    def test_paths(self):
+        self.laptops.refresh_from_db()
+        self.assertEqual(self.laptops.path, f"{self.electronics.pk}/{self.computers.pk}/{self.laptops.pk}/")
+
+    def test_subtree_filter(self):
+        self.assertEqual(self.subtree_titles("electronics"), ["Radio", "Laptop"])
+        self.assertEqual(self.subtree_titles("computers"), ["Laptop"])
+        self.assertEqual(self.subtree_titles("missing"), [])
+
+    def test_moving_a_category_moves_its_subtree(self):
+        self.computers.parent = self.garden
+        self.computers.save()
+
+        self.laptops.refresh_from_db()
+        self.assertTrue(self.laptops.path.startswith(self.garden.path))
+        self.assertEqual(self.subtree_titles("garden"), ["Hose", "Laptop"])
+        self.assertEqual(self.subtree_titles("electronics"), ["Radio"])
+
+    def test_subtree_filter_is_one_query_when_tree_cached(self):
+        self.client.get(reverse("category-tree"))
+        with self.assertNumQueries(3):  # products page + images + categories prefetch
+            self.client.get(reverse("products-list"), {"category_tree": "electronics"})
+
+    def test_tree_endpoint(self):
+        response = self.client.get(reverse("category-tree"))
+        electronics = next(node for node in response.data if node["slug"] == "electronics")
+        self.assertEqual(electronics["children"][0]["slug"], "computers")
+        self.assertEqual(electronics["children"][0]["children"][0]["slug"], "laptops")
+
+        with self.assertNumQueries(0):
+            self.client.get(reverse("category-tree"))
+
+    def test_cannot_move_under_descendant(self):
+        from .serializers import CategorySerializer
+        serializer = CategorySerializer(self.electronics, data={"title": "Electronics", "parent": self.laptops.pk}, partial=True)
+        self.assertFalse(serializer.is_valid())
+
+
+class ProductFacetsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.phones = Category.objects.create(title="Phones")
+        self.tablets = Category.objects.create(title="Tablets")
+        self.garden = Category.objects.create(title="Garden")
+        for title, price, stock, categories in [
+            ("Phone A", 300, 5, [self.phones]),
+            ("Phone B", 700, 0, [self.phones]),
+            ("Phablet", 800, 2, [self.phones, self.tablets]),
+            ("Tablet", 12000, 1, [self.tablets]),
+            ("Rake", 20, 9, [self.garden]),
+        ]:
+            product = Product.objects.create(title=title, price=price, stock=stock)
+            product.categories.set(categories)
+
+    def get_facets(self, params):
+        response = self.client.get(reverse("products-list"), {"facets": "true", **params})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_facets_for_multiple_categories_and_price_range(self):
+        data = self.get_facets({"categories": [self.phones.pk, self.tablets.pk], "max_price": 1000})
+        facets = data["facets"]
+
+        self.assertEqual(len(data["results"]), 3)
+        self.assertEqual(facets["total"], 3)
+        self.assertEqual(facets["in_stock"], 2)
+        self.assertEqual(facets["out_of_stock"], 1)
+        self.assertEqual({row["slug"]: row["count"] for row in facets["categories"]}, {"phones": 3, "tablets": 1})
+        self.assertEqual([bucket["count"] for bucket in facets["price"]][:3], [1, 2, 0])
+
+    def test_in_stock_filter(self):
+        data = self.get_facets({"in_stock": "true", "categories": [self.phones.pk]})
+        self.assertEqual(sorted(item["title"] for item in data["results"]), ["Phablet", "Phone A"])
+
+    def test_reserved_units_are_not_in_stock(self):
+        Product.objects.filter(title="Phone A").update(reserved=5)
+        data = self.get_facets({"in_stock": "true", "categories": [self.phones.pk]})
+        self.assertEqual([item["title"] for item in data["results"]], ["Phablet"])
+        self.assertEqual(data["facets"]["in_stock"], 1)
+        data = self.get_facets({"in_stock": "false", "categories": [self.phones.pk]})
+        self.assertEqual(sorted(item["title"] for item in data["results"]), ["Phone A", "Phone B"])
+
+    def test_facets_cached_across_pages(self):
+        first = self.get_facets({"page_size": 2, "ordering": "price"})
+        # The next page reuses the cached facets instead of re-aggregating
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(first["next"])
+        self.assertEqual(response.data["facets"], first["facets"])
+        self.assertFalse(any("COUNT(" in query["sql"] for query in ctx.captured_queries))
+
+
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(title="Kettle", price=30)
+
+    def assertNotModified(self, url, **headers):
+        with self.assertNumQueries(0):
+            response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+    def test_product_list_etag(self):
+        url = reverse("products-list")
+        response = self.client.get(url)
+        etag = response["ETag"]
+        self.assertIn("Last-Modified", response)
+
+        self.assertNotModified(url, if_none_match=etag)
+
+        self.product.price = 35
+        self.product.save()
+        response = self.client.get(url, headers={"if-none-match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_product_detail_etag(self):
+        url = reverse("products-detail", args=[self.product.slug])
+        response = self.client.get(url)
+        self.assertNotModified(url, if_none_match=response["ETag"])
+        self.assertNotModified(url, if_modified_since=response["Last-Modified"])
+
+    def test_categories_and_coupons(self):
+        Category.objects.create(title="Kitchen")
+        for name in ("category-list", "category-tree", "coupon-list"):
+            response = self.client.get(reverse(name))
+            self.assertEqual(response.status_code, 200)
+            self.assertNotModified(reverse(name), if_none_match=response["ETag"])
+
+        # A new coupon changes the coupon list representation
+        etag = self.client.get(reverse("coupon-list"))["ETag"]
+        Coupon.objects.create(code="NEW10", discount_percent=10, valid_from=timezone.now(), valid_to=timezone.now())
+        self.assertNotEqual(self.client.get(reverse("coupon-list"))["ETag"], etag)
+
+
+class CatalogImportTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.existing = Product.objects.create(title="Kettle", slug="kettle", price=30, stock=1)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def write_feed(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "w") as feed:
+            feed.write(content)
+        return path
+
+    def test_ndjson_upsert(self):
+        feed = "\n".join([
+            '{"slug": "kettle", "price": "25.00", "stock": 7, "categories": ["Kitchen"]}',
+            '{"title": "Toaster", "price": 40, "stock": 3, "categories": ["Kitchen", "Breakfast"]}',
+            '{"title": "Kettle", "price": 45}',
+            '{"title": "Broken", "price": "cheap"}',
+            'not json',
+        ])
+        out = io.StringIO()
+        call_command("import_catalog", self.write_feed("feed.ndjson", feed), "--batch-size", "2", stdout=out, stderr=io.StringIO())
+
+        self.existing.refresh_from_db()
+        self.assertEqual(str(self.existing.price), "25.00")
+        self.assertEqual(self.existing.stock, 7)
+        self.assertEqual([c.title for c in self.existing.categories.all()], ["Kitchen"])
+
+        toaster = Product.objects.get(title="Toaster")
+        self.assertEqual(sorted(c.slug for c in toaster.categories.all()), ["breakfast", "kitchen"])
+        # A second "Kettle" without a slug is a new product with its own slug
+        self.assertEqual(Product.objects.get(title="Kettle", price=45).slug, "kettle-2")
+        self.assertIn("processed=5 created=2 updated=1 failed=2", out.getvalue())
+
+    def test_update_writes_only_supplied_fields(self):
+        from .importer import CatalogImporter
+        Product.objects.create(title="Toaster", slug="toaster", price=40, stock=5)
+        rows = enumerate([{"slug": "kettle", "price": "20"}, {"slug": "toaster", "price": "35", "stock": 9}], start=1)
+        with CaptureQueriesContext(connection) as ctx:
+            list(CatalogImporter().run(rows))
+
+        updates = [query["sql"] for query in ctx.captured_queries if query["sql"].startswith('UPDATE "products"')]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(sum('"stock" = ' in sql for sql in updates), 1)
+        self.assertEqual(Product.objects.get(slug="toaster").stock, 9)
+        self.assertEqual(str(Product.objects.get(slug="kettle").price), "20.00")
+
+    def test_bad_slugs_are_reported(self):
+        from .importer import CatalogImporter
+        rows = enumerate([
+            {"slug": "  Tea Pot ", "title": "Tea Pot", "price": 12},
+            {"slug": "!!!", "title": "Nothing", "price": 1},
+            {"slug": "x" * 51, "title": "Too long", "price": 1},
+        ], start=1)
+        stats = list(CatalogImporter().run(rows))[-1]
+        self.assertEqual((stats["created"], stats["failed"]), (1, 2))
+        self.assertEqual([error["line"] for error in stats["errors"]], [2, 3])
+        self.assertTrue(Product.objects.filter(slug="tea-pot").exists())
+
+    def test_csv_and_search_index(self):
+        feed = "title,price,stock,categories\nGarden Hose,15,10,Garden|Outdoor\n"
+        call_command("import_catalog", self.write_feed("feed.csv", feed), stdout=io.StringIO())
+
+        hose = Product.objects.get(slug="garden-hose")
+        self.assertEqual(hose.categories.count(), 2)
+        response = self.client.get(reverse("products-list"), {"search": "hose"})
+        self.assertEqual(response.data["results"][0]["slug"], "garden-hose")
+
+    def test_admin_import_endpoint_streams_progress(self):
+        admin = User.objects.create_user(username="boss", password="pass", role="admin")
+        client = APIClient()
+        client.force_authenticate(admin)
+        feed = SimpleUploadedFile("feed.ndjson", b'{"title": "Mug", "price": 5}\n{"title": "Mug", "price": 6}\n')
+
+        response = client.post(reverse("products-import-catalog"), {"file": feed}, format="multipart")
+        self.assertEqual(response.status_code, 200)
+        lines = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual(lines[-1]["created"], 2)
+        self.assertEqual(sorted(Product.objects.filter(title="Mug").values_list("slug", flat=True)), ["mug", "mug-2"])
+
+    def test_product_save_allocates_unique_slug(self):
+        self.assertEqual(Product.objects.create(title="Kettle", price=1).slug, "kettle-2")
+        self.assertEqual(Product.objects.create(title="Kettle", price=1).slug, "kettle-3")
+
+
+class OrderExportTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.admin = User.objects.create_user(username="boss", password="pass", role="admin")
+        self.customer = User.objects.create_user(username="buyer", password="pass", role="customer")
+        self.product = Product.objects.create(title="Lamp", price=20)
+
+        self.shipped = Order.objects.create(user=self.customer, total_amount=40, shipping_address="A", status="shipped")
+        OrderItem.objects.create(order=self.shipped, product=self.product, product_name="Lamp", product_price=20, quantity=2)
+        self.pending = Order.objects.create(user=self.customer, total_amount=0, shipping_address="B")
+        Order.objects.filter(pk=self.pending.pk).update(created_at=timezone.now() - timezone.timedelta(days=10))
+
+    def export(self, **params):
+        self.client.force_authenticate(self.admin)
+        response = self.client.get(reverse("order-export"), params)
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content).decode()
+
+    def test_csv_export(self):
+        lines = self.export().strip().splitlines()
+        self.assertEqual(lines[0].split(",")[0], "order_id")
+        self.assertEqual(len(lines), 3)
+        self.assertIn("Lamp,20.00,2", lines[2])
+
+    def test_ndjson_export_with_filters(self):
+        body = self.export(export_format="ndjson", status="shipped", date_from=timezone.now().date().isoformat())
+        orders = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([order["id"] for order in orders], [self.shipped.id])
+        self.assertEqual(orders[0]["items"][0]["quantity"], 2)
+
+    def test_export_validation_and_permissions(self):
+        self.client.force_authenticate(self.admin)
+        self.assertEqual(self.client.get(reverse("order-export"), {"status": "lost"}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("order-export"), {"date_from": "yesterday"}).status_code, 400)
+
+        self.client.force_authenticate(self.customer)
+        self.assertEqual(self.client.get(reverse("order-export")).status_code, 403)
+
+
+class ImageVariantPipelineTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.product = Product.objects.create(title="Chair", price=50)
+
+    def make_upload(self, name="chair.jpg", size=(900, 600)):
+        buffer = io.BytesIO()
+        exif = PILImage.Exif()
+        exif[0x010F] = "Camera Maker"
+        PILImage.new("RGB", size, (200, 30, 30)).save(buffer, "JPEG", exif=exif)
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type="image/jpeg")
+
+    def test_variants_are_resized_and_stripped(self):
+        image = ProductImage.objects.create(product=self.product, image=self.make_upload())
+        generate_image_variants(image.pk)
+        image.refresh_from_db()
+
+        self.assertEqual(sorted(image.variants, key=int), ["160", "320", "640"])
+        with default_storage.open(image.variants["160"]["webp"]) as f:
+            thumb = PILImage.open(f)
+            self.assertEqual(thumb.format, "WEBP")
+            self.assertEqual(thumb.size, (160, 107))
+        with default_storage.open(image.variants["640"]["jpeg"]) as f:
+            self.assertEqual(len(PILImage.open(f).getexif()), 0)
+
+    def test_identical_uploads_are_deduplicated(self):
+        first = ProductImage.objects.create(product=self.product, image=self.make_upload("a.jpg"))
+        generate_image_variants(first.pk)
+        second = ProductImage.objects.create(product=self.product, image=self.make_upload("b.jpg"))
+        duplicate_name = second.image.name
+        generate_image_variants(second.pk)
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(second.image.name, first.image.name)
+        self.assertEqual(second.variants, first.variants)
+        self.assertFalse(default_storage.exists(duplicate_name))
+
+    def test_serializer_exposes_srcset(self):
+        image = ProductImage.objects.create(product=self.product, image=self.make_upload())
+        self.assertIsNone(self.client.get(reverse("products-list")).data["results"][0]["images"][0]["srcset"])
+
+        generate_image_variants(image.pk)
+        srcset = self.client.get(reverse("products-detail", args=[self.product.slug])).data["images"][0]["srcset"]
+        self.assertTrue(srcset["thumbnail"].startswith("http://testserver/media/product_images/variants/"))
+        self.assertTrue(srcset["webp"].endswith(".webp 640w"))
+        self.assertEqual(srcset["jpeg"].count("http://testserver/"), 3)
+
+
+class SalesRankingTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="buyer", password="pass")
+        self.slow = Product.objects.create(title="Slow Seller", price=10)
+        self.hot = Product.objects.create(title="Hot Seller", price=10)
+        self.old_hit = Product.objects.create(title="Old Hit", price=10)
+
+    def sell(self, product, quantity, hours_ago):
+        order = Order.objects.create(user=self.user, total_amount=0, shipping_address="X")
+        Order.objects.filter(pk=order.pk).update(created_at=timezone.now() - timezone.timedelta(hours=hours_ago))
+        OrderItem.objects.create(order=order, product=product, product_name=product.title, product_price=10, quantity=quantity)
+
+    def titles(self, name):
+        return [item["title"] for item in self.client.get(reverse(name)).data]
+
+    def test_rankings_per_window(self):
+        self.sell(self.slow, 1, hours_ago=1)
+        self.sell(self.hot, 5, hours_ago=2)
+        self.sell(self.old_hit, 20, hours_ago=72)
+        refresh_rankings()
+
+        self.assertEqual(self.titles("products-trending"), ["Hot Seller", "Slow Seller"])
+        self.assertEqual(self.titles("products-featured"), ["Old Hit", "Hot Seller", "Slow Seller"])
+
+    def test_incremental_fold(self):
+        self.sell(self.slow, 3, hours_ago=1)
+        refresh_rankings()
+        # Only the new item is read on the next run, and it adds to the same bucket
+        self.sell(self.slow, 4, hours_ago=1)
+        refresh_rankings()
+        self.assertEqual(ProductSalesRank.objects.get(window="24h", rank=1).units, 7)
+
+    def test_recent_items_hold_back_later_ids(self):
+        # A new order's items, then a later id from an order that looks old (e.g. a queued one placed late)
+        self.sell(self.hot, 5, hours_ago=0)
+        self.sell(self.slow, 2, hours_ago=1)
+        refresh_rankings()
+        self.assertFalse(ProductSalesRank.objects.exists())
+
+        refresh_rankings(now=timezone.now() + timezone.timedelta(minutes=5))
+        self.assertEqual(
+            list(ProductSalesRank.objects.filter(window="24h").values_list("product__title", "units")),
+            [("Hot Seller", 5), ("Slow Seller", 2)],
+        )
+
+    def test_featured_falls_back_to_newest(self):
+        self.assertEqual(self.titles("products-featured")[0], "Old Hit")
+
+
+class CartBackendTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="shopper", password="pass")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.phone = Product.objects.create(title="Phone", price=100, stock=10)
+        self.case = Product.objects.create(title="Case", price=5, stock=10)
+
+    def post(self, name, data, **kwargs):
+        # Cart versions move on commit
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse(name), data, **kwargs)
+
+    def add(self, product, quantity):
+        return self.post("cart-add-item", {"product_id": str(product.id), "quantity": quantity})
+
+    def quantities(self, response):
+        return {item["product"]["title"]: item["quantity"] for item in response.data["items"]}
+
+    def exercise_cart(self):
+        self.add(self.phone, 1)
+        self.add(self.phone, 2)
+        response = self.add(self.case, 4)
+        self.assertEqual(self.quantities(response), {"Phone": 3, "Case": 4})
+        self.assertEqual(response.data["total"], 320)
+
+        response = self.post("cart-remove-item", {"product_id": str(self.case.id), "quantity": 1})
+        self.assertEqual(self.quantities(response), {"Phone": 3, "Case": 3})
+        response = self.post("cart-remove-item", {"product_id": str(self.case.id)})
+        self.assertEqual(self.quantities(response), {"Phone": 3})
+        response = self.post("cart-remove-item", {"product_id": str(self.case.id)})
+        self.assertEqual(response.status_code, 404)
+
+    def batch(self, operations, **extra):
+        return self.post("cart-batch", {"operations": operations, **extra}, format="json")
+
+    def exercise_batch(self):
+        self.add(self.case, 5)
+        cable = Product.objects.create(title="Cable", price=2, stock=10)
+        response = self.batch([
+            {"op": "add", "product_id": str(self.phone.id), "quantity": 2},
+            {"op": "add", "product_id": str(self.phone.id), "quantity": 1},
+            {"op": "remove", "product_id": str(self.case.id), "quantity": 2},
+            {"op": "set", "product_id": str(cable.id), "quantity": 4},
+        ])
+        self.assertEqual(self.quantities(response), {"Phone": 3, "Case": 3, "Cable": 4})
+
+        response = self.batch([
+            {"op": "remove", "product_id": str(self.case.id)},
+            {"op": "set", "product_id": str(cable.id), "quantity": 1},
+        ], delta=True)
+        self.assertEqual(response.data["items"], [
+            {"product_id": str(self.case.id), "quantity": 0},
+            {"product_id": str(cable.id), "quantity": 1},
+        ])
+
+    def test_database_backend(self):
+        self.exercise_cart()
+        self.assertEqual(CartItem.objects.get(cart__user=self.user).quantity, 3)
+
+    def test_database_batch(self):
+        self.exercise_batch()
+        self.assertEqual(
+            dict(CartItem.objects.values_list("product__title", "quantity")), {"Phone": 3, "Cable": 1}
+        )
+
+    def test_batch_query_count_does_not_grow_with_size(self):
+        products = [Product.objects.create(title=f"Item {i}", price=1, stock=10) for i in range(40)]
+        self.add(products[0], 1)
+        operations = [{"op": "add", "product_id": str(product.id), "quantity": 1} for product in products]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.batch(operations, delta=True)
+        self.assertEqual(len(response.data["items"]), 40)
+        self.assertLessEqual(len(queries), 8)
+        self.assertEqual(CartItem.objects.get(product=products[0]).quantity, 2)
+
+    def test_batch_validation(self):
+        self.assertEqual(self.batch([]).status_code, 400)
+        self.assertEqual(self.batch([{"op": "explode", "product_id": str(self.phone.id)}]).status_code, 400)
+        response = self.batch([{"op": "set", "product_id": str(self.phone.id), "quantity": 11}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["product_ids"], [str(self.phone.id)])
+        # Nothing is applied when any operation is rejected
+        self.assertFalse(CartItem.objects.exists())
+
+    @unittest.skipUnless("django_redis" in settings.CACHES["default"]["BACKEND"], "needs Redis")
+    @override_settings(CART_BACKEND="products.carts.RedisCartBackend")
+    def test_redis_backend_writes_behind(self):
+        backend = RedisCartBackend()
+        backend.redis.delete(backend.cart_key(self.user.id), backend.dirty_key)
+        # Items already in the database cart are picked up on first use
+        CartItem.objects.create(cart=Cart.objects.create(user=self.user), product=self.phone, quantity=1)
+        self.add(self.phone, 1)
+        self.assertEqual(CartItem.objects.get(product=self.phone).quantity, 1)
+
+        self.add(self.phone, 1)
+        response = self.client.get(reverse("cart-list"))
+        self.assertEqual(self.quantities(response), {"Phone": 3})
+
+        self.add(self.case, 2)
+        self.assertEqual(backend.flush_dirty(), 1)
+        self.assertEqual(
+            dict(CartItem.objects.values_list("product__title", "quantity")), {"Phone": 3, "Case": 2}
+        )
+
+        # Checkout flushes the cart itself and clears both copies
+        self.add(self.case, 1)
+        response = self.post("order-list", {"shipping_address": "X"})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["order"]["total_amount"], "315.00")
+        self.assertFalse(CartItem.objects.exists())
+        self.assertEqual(self.client.get(reverse("cart-list")).data["items"], [])
+
+    @unittest.skipUnless("django_redis" in settings.CACHES["default"]["BACKEND"], "needs Redis")
+    @override_settings(CART_BACKEND="products.carts.RedisCartBackend")
+    def test_redis_batch(self):
+        backend = RedisCartBackend()
+        backend.redis.delete(backend.cart_key(self.user.id), backend.dirty_key)
+        self.exercise_batch()
+        backend.flush_dirty()
+        self.assertEqual(
+            dict(CartItem.objects.values_list("product__title", "quantity")), {"Phone": 3, "Cable": 1}
+        )
+
+    @unittest.skipUnless("django_redis" in settings.CACHES["default"]["BACKEND"], "needs Redis")
+    @override_settings(CART_BACKEND="products.carts.RedisCartBackend")
+    def test_redis_flush_leaves_locked_carts_dirty(self):
+        backend = RedisCartBackend()
+        backend.redis.delete(backend.cart_key(self.user.id), backend.dirty_key)
+        self.add(self.phone, 2)
+        with backend.flush_lock(self.user.id) as locked:
+            self.assertTrue(locked)
+            # Checkout holds the lock: the background flush leaves this cart to it
+            self.assertEqual(backend.flush_dirty(), 0)
+        self.assertFalse(CartItem.objects.exists())
+        backend.persist(self.user)
+        self.assertEqual(CartItem.objects.get(product=self.phone).quantity, 2)
+        self.assertEqual(backend.flush_dirty(), 0)
+
+
+class CartQuoteTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="saver", password="pass")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.phone = Product.objects.create(title="Phone", price=1000, stock=10)
+        self.add(2)
+        Coupon.objects.create(
+            code="SAVE10", discount_percent=10, max_discount_amount=150,
+            valid_from=timezone.now() - timezone.timedelta(days=1),
+            valid_to=timezone.now() + timezone.timedelta(days=1),
+        )
+
+    def add(self, quantity):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("cart-add-item"), {"product_id": str(self.phone.id), "quantity": quantity})
+
+    def validate(self):
+        return self.client.post(reverse("coupon-validate"), {"code": "SAVE10"})
+
+    def test_coupon_reuses_cart_quote(self):
+        self.assertEqual(self.client.get(reverse("cart-list")).data["total"], 2000)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.validate()
+        self.assertFalse(any("SUM" in query["sql"] for query in queries))
+        self.assertEqual(response.data["cart_total"], 2000)
+        # 10% would be 200, capped at 150
+        self.assertEqual(response.data["discount_amount"], 150)
+        self.assertEqual(response.data["cart_total_after_discount"], 1850)
+
+    def test_quote_follows_cart_and_price_changes(self):
+        self.assertEqual(self.validate().data["cart_total"], 2000)
+        self.add(1)
+        self.assertEqual(self.validate().data["cart_total"], 3000)
+        self.phone.price = 500
+        self.phone.save()
+        self.assertEqual(self.validate().data["cart_total"], 1500)
+
+    def test_stock_changes_keep_the_quote(self):
+        self.validate()
+        self.phone.stock = 1
+        self.phone.save()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.validate().data["cart_total"], 2000)
+        self.assertFalse(any("SUM" in query["sql"] for query in queries))
+
+    @unittest.skipUnless("django_redis" in settings.CACHES["default"]["BACKEND"], "needs Redis")
+    def test_cart_version_tags_expire(self):
+        self.add(1)
+        self.validate()
+        for key in ("tag_version_cart-%s", "tag_modified_cart-%s"):
+            self.assertGreater(cache.ttl(key % self.user.id), 0)
+
+
+class CheckoutTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="buyer", password="pass", email="buyer@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.cart = Cart.objects.create(user=self.user)
+
+    def fill_cart(self, count, stock=5):
+        products = [Product.objects.create(title=f"Item {i}", price=10, stock=stock) for i in range(count)]
+        CartItem.objects.bulk_create([CartItem(cart=self.cart, product=product, quantity=2) for product in products])
+        return products
+
+    def checkout(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse("order-list"), {"shipping_address": "1 Main St"})
+
+    def test_checkout_queries_do_not_grow_with_cart_size(self):
+        self.fill_cart(2)
+        with CaptureQueriesContext(connection) as small:
+            self.assertEqual(self.checkout().status_code, 201)
+        self.fill_cart(30)
+        with CaptureQueriesContext(connection) as large:
+            response = self.checkout()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data["order"]["items"]), 30)
+        self.assertEqual(response.data["order"]["total_amount"], "600.00")
+        self.assertEqual(len(large), len(small))
+
+    def test_stock_is_taken_atomically(self):
+        plenty, scarce = self.fill_cart(2)
+        Product.objects.filter(pk=scarce.pk).update(stock=1)
+        response = self.checkout()
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["error"], "Not enough stock for Item 1")
+        # Nothing was taken from the product that did have stock, and the cart survives
+        plenty.refresh_from_db()
+        self.assertEqual(plenty.stock, 5)
+        self.assertEqual(CartItem.objects.count(), 2)
+        self.assertFalse(Order.objects.exists())
+
+        Product.objects.filter(pk=scarce.pk).update(stock=2)
+        self.assertEqual(self.checkout().status_code, 201)
+        self.assertEqual(sorted(Product.objects.values_list("stock", flat=True)), [0, 3])
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_empty_cart(self):
+        self.assertEqual(self.checkout().status_code, 400)
+
+
+class StockReservationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(title="Console", price=500, stock=3)
+        self.buyer = self.shopper("first")
+        self.rival = self.shopper("second")
+        CartItem.objects.create(cart=Cart.objects.create(user=self.buyer.user), product=self.product, quantity=2)
+
+    def shopper(self, name):
+        client = APIClient()
+        client.user = User.objects.create_user(username=name, password="pass")
+        client.force_authenticate(client.user)
+        return client
+
+    def post(self, client, name, data=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            return client.post(reverse(name), data or {})
+
+    def available(self):
+        return self.client.get(reverse("products-detail", args=[self.product.slug])).data["available_stock"]
+
+    def test_reservation_holds_stock_until_checkout(self):
+        self.assertEqual(self.available(), 3)
+        response = self.post(self.buyer, "cart-reserve")
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["items"], [{"product_id": self.product.id, "quantity": 2}])
+        self.assertEqual(self.available(), 1)
+
+        # The held units can't be put in another cart
+        response = self.post(self.rival, "cart-add-item", {"product_id": str(self.product.id), "quantity": 2})
+        self.assertEqual(response.status_code, 400)
+
+        # Checkout consumes the holder's own reservation
+        self.assertEqual(self.post(self.buyer, "order-list", {"shipping_address": "X"}).status_code, 201)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.stock, self.product.reserved), (1, 0))
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_reserving_again_replaces_the_hold(self):
+        self.post(self.buyer, "cart-reserve")
+        self.post(self.buyer, "cart-reserve")
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.reserved, 2)
+
+    def test_reservation_is_all_or_nothing(self):
+        other = Product.objects.create(title="Controller", price=50, stock=0)
+        CartItem.objects.create(cart=self.buyer.user.cart, product=other, quantity=1)
+        response = self.post(self.buyer, "cart-reserve")
+        self.assertEqual(response.data["error"], "Not enough stock for Controller")
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.reserved, 0)
+
+    def test_sweeper_releases_expired_holds(self):
+        self.post(self.buyer, "cart-reserve")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(release_expired_reservations(), 0)
+            released = release_expired_reservations(batch_size=1, now=timezone.now() + timezone.timedelta(hours=1))
+        self.assertEqual(released, 1)
+        self.assertEqual(self.available(), 3)
+
+    def test_stock_changes_move_list_etags_and_refresh_detail(self):
+        self.available()
+        listing = self.client.get(reverse("products-list"))
+        product_version = get_tag_versions([PRODUCT_TAG])
+
+        self.post(self.buyer, "cart-reserve")
+        # The detail entry is written back rather than dropped
+        self.assertEqual(cache.get(product_detail_key(self.product.slug))[0]["data"]["available_stock"], 1)
+        self.assertEqual(get_tag_versions([PRODUCT_TAG]), product_version)
+        # The list no longer matches its old ETag and shows the new stock
+        relisted = self.client.get(reverse("products-list"), HTTP_IF_NONE_MATCH=listing["ETag"])
+        self.assertEqual(relisted.status_code, 200)
+        self.assertNotEqual(relisted["ETag"], listing["ETag"])
+        self.assertEqual(relisted.data["results"][0]["available_stock"], 1)
+
+    def test_save_does_not_write_back_reserved(self):
+        stale = Product.objects.get(pk=self.product.pk)
+        self.post(self.buyer, "cart-reserve")
+        stale.title = "Console Pro"
+        stale.save()
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.title, self.product.reserved), ("Console Pro", 2))
+
+
+class IdempotencyKeyTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="retrier", password="pass", email="retrier@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.product = Product.objects.create(title="Lamp", price=40, stock=10)
+        CartItem.objects.create(cart=Cart.objects.create(user=self.user), product=self.product, quantity=1)
+
+    def checkout(self, key, address="1 Main St"):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse("order-list"), {"shipping_address": address}, HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retried_checkout_is_replayed(self):
+        first = self.checkout("checkout-1")
+        self.assertEqual(first.status_code, 201)
+        with CaptureQueriesContext(connection) as queries:
+            retry = self.checkout("checkout-1")
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.data["order"]["id"], first.data["order"]["id"])
+        self.assertEqual(Order.objects.count(), 1)
+        # The replay is served from the cache without touching the orders tables
+        self.assertFalse(any("orders" in query["sql"] for query in queries))
+
+    def test_key_reused_for_another_request(self):
+        self.checkout("checkout-1")
+        self.assertEqual(self.checkout("checkout-1", address="Elsewhere").status_code, 422)
+
+    def test_in_flight_request_conflicts(self):
+        view_cache_key = f'idempotency_{self.user.pk}_order_create_{hashlib.md5(b"checkout-1").hexdigest()}'
+        cache.set(f"{view_cache_key}_lock", 1)
+        self.assertEqual(self.checkout("checkout-1").status_code, 409)
+        self.assertFalse(Order.objects.exists())
+
+    def test_cart_mutations_are_idempotent(self):
+        for _ in range(2):
+            self.client.post(
+                reverse("cart-add-item"), {"product_id": str(self.product.id), "quantity": 2},
+                HTTP_IDEMPOTENCY_KEY="add-1",
+            )
+        self.assertEqual(CartItem.objects.get().quantity, 3)
+
+
+class AsyncCheckoutTest(EagerTasksMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="rusher", password="pass", email="rusher@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.product = Product.objects.create(title="Sneakers", price=90, stock=1)
+        CartItem.objects.create(cart=Cart.objects.create(user=self.user), product=self.product, quantity=1)
+        self.layer = get_channel_layer()
+
+    def queue_checkout(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(
+                reverse("order-list"), {"shipping_address": "X"}, HTTP_PREFER="respond-async"
+            )
+        self.assertEqual(response.status_code, 202)
+        order_id = response.data["order"]["id"]
+        self.assertEqual(Order.objects.get(pk=order_id).status, "queued")
+        # Listen on the order's group before the worker runs
+        async_to_sync(self.layer.group_add)(f"order_{order_id}", "test-listener")
+        with self.captureOnCommitCallbacks(execute=True):
+            for callback in callbacks:
+                callback()
+        return Order.objects.get(pk=order_id)
+
+    def last_update(self):
+        message = None
+        while True:
+            try:
+                message = async_to_sync(asyncio.wait_for)(self.layer.receive("test-listener"), 0.1)
+            except asyncio.TimeoutError:
+                return message["data"]
+
+    def test_queued_order_is_placed_by_worker(self):
+        order = self.queue_checkout()
+        self.assertEqual(order.status, "pending")
+        self.assertEqual(order.items.get().product_name, "Sneakers")
+        self.assertEqual(self.last_update()["status"], "pending")
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 0)
+
+    def test_failed_checkout_is_pushed_to_the_client(self):
+        Product.objects.filter(pk=self.product.pk).update(stock=0)
+        order = self.queue_checkout()
+        self.assertEqual(order.status, "failed")
+        update = self.last_update()
+        self.assertEqual(
+            {key: update[key] for key in ("id", "status", "previous_status", "error")},
+            {"id": order.id, "status": "failed", "previous_status": "queued", "error": "Not enough stock for Sneakers"},
+        )
+        self.assertTrue(CartItem.objects.exists())
+
+    def test_transient_errors_are_retried(self):
+        real_place_order = checkout.place_order
+        calls = []
+
+        def flaky(*args, **kwargs):
+            calls.append(1)
+            if len(calls) < 3:
+                raise OperationalError("database is locked")
+            return real_place_order(*args, **kwargs)
+
+        with mock.patch.object(checkout, "place_order", flaky):
+            order = self.queue_checkout()
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(order.status, "pending")
+
+    def test_order_fails_after_the_last_retry(self):
+        with mock.patch.object(checkout, "place_order", side_effect=OperationalError("database is locked")) as place:
+            order = self.queue_checkout()
+        self.assertEqual(place.call_count, 6)
+        self.assertEqual(order.status, "failed")
+        update = self.last_update()
+        self.assertEqual((update["status"], update["error"]), ("failed", "Checkout could not be completed, please try again"))
+
+    def test_empty_cart_is_rejected_up_front(self):
+        CartItem.objects.all().delete()
+        response = self.client.post(reverse("order-list"), {"shipping_address": "X"}, HTTP_PREFER="respond-async")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+
+
+class SalesRollupTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="shopper", password="pass", email="shopper@example.com")
+        self.admin = User.objects.create_user(username="boss", password="pass", email="boss@example.com", role="admin")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.lamp = Product.objects.create(title="Lamp", price=20, stock=50)
+        self.rug = Product.objects.create(title="Rug", price=100, stock=50)
+
+    def checkout(self, lamps=0, rugs=0):
+        cart, _ = Cart.objects.get_or_create(user=self.user)
+        CartItem.objects.bulk_create(
+            [CartItem(cart=cart, product=product, quantity=n) for product, n in ((self.lamp, lamps), (self.rug, rugs)) if n]
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse("order-list"), {"shipping_address": "1 Main St"})
+        self.assertEqual(response.status_code, 201)
+        return Order.objects.get(pk=response.data["order"]["id"])
+
+    def rollups(self):
+        return (
+            list(DailySales.objects.order_by("day").values_list("day", "orders", "units", "revenue")),
+            sorted(DailyProductSales.objects.values_list("day", "product_id", "units", "revenue")),
+            dict(OrderStatusCount.objects.filter(count__gt=0).values_list("status", "count")),
+        )
+
+    def test_checkout_updates_rollups(self):
+        self.checkout(lamps=2, rugs=1)
+        self.checkout(lamps=1)
+        today = timezone.localdate()
+        self.assertEqual(DailySales.objects.get(day=today).revenue, 160)
+        self.assertEqual(DailySales.objects.get(day=today).orders, 2)
+        self.assertEqual(DailyProductSales.objects.get(day=today, product=self.lamp).units, 3)
+        self.assertEqual(DailyProductSales.objects.get(day=today, product=self.rug).revenue, 100)
+        self.assertEqual(OrderStatusCount.objects.get(status="pending").count, 2)
+
+    def test_cancelling_takes_sales_back(self):
+        order = self.checkout(lamps=2)
+        self.checkout(rugs=1)
+        order.status = "cancelled"
+        order.save()
+        daily = DailySales.objects.get()
+        self.assertEqual((daily.orders, daily.units, daily.revenue), (1, 1, 100))
+        self.assertEqual(DailyProductSales.objects.get(product=self.lamp).units, 0)
+        self.assertEqual(self.rollups()[2], {"pending": 1, "cancelled": 1})
+
+        order.status = "processing"
+        order.save()
+        self.assertEqual(DailySales.objects.get().revenue, 140)
+
+    def test_orders_outside_checkout_are_recorded_once(self):
+        order = Order.objects.create(user=self.user, total_amount=100, shipping_address="X")
+        self.assertEqual(DailySales.objects.count(), 0)
+        item = OrderItem.objects.create(order=order, product=self.rug, product_name="Rug", product_price=100, quantity=1)
+        self.assertEqual(DailySales.objects.values_list("orders", "units", "revenue").get(), (1, 1, 100))
+        item.quantity = 2
+        item.save()
+        OrderItem.objects.create(order=order, product=self.lamp, product_name="Lamp", product_price=20, quantity=1)
+        self.assertEqual(DailySales.objects.values_list("orders", "units", "revenue").get(), (1, 3, 220))
+
+        order.status = "cancelled"
+        order.save()
+        self.assertEqual(DailySales.objects.values_list("orders", "units", "revenue").get(), (0, 0, 0))
+        # Cancelling again (or an order that never counted) takes nothing back
+        Order.objects.filter(pk=order.pk).update(status="pending")
+        order.refresh_from_db()
+        order.status = "cancelled"
+        order.save()
+        self.assertEqual(DailySales.objects.values_list("orders", "units", "revenue").get(), (0, 0, 0))
+
+    def test_unrecorded_orders_are_not_taken_back_in_bulk(self):
+        recorded = self.checkout(rugs=1)
+        unrecorded = Order.objects.create(user=self.user, total_amount=0, shipping_address="X")
+        self.client.force_authenticate(self.admin)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse("order-bulk-update-status"), {"status": "cancelled", "ids": [recorded.id, unrecorded.id]}, format="json"
+            )
+        self.assertEqual(DailySales.objects.values_list("orders", "units", "revenue").get(), (0, 0, 0))
+
+    def test_deleted_orders_leave_the_rollups(self):
+        kept = self.checkout(rugs=1)
+        before = self.rollups()
+        cancelled = self.checkout(lamps=2)
+        self.checkout(rugs=2)
+        cancelled.status = "cancelled"
+        cancelled.save()
+        orders = Order.objects.exclude(pk=kept.pk)
+        orders_deleted(orders)
+        orders.delete()
+        self.assertEqual(self.rollups()[0], before[0])
+        self.assertEqual(self.rollups()[2], before[2])
+        self.assertEqual(DailyProductSales.objects.get(product=self.lamp).units, 0)
+
+    def test_deleting_an_order_takes_it_out_of_the_rollups(self):
+        order = self.checkout(lamps=2)
+        response = self.client.delete(reverse("order-detail", args=[order.id]))
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.rollups()[2], {})
+        self.assertEqual(DailySales.objects.values_list("orders", "units", "revenue").get(), (0, 0, 0))
+
+    def test_backfill_matches_incremental_rollups(self):
+        shipped = self.checkout(lamps=2, rugs=1)
+        cancelled = self.checkout(lamps=3)
+        self.checkout(rugs=2)
+        shipped.status = "shipped"
+        shipped.save()
+        cancelled.status = "cancelled"
+        cancelled.save()
+        incremental = self.rollups()
+        call_command("backfill_sales_rollups", stdout=io.StringIO())
+        self.assertEqual(self.rollups(), incremental)
+
+    def test_reports_read_rollups_only(self):
+        self.checkout(lamps=2, rugs=1)
+        self.checkout(lamps=1)
+        self.client.force_authenticate(self.admin)
+        today = timezone.localdate().isoformat()
+        with CaptureQueriesContext(connection) as queries:
+            revenue = self.client.get(reverse("report-revenue"), {"date_from": today, "date_to": today})
+            top = self.client.get(reverse("report-top-products"), {"limit": 1})
+            statuses = self.client.get(reverse("report-order-status"))
+        for query in queries:
+            self.assertNotIn('FROM "orders"', query["sql"])
+            self.assertNotIn('JOIN "orders"', query["sql"])
+            self.assertNotIn('"order_items"', query["sql"])
+        self.assertEqual(revenue.data["revenue"], 160)
+        self.assertEqual(revenue.data["orders"], 2)
+        self.assertEqual(top.data["results"][0]["title"], "Lamp")
+        self.assertEqual(top.data["results"][0]["units"], 3)
+        self.assertEqual(statuses.data, {"pending": 2})
+
+    def test_reports_are_admin_only(self):
+        self.assertEqual(self.client.get(reverse("report-revenue")).status_code, 403)
+        self.client.force_authenticate(self.admin)
+        self.assertEqual(self.client.get(reverse("report-revenue"), {"date_from": "yesterday"}).status_code, 400)
+
+
+
+class BulkOrderStatusTest(EagerTasksMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user(username="warehouse", password="pass", email="wh@example.com", role="admin")
+        self.buyer = User.objects.create_user(username="buyer", password="pass", email="buyer@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+        self.product = Product.objects.create(title="Box", price=10, stock=100)
+        self.layer = get_channel_layer()
+
+    def make_orders(self, count, status="processing"):
+        orders = []
+        for _ in range(count):
+            order = Order.objects.create(user=self.buyer, total_amount=20, shipping_address="X", status=status)
+            OrderItem.objects.create(order=order, product=self.product, product_name="Box", product_price=10, quantity=2)
+            orders.append(order)
+        return orders
+
+    def bulk_update(self, body):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse("order-bulk-update-status"), body, format="json")
+
+    def received(self, channel):
+        messages = []
+        while True:
+            try:
+                messages.append(async_to_sync(asyncio.wait_for)(self.layer.receive(channel), 0.1)["data"])
+            except asyncio.TimeoutError:
+                return messages
+
+    def test_one_update_per_status(self):
+        processing = self.make_orders(3)
+        pending = self.make_orders(2, status="pending")
+        delivered = self.make_orders(1, status="delivered")
+        ids = [order.id for order in processing + delivered]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.bulk_update({"transitions": [
+                {"status": "shipped", "ids": ids},
+                {"status": "cancelled", "filter": {"status": "pending"}},
+            ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {"updated": {"shipped": 3, "cancelled": 2}, "skipped": 1})
+        updates = [query for query in queries if query["sql"].startswith('UPDATE "orders"')]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(Order.objects.filter(status="shipped").count(), 3)
+        self.assertEqual(Order.objects.get(pk=delivered[0].pk).status, "delivered")
+        self.assertEqual(Order.objects.filter(pk__in=[order.pk for order in pending], status="cancelled").count(), 2)
+
+    def test_rollups_follow_bulk_updates(self):
+        self.make_orders(2, status="pending")
+        processing = self.make_orders(2)
+        call_command("backfill_sales_rollups", stdout=io.StringIO())
+        self.bulk_update({"status": "cancelled", "filter": {"status": ["pending", "processing"]}})
+        self.bulk_update({"status": "processing", "ids": [order.id for order in processing]})
+        incremental = (
+            list(DailySales.objects.values_list("day", "orders", "units", "revenue")),
+            dict(OrderStatusCount.objects.filter(count__gt=0).values_list("status", "count")),
+        )
+        self.assertEqual(incremental[0][0][1:], (0, 0, 0))
+        self.assertEqual(incremental[1], {"cancelled": 4})
+        call_command("backfill_sales_rollups", stdout=io.StringIO())
+        self.assertEqual(list(DailySales.objects.values_list("day", "orders", "units", "revenue")), [])
+
+    def test_updates_are_fanned_out_after_commit(self):
+        orders = self.make_orders(5)
+        for order in orders:
+            async_to_sync(self.layer.group_add)(f"order_{order.id}", f"listener-{order.id}")
+        self.bulk_update({"status": "shipped", "ids": [order.id for order in orders]})
+        for order in orders:
+            (data,) = self.received(f"listener-{order.id}")
+            self.assertEqual(data["id"], order.id)
+            self.assertEqual(data["status"], "shipped")
+            self.assertEqual(data["previous_status"], "processing")
+
+    def test_transitions_do_not_chain(self):
+        pending = self.make_orders(2, status="pending")
+        async_to_sync(self.layer.group_add)(f"order_{pending[0].id}", "chain-listener")
+        response = self.bulk_update({"transitions": [
+            {"status": "processing", "ids": [order.id for order in pending]},
+            {"status": "shipped", "filter": {"status": "processing"}},
+        ]})
+        self.assertEqual(response.data, {"updated": {"processing": 2, "shipped": 0}, "skipped": 0})
+        self.assertEqual(set(Order.objects.values_list("status", flat=True)), {"processing"})
+        (data,) = self.received("chain-listener")
+        self.assertEqual((data["previous_status"], data["status"]), ("pending", "processing"))
+
+    def test_validation(self):
+        orders = self.make_orders(1)
+        self.assertEqual(self.bulk_update({"status": "queued", "ids": [orders[0].id]}).status_code, 400)
+        self.assertEqual(self.bulk_update({"status": "shipped"}).status_code, 400)
+        self.assertEqual(self.bulk_update({"status": "shipped", "filter": {"date_from": "soon"}}).status_code, 400)
+        self.client.force_authenticate(self.buyer)
+        self.assertEqual(self.bulk_update({"status": "shipped", "ids": [orders[0].id]}).status_code, 403)
+        self.assertEqual(Order.objects.get().status, "processing")
+
+    def test_single_update_follows_the_transitions(self):
+        (order,) = self.make_orders(1)
+        queued = Order.objects.create(user=self.buyer, total_amount=20, shipping_address="X", status="queued")
+
+        def update(order, status):
+            with self.captureOnCommitCallbacks(execute=True):
+                return self.client.post(reverse("order-update-status", args=[order.id]), {"status": status})
+
+        for target in ("queued", "failed", "pending"):
+            self.assertEqual(update(order, target).status_code, 400)
+        self.assertEqual(update(queued, "pending").status_code, 400)
+        self.assertEqual(update(order, "shipped").status_code, 200)
+        self.assertEqual(
+            dict(Order.objects.values_list("id", "status")), {order.id: "shipped", queued.id: "queued"}
+        )
+
+
+class OrderArchiveTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="regular", password="pass", email="regular@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.product = Product.objects.create(title="Kettle", price=30, stock=100)
+
+    def make_order(self, days_ago, status="delivered"):
+        order = Order.objects.create(user=self.user, total_amount=60, shipping_address="X", status=status)
+        OrderItem.objects.create(order=order, product=self.product, product_name="Kettle", product_price=30, quantity=2)
+        Order.objects.filter(pk=order.pk).update(created_at=timezone.now() - timezone.timedelta(days=days_ago))
+        return order
+
+    def rollups(self):
+        return (
+            sorted(DailySales.objects.values_list("day", "orders", "units", "revenue")),
+            sorted(DailyProductSales.objects.values_list("day", "product_id", "units", "revenue")),
+            dict(OrderStatusCount.objects.filter(count__gt=0).values_list("status", "count")),
+        )
+
+    def test_only_old_closed_orders_move(self):
+        old_delivered = self.make_order(200)
+        old_cancelled = self.make_order(150, status="cancelled")
+        old_open = self.make_order(200, status="shipped")
+        recent = self.make_order(5)
+        self.assertEqual(archive_orders(days=90, batch_size=1), 2)
+        self.assertEqual(set(Order.objects.values_list("id", flat=True)), {old_open.id, recent.id})
+        self.assertEqual(set(ArchivedOrder.objects.values_list("id", flat=True)), {old_delivered.id, old_cancelled.id})
+        item = ArchivedOrderItem.objects.get(order_id=old_delivered.id)
+        self.assertEqual((item.product_id, item.quantity), (self.product.id, 2))
+        self.assertEqual(OrderItem.objects.count(), 2)
+
+    def test_archival_leaves_rollups_alone(self):
+        self.make_order(200)
+        self.make_order(120, status="cancelled")
+        self.make_order(3, status="pending")
+        call_command("backfill_sales_rollups", stdout=io.StringIO())
+        before = self.rollups()
+        archive_orders(days=90)
+        self.assertEqual(self.rollups(), before)
+        call_command("backfill_sales_rollups", stdout=io.StringIO())
+        self.assertEqual(self.rollups(), before)
+
+    def test_order_list_reads_both_tiers(self):
+        orders = [self.make_order(days) for days in (300, 200, 100)] + [self.make_order(days, "pending") for days in (250, 1)]
+        archive_orders(days=90)
+        self.assertEqual(Order.objects.count(), 2)
+        newest_first = [orders[4].id, orders[2].id, orders[1].id, orders[3].id, orders[0].id]
+
+        seen, url = [], reverse("order-list") + "?page_size=2"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen += [order["id"] for order in response.data["results"]]
+            url = response.data["next"]
+        self.assertEqual(seen, newest_first)
+
+        archived = self.client.get(reverse("order-detail", args=[orders[0].id]))
+        self.assertEqual(archived.status_code, 200)
+        self.assertTrue(archived.data["archived"])
+        self.assertEqual(archived.data["items"][0]["product_name"], "Kettle")
+        self.assertEqual(self.client.delete(reverse("order-detail", args=[orders[0].id])).status_code, 404)
+
+    def test_export_and_coupons_see_archived_orders(self):
+        archived = self.make_order(200)
+        hot = self.make_order(10, status="pending")
+        archive_orders(days=90)
+        admin = User.objects.create_user(username="exporter", password="pass", email="ex@example.com", role="admin")
+        self.client.force_authenticate(admin)
+        response = self.client.get(reverse("order-export"), {"export_format": "ndjson"})
+        ids = [json.loads(line)["id"] for line in b"".join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(ids, [archived.id, hot.id])
+
+        coupon = Coupon.objects.create(
+            code="FIRST", discount_percent=10, valid_from=timezone.now() - timezone.timedelta(days=1),
+            valid_to=timezone.now() + timezone.timedelta(days=1), first_time_users_only=True,
+        )
+        self.assertFalse(coupon.is_valid(self.user, 100))
+
+
+class OrderUpdateNotificationTest(EagerTasksMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="watcher", password="pass", email="watcher@example.com")
+        self.order = Order.objects.create(user=self.user, total_amount=10, shipping_address="X")
+        self.layer = get_channel_layer()
+        async_to_sync(self.layer.group_add)(f"order_{self.order.id}", "watcher")
+
+    def received(self):
+        messages = []
+        while True:
+            try:
+                messages.append(async_to_sync(asyncio.wait_for)(self.layer.receive("watcher"), 0.1)["data"])
+            except asyncio.TimeoutError:
+                return messages
+
+    def set_status(self, status):
+        self.order.status = status
+        self.order.save()
+
+    def test_changes_in_one_transaction_are_coalesced(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                self.set_status("processing")
+                self.set_status("shipped")
+                self.order.shipping_address = "Y"
+                self.order.save()
+        # Nothing is sent before the commit
+        self.assertEqual(self.received(), [])
+        for callback in callbacks:
+            callback()
+        (update,) = self.received()
+        self.assertEqual(
+            {key: update[key] for key in ("id", "status", "previous_status")},
+            {"id": self.order.id, "status": "shipped", "previous_status": "pending"},
+        )
+
+    def test_only_status_changes_are_sent(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.objects.create(user=self.user, total_amount=10, shipping_address="X")
+            self.order.shipping_address = "Y"
+            self.order.save()
+            with transaction.atomic():
+                self.set_status("processing")
+                self.set_status("pending")
+        self.assertEqual(self.received(), [])
+
+    def test_rolled_back_changes_are_not_sent(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    self.set_status("cancelled")
+                    raise ValueError
+            except ValueError:
+                pass
+            with transaction.atomic():
+                self.order.refresh_from_db()
+                self.set_status("processing")
+        self.assertEqual([update["status"] for update in self.received()], ["processing"])
+
+    def test_a_reused_batch_publishes_only_committed_changes(self):
+        # e.g. the outermost block's batch, after an earlier transaction on this thread rolled back
+        batch = OrderChangeBatch()
+        other = Order.objects.create(user=self.user, total_amount=10, shipping_address="X")
+        async_to_sync(self.layer.group_add)(f"order_{other.id}", "watcher")
+        with self.captureOnCommitCallbacks():
+            batch.add(other.id, status_change("pending", "cancelled", timezone.now()))
+        with self.captureOnCommitCallbacks() as callbacks:
+            batch.add(self.order.id, status_change("pending", "processing", timezone.now()))
+        for callback in callbacks:
+            callback()
+        self.assertEqual([(update["id"], update["status"]) for update in self.received()], [(self.order.id, "processing")])
+
+    def test_rolled_back_savepoint_is_dropped_from_the_batch(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                self.set_status("processing")
+                try:
+                    with transaction.atomic():
+                        self.set_status("cancelled")
+                        raise ValueError
+                except ValueError:
+                    pass
+        (update,) = self.received()
+        self.assertEqual((update["status"], update["previous_status"]), ("processing", "pending"))
+
+
+class OrderWebsocketTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="socket", password="pass", email="socket@example.com")
+        self.other = User.objects.create_user(username="neighbour", password="pass", email="neighbour@example.com")
+        self.open_ids = [
+            Order.objects.create(user=self.user, total_amount=10, shipping_address="X", status=status).id
+            for status in ("pending", "processing", "shipped")
+        ]
+        self.delivered_id = Order.objects.create(user=self.user, total_amount=10, shipping_address="X", status="delivered").id
+        self.foreign_id = Order.objects.create(user=self.other, total_amount=10, shipping_address="X").id
+        self.layer = get_channel_layer()
+        # Order ids are reused across tests, so start without earlier tests' group members
+        async_to_sync(self.layer.flush)()
+
+    def socket(self, user, consumer=OrderUpdatesConsumer, order_id=None):
+        path = f"/ws/orders/{order_id}/" if order_id else "/ws/orders/"
+        communicator = WebsocketCommunicator(consumer.as_asgi(), path)
+        communicator.scope["user"] = user
+        communicator.scope["url_route"] = {"kwargs": {"order_id": str(order_id)} if order_id else {}}
+        return communicator
+
+    async def publish(self, order_id):
+        # What publish_order_updates sends: to the order's group and to its owner's
+        owner = self.other if order_id == self.foreign_id else self.user
+        message = {"type": "order_update", "data": {"id": order_id, "status": "shipped"}}
+        await self.layer.group_send(f"order_{order_id}", message)
+        await self.layer.group_send(f"user_orders_{owner.id}", message)
+
+    def test_one_socket_follows_all_open_orders(self):
+        async def scenario():
+            socket = self.socket(self.user)
+            connected, _ = await socket.connect()
+            self.assertTrue(connected)
+            welcome = await socket.receive_json_from()
+            self.assertEqual(welcome["orders"], sorted(self.open_ids))
+            for order_id in self.open_ids:
+                await self.publish(order_id)
+                self.assertEqual((await socket.receive_json_from())["data"]["id"], order_id)
+            await self.publish(self.foreign_id)
+            self.assertTrue(await socket.receive_nothing())
+            await socket.disconnect()
+
+        with self.assertNumQueries(1):
+            async_to_sync(scenario)()
+
+    def test_orders_placed_after_connecting_arrive_once(self):
+        async def scenario():
+            socket = self.socket(self.user)
+            await socket.connect()
+            await socket.receive_json_from()
+            await socket.send_json_to({"action": "subscribe", "orders": [self.delivered_id]})
+            await socket.receive_json_from()
+            order = await database_sync_to_async(Order.objects.create)(user=self.user, total_amount=10, shipping_address="X")
+            await database_sync_to_async(publish_order_updates)([
+                {"id": order.id, "status": "pending"}, {"id": self.delivered_id, "status": "delivered"},
+            ])
+            self.assertEqual((await socket.receive_json_from())["data"]["id"], order.id)
+            self.assertEqual((await socket.receive_json_from())["data"]["id"], self.delivered_id)
+            self.assertTrue(await socket.receive_nothing())
+            await socket.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_subscribe_checks_cached_ownership(self):
+        async def scenario():
+            socket = self.socket(self.user)
+            await socket.connect()
+            await socket.receive_json_from()
+            await socket.send_json_to({"action": "subscribe", "orders": [self.delivered_id, self.foreign_id, 10 ** 9]})
+            reply = await socket.receive_json_from()
+            self.assertEqual(reply, {"type": "subscribed", "orders": [self.delivered_id], "denied": [self.foreign_id, 10 ** 9]})
+
+            await socket.send_json_to({"action": "unsubscribe", "orders": [self.open_ids[0]]})
+            self.assertEqual((await socket.receive_json_from())["orders"], [self.open_ids[0]])
+            await self.publish(self.open_ids[0])
+            self.assertTrue(await socket.receive_nothing())
+            await socket.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(cache.get(order_owner_key(self.foreign_id)), self.other.id)
+
+        async def resubscribe():
+            # A new socket: connect runs its one query, ownership comes from the cache after that
+            socket = self.socket(self.user)
+            await socket.connect()
+            await socket.receive_json_from()
+            await socket.send_json_to({"action": "subscribe", "orders": [self.delivered_id, self.foreign_id]})
+            self.assertEqual((await socket.receive_json_from())["orders"], [self.delivered_id])
+            await socket.disconnect()
+
+        with self.assertNumQueries(1):
+            async_to_sync(resubscribe)()
+
+    def test_admin_can_follow_any_order(self):
+        admin = User.objects.create_user(username="ops", password="pass", email="ops@example.com", role="admin")
+
+        async def scenario():
+            socket = self.socket(admin)
+            await socket.connect()
+            self.assertEqual((await socket.receive_json_from())["orders"], [])
+            await socket.send_json_to({"action": "subscribe", "orders": [self.foreign_id]})
+            self.assertEqual((await socket.receive_json_from())["orders"], [self.foreign_id])
+            await socket.send_json_to({"action": "watch"})
+            self.assertEqual((await socket.receive_json_from())["type"], "error")
+            await socket.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_single_order_socket_checks_access_before_joining(self):
+        async def scenario():
+            socket = self.socket(self.user, OrderConsumer, self.foreign_id)
+            connected, _ = await socket.connect()
+            self.assertFalse(connected)
+            # Refused before joining, so the order's group has nobody in it
+            self.assertFalse(self.layer.groups.get(f"order_{self.foreign_id}"))
+
+            socket = self.socket(self.user, OrderConsumer, self.open_ids[0])
+            connected, _ = await socket.connect()
+            self.assertTrue(connected)
+            await self.publish(self.open_ids[0])
+            self.assertEqual(json.loads(await socket.receive_from())["data"]["id"], self.open_ids[0])
+            await socket.disconnect()
+
+        async_to_sync(scenario)()
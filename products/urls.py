@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import CategoryViewSet, ProductViewSet, CartViewSet, OrderViewSet , CouponViewSet # Import the viewsets
+from .views import CategoryViewSet, ProductViewSet, CartViewSet, OrderViewSet , CouponViewSet, ReportViewSet # Import the viewsets
 
 # Create a router object
 router = DefaultRouter()
@@ -11,6 +11,7 @@ router.register(r'products', ProductViewSet, basename='products')
 router.register(r'cart', CartViewSet, basename='cart')
 router.register(r'order', OrderViewSet, basename='order')
 router.register(r'coupons', CouponViewSet, basename='coupon')
+router.register(r'reports', ReportViewSet, basename='report')
 
 # Include the generated URLs from the router
 urlpatterns = [
@@ -1,66 +1,173 @@
+import io
+import json
 from rest_framework import viewsets, status, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.exceptions import NotFound
+from rest_framework.parsers import MultiPartParser
 from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from django_filters.rest_framework import DjangoFilterBackend
-from django.core.cache import cache
-from .models import Category, Product, ProductImage, Cart, CartItem, Order, OrderItem, Coupon
+from django.http import StreamingHttpResponse, Http404
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.core.exceptions import ValidationError
+from django.utils.dateparse import parse_date
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+from .models import Category, Product, ProductImage, Cart, Order, ArchivedOrder, Coupon
 from .serializers import CategorySerializer, ProductSerializer, ProductImageSerializer, CartSerializer,CartItemSerializer, OrderSerializer, CouponSerializer
 from .permissions import IsAdminOrReadOnly
-from .tasks import send_order_confirmation_email
+from .search import ProductSearchFilter
+from .filters import ProductFilter
+from .category_tree import get_category_tree
+from .facets import wants_facets, get_product_facets
+from .importer import CatalogImporter, iter_rows, IMPORT_FORMATS
+from .exports import filter_orders, export_csv, export_ndjson, ExportError, EXPORT_FORMATS
+from .rankings import ranked_products, RANKING_SIZE
+from .reports import daily_revenue, top_products, status_counts, orders_deleted, MAX_TOP_PRODUCTS
+from .detail_cache import get_product_detail, absolutize_media_urls
+from .pagination import ProductPagination, OrderPagination
+from .archive import OrderTiers
+from .pricing import get_cart_quote, apply_coupon
+from .idempotency import IdempotencyMixin
+from .checkout import place_order, queue_order, reserve_cart, CheckoutError
+from .order_status import parse_transitions, apply_transitions, OrderStatusError, ORDER_TRANSITIONS
+from .carts import get_cart_backend, cart_prefetch_plan, parse_operations, plan_operations, CartOperationError
+from .cache import (
+    CachedListMixin, PRODUCT_LIST_TAGS, CATEGORY_LIST_TAGS, COUPON_LIST_TAGS, SALES_RANK_TAG,
+    make_tagged_etag, not_modified_response, set_conditional_headers,
+)
 from rest_framework.throttling import UserRateThrottle
-from django.conf import settings
 
 class CouponValidationThrottle(UserRateThrottle):
     scope = 'coupon_validation'
 
 
-class CategoryViewSet(viewsets.ModelViewSet):
+class PrefetchPlanMixin:
+    """
+    Declares the relations a viewset's serializer tree walks, so every
+    queryset or instance it serializes is loaded in a fixed number of queries.
+    """
+    select_related_fields = ()
+    prefetch_related_fields = ()
+
+    def get_prefetch_related_fields(self):
+        return self.prefetch_related_fields
+
+    def apply_prefetch_plan(self, queryset):
+        if self.select_related_fields:
+            queryset = queryset.select_related(*self.select_related_fields)
+        prefetch_fields = self.get_prefetch_related_fields()
+        if prefetch_fields:
+            queryset = queryset.prefetch_related(*prefetch_fields)
+        return queryset
+
+    def prefetch_instance(self, instance):
+        prefetch_related_objects([instance], *self.get_prefetch_related_fields())
+        return instance
+
+
+class CategoryViewSet(CachedListMixin, viewsets.ModelViewSet):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     permission_classes = [IsAdminOrReadOnly]
     lookup_field = 'slug'
+    cache_tags = CATEGORY_LIST_TAGS
+    
+    @action(detail=False, methods=['get'])
+    def tree(self, request):
+        etag, last_modified = make_tagged_etag(self.cache_tags, 'tree')
+        not_modified = not_modified_response(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+        return set_conditional_headers(Response(get_category_tree()), etag, last_modified)
 
-class ProductViewSet(viewsets.ModelViewSet):
+class ProductViewSet(PrefetchPlanMixin, CachedListMixin, viewsets.ModelViewSet):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
     permission_classes = [IsAdminOrReadOnly]
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
-    filterset_fields = ['categories', 'price', 'is_active']
-    search_fields = ['name', 'description']
+    filter_backends = [DjangoFilterBackend, ProductSearchFilter, filters.OrderingFilter]
+    filterset_class = ProductFilter
+    search_fields = ['title', 'description', 'categories__title']
     ordering_fields = ['price', 'created_at', 'stock']
+    pagination_class = ProductPagination
     lookup_field = 'slug'
+    cache_tags = PRODUCT_LIST_TAGS
+    prefetch_related_fields = ('images', 'categories')
     
     def get_queryset(self):
-        cache_key = f'product_{self.request.query_params}'
-        queryset = cache.get(cache_key)
-        
-        if not queryset:
-            queryset = super().get_queryset()
-            cache.set(cache_key, queryset, settings.CACHE_TTL)  # Cache for 5 minutes
-        
-        return queryset
+        return self.apply_prefetch_plan(super().get_queryset())
+    
+    def get_cache_tags(self):
+        if self.action in ('featured', 'trending'):
+            return self.cache_tags + (SALES_RANK_TAG,)
+        return self.cache_tags
+    
+    def paginate_queryset(self, queryset):
+        # Keep the filtered queryset around so facets aggregate over the same rows
+        self.filtered_queryset = queryset
+        return super().paginate_queryset(queryset)
+    
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if wants_facets(self.request):
+            response.data['facets'] = get_product_facets(self.request, self.filtered_queryset)
+        return response
     
     def retrieve(self, request, *args, **kwargs):
-        instance = self.get_object()
-        cache_key = f'product_{instance.pk}'
-        cached_data = cache.get(cache_key)
-        
-        if cached_data:
-            return Response(cached_data)
+        # Served from the write-through cache by slug, without loading the object first
+        entry = get_product_detail(kwargs[self.lookup_field])
+        if entry is None:
+            raise NotFound()
         
-        serializer = self.get_serializer(instance)
-        data = serializer.data
-        cache.set(cache_key, data, timeout=300)
+        not_modified = not_modified_response(request, entry['etag'], entry['last_modified'])
+        if not_modified is not None:
+            return not_modified
         
-        return Response(data)
+        response = Response(absolutize_media_urls(request, entry['data']))
+        return set_conditional_headers(response, entry['etag'], entry['last_modified'])
     
     @action(detail=False, methods=['get']) 
     def featured(self, request):
-        featured = self.get_queryset().filter(is_active=True)[:5]
-        serializer = self.get_serializer(featured, many=True)
-        return Response(serializer.data)
+        def build_response():
+            featured = ranked_products('7d', 5)
+            if not featured:
+                # No sales yet: fall back to the newest products
+                featured = self.get_queryset().filter(is_active=True).order_by('-created_at')[:5]
+            serializer = self.get_serializer(featured, many=True)
+            return Response(serializer.data)
+        return self.cached_response(request, build_response)
+    
+    @action(detail=False, methods=['get'])
+    def trending(self, request):
+        try:
+            limit = min(int(request.query_params.get('limit', 10)), RANKING_SIZE)
+        except ValueError:
+            limit = 10
+        
+        def build_response():
+            serializer = self.get_serializer(ranked_products('24h', limit), many=True)
+            return Response(serializer.data)
+        return self.cached_response(request, build_response)
+        
+    @action(detail=False, methods=['post'], url_path='import', parser_classes=[MultiPartParser])
+    def import_catalog(self, request):
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({"error": "Upload the feed as 'file'"}, status=status.HTTP_400_BAD_REQUEST)
+        
+        fmt = request.data.get('format') or ('csv' if upload.name.endswith('.csv') else 'ndjson')
+        if fmt not in IMPORT_FORMATS:
+            return Response({"error": f"Format must be one of {', '.join(IMPORT_FORMATS)}"}, status=status.HTTP_400_BAD_REQUEST)
+        
+        def progress():
+            # One NDJSON line per batch, so clients can follow long imports
+            stream = io.TextIOWrapper(upload, encoding='utf-8', newline='')
+            for stats in CatalogImporter().run(iter_rows(stream, fmt)):
+                yield json.dumps(stats) + '\n'
         
+        return StreamingHttpResponse(progress(), content_type='application/x-ndjson')
+    
     @action(detail=True, methods=['post'], permission_classes=[IsAdminUser])
     def upload_image(self, request, slug=None):
         product = self.get_object()
@@ -72,28 +179,43 @@ class ProductViewSet(viewsets.ModelViewSet):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
 
-class CartViewSet(viewsets.GenericViewSet):
+class CartViewSet(IdempotencyMixin, PrefetchPlanMixin, viewsets.GenericViewSet):
     serializer_class = CartSerializer
     permission_classes = [IsAuthenticated]
+    idempotent_actions = ('add_item', 'remove_item', 'batch', 'clear', 'reserve')
+    
+    def get_prefetch_related_fields(self):
+        return cart_prefetch_plan()
+    
+    @property
+    def cart_backend(self):
+        # settings.CART_BACKEND picks between the database and the Redis write-behind store
+        return get_cart_backend()
     
     def get_queryset(self):
         # Get or create cart for the authenticated user
         cart, created = Cart.objects.get_or_create(user=self.request.user)
-        return Cart.objects.filter(id=cart.id)
+        return self.apply_prefetch_plan(Cart.objects.filter(id=cart.id))
     
     def get_serializer_context(self):
         context = super().get_serializer_context()
         context.update({"request": self.request})
         return context
     
-    def list(self, request):
-        cart, created = Cart.objects.get_or_create(user=request.user)
-        serializer = self.get_serializer(cart)
+    def cart_response(self, backend):
+        version = backend.version(self.request.user)
+        cart = backend.get_cart(self.request.user)
+        # Priced from the items just loaded, then reused by coupon validation and checkout
+        quote = get_cart_quote(self.request.user, backend, cart=cart, version=version)
+        serializer = self.get_serializer(cart, context={**self.get_serializer_context(), 'quote': quote})
         return Response(serializer.data)
     
+    def list(self, request):
+        return self.cart_response(self.cart_backend)
+    
     @action(detail=False, methods=['post'])
     def add_item(self, request):
-        cart, created = Cart.objects.get_or_create(user=request.user)
+        backend = self.cart_backend
         
         try:
             product = Product.objects.get(id=request.data.get('product_id'))
@@ -103,131 +225,194 @@ class CartViewSet(viewsets.GenericViewSet):
                 status=status.HTTP_404_NOT_FOUND
             )
         
-        if product.stock < int(request.data.get('quantity', 1)):
+        # Units held by other shoppers' checkout reservations can't be added
+        if product.available_stock < int(request.data.get('quantity', 1)):
             return Response(
                 {"error": "Not enough stock available"}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        cart_item, created = CartItem.objects.get_or_create(
-            cart=cart,
-            product=product,
-            defaults={'quantity': request.data.get('quantity', 1)}
-        )
-        
-        if not created:
-            cart_item.quantity += int(request.data.get('quantity', 1))
-            cart_item.save()
-        
-        serializer = self.get_serializer(cart)
-        return Response(serializer.data)
+        backend.add(request.user, product, int(request.data.get('quantity', 1)))
+        return self.cart_response(backend)
     
     @action(detail=False, methods=['post'])
     def remove_item(self, request):
-        cart = Cart.objects.get(user=request.user)
+        backend = self.cart_backend
+        quantity = int(request.data['quantity']) if 'quantity' in request.data else None
         
         try:
-            product = Product.objects.get(id=request.data.get('product_id'))
-            cart_item = CartItem.objects.get(cart=cart, product=product)
-            
-            if 'quantity' in request.data and int(request.data['quantity']) < cart_item.quantity:
-                cart_item.quantity -= int(request.data['quantity'])
-                cart_item.save()
-            else:
-                cart_item.delete()
-            
-            serializer = self.get_serializer(cart)
-            return Response(serializer.data)
-            
-        except (Product.DoesNotExist, CartItem.DoesNotExist):
+            removed = backend.remove(request.user, request.data.get('product_id'), quantity)
+        except ValidationError:
+            # Not a valid product id
+            removed = False
+        if not removed:
             return Response(
                 {"error": "Item not found in cart"}, 
                 status=status.HTTP_404_NOT_FOUND
             )
+        return self.cart_response(backend)
+    
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        """
+        Apply many add/remove/set operations in one request, e.g.
+        {"operations": [{"op": "add", "product_id": "...", "quantity": 2}], "delta": true}.
+        With "delta" only the touched lines' new quantities come back instead of the whole cart.
+        """
+        backend = self.cart_backend
+        try:
+            plan = plan_operations(parse_operations(request.data.get('operations')))
+        except CartOperationError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        # Removals of products that no longer exist are harmless, everything else must be in the catalog
+        wanted = {product_id: n for product_id, (kind, n) in plan.items() if n > 0}
+        stock = {
+            str(product_id): units - reserved
+            for product_id, units, reserved in Product.objects.filter(id__in=wanted).values_list('id', 'stock', 'reserved')
+        }
+        missing = sorted(set(wanted) - set(stock))
+        if missing:
+            return Response(
+                {"error": "Product not found", "product_ids": missing}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
+        short = sorted(product_id for product_id, n in wanted.items() if stock[product_id] < n)
+        if short:
+            return Response(
+                {"error": "Not enough stock available", "product_ids": short}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        quantities = backend.apply(request.user, plan)
+        if request.data.get('delta') in (True, 'true', '1', 1):
+            return Response({"items": [
+                {"product_id": product_id, "quantity": quantity} for product_id, quantity in quantities.items()
+            ]})
+        return self.cart_response(backend)
+    
+    @action(detail=False, methods=['post'])
+    def reserve(self, request):
+        """Hold the cart's stock while the user goes through checkout."""
+        try:
+            expires_at, items = reserve_cart(request.user)
+        except CheckoutError as exc:
+            return Response({"error": str(exc)}, status=exc.status_code)
+        return Response({
+            "expires_at": expires_at,
+            "items": [{"product_id": item.product_id, "quantity": item.quantity} for item in items],
+        })
     
     @action(detail=False, methods=['post'])
     def clear(self, request):
-        cart = Cart.objects.get(user=request.user)
-        cart.items.all().delete()
-        serializer = self.get_serializer(cart)
-        return Response(serializer.data)
+        backend = self.cart_backend
+        backend.clear(request.user)
+        return self.cart_response(backend)
     
     
 #============================================ORDER SECTION=========================================================
 
  
 
-class OrderViewSet(viewsets.ModelViewSet):
+class OrderViewSet(IdempotencyMixin, PrefetchPlanMixin, viewsets.ModelViewSet):
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated]
+    # Mobile clients retry checkout on timeouts
+    idempotent_actions = ('create', 'bulk_update_status')
+    pagination_class = OrderPagination
+    prefetch_related_fields = ('items',)
     
     def get_queryset(self):
         user = self.request.user
         if user.role == 'admin':
-            return Order.objects.all()
-        return Order.objects.filter(user=user)
+            return self.apply_prefetch_plan(Order.objects.all())
+        return self.apply_prefetch_plan(Order.objects.filter(user=user))
+    
+    def get_archived_queryset(self):
+        user = self.request.user
+        if user.role == 'admin':
+            return self.apply_prefetch_plan(ArchivedOrder.objects.all())
+        return self.apply_prefetch_plan(ArchivedOrder.objects.filter(user=user))
+    
+    def get_object(self):
+        try:
+            return super().get_object()
+        except Http404:
+            # Archived orders can be read but not changed
+            if self.action != 'retrieve':
+                raise
+        order = get_object_or_404(self.get_archived_queryset(), pk=self.kwargs['pk'])
+        self.check_object_permissions(self.request, order)
+        return order
+    
+    def perform_destroy(self, instance):
+        # Take the order out of the sales rollups and status counts (archived orders still count, so archival doesn't)
+        with transaction.atomic():
+            orders_deleted(Order.objects.filter(pk=instance.pk))
+            instance.delete()
+    
+    def list(self, request, *args, **kwargs):
+        # Both tiers, newest first, as if the archive had never split them
+        orders = OrderTiers(self.get_queryset(), self.get_archived_queryset())
+        page = self.paginate_queryset(orders)
+        if page is None:
+            return Response(self.get_serializer(list(orders), many=True).data)
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
     
     def create(self, request, *args, **kwargs):
         user = request.user
+        shipping_address = request.data.get('shipping_address', user.address or '')
+        
+        if 'respond-async' in request.headers.get('Prefer', ''):
+            # Async checkout: queue the order for a checkout worker and answer right away
+            try:
+                order = queue_order(user, shipping_address)
+            except CheckoutError as exc:
+                return Response({"error": str(exc)}, status=exc.status_code)
+            return Response({
+                'order': {'id': order.id, 'status': order.status},
+                'message': "ORDER QUEUED",
+                'websocket': f'/ws/orders/{order.id}/',
+            }, status=status.HTTP_202_ACCEPTED, headers={'Location': reverse('order-detail', args=[order.id])})
         
         try:
-            cart = Cart.objects.get(user=user)
-            if not cart.items.exists():
-                return Response(
-                    {"error": "Cannot create order with empty cart"}, 
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-                
-            # Calculate total order amount
-            total_amount = sum(item.quantity * item.product.price for item in cart.items.all())
-            
-            # Check stock availability
-            for item in cart.items.all():
-                if item.product.stock < item.quantity:
-                    return Response(
-                        {"error": f"Not enough stock for {item.product.title}"}, 
-                        status=status.HTTP_400_BAD_REQUEST
-                    )
-            
-            # Create the order
-            order = Order.objects.create(
-                user=user,
-                total_amount=total_amount,
-                shipping_address=request.data.get('shipping_address', user.address or '')
+            order = place_order(user, shipping_address)
+        except CheckoutError as exc:
+            return Response({"error": str(exc)}, status=exc.status_code)
+        
+        serializer = self.get_serializer(order)
+        return Response({
+            'order': serializer.data,
+            'message': "CONFIRMATION MAIL SENT"
+        }, status=status.HTTP_201_CREATED)
+    
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        if request.user.role != 'admin':
+            return Response(
+                {"error": "Only administrators can export orders"}, 
+                status=status.HTTP_403_FORBIDDEN
             )
-            
-            # Create order items and update product stock
-            for cart_item in cart.items.all():
-                OrderItem.objects.create(
-                    order=order,
-                    product=cart_item.product,
-                    product_name=cart_item.product.title,
-                    product_price=cart_item.product.price,
-                    quantity=cart_item.quantity
-                )
-                
-                # Update product stock
-                product = cart_item.product
-                product.stock -= cart_item.quantity
-                product.save()
-            
-            # Clear the cart after order is created
-            cart.items.all().delete()
-            
-            # Send confirmation email (Celery task)
-            send_order_confirmation_email.delay(order.id, user.email)
-            
-            serializer = self.get_serializer(order)
-            return Response({
-                'order': serializer.data,
-                'message': "CONFIRMATION MAIL SENT"
-            }, status=status.HTTP_201_CREATED)
-            
-        except Cart.DoesNotExist:
+        
+        fmt = request.query_params.get('export_format', 'csv')
+        if fmt not in EXPORT_FORMATS:
             return Response(
-                {"error": "Cart not found"}, 
-                status=status.HTTP_404_NOT_FOUND
+                {"error": f"export_format must be one of {', '.join(EXPORT_FORMATS)}"}, 
+                status=status.HTTP_400_BAD_REQUEST
             )
+        
+        try:
+            orders = filter_orders(request.query_params)
+            archived = filter_orders(request.query_params, ArchivedOrder)
+        except ExportError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        if fmt == 'csv':
+            response = StreamingHttpResponse(export_csv(orders, archived), content_type='text/csv')
+        else:
+            response = StreamingHttpResponse(export_ndjson(orders, archived), content_type='application/x-ndjson')
+        response['Content-Disposition'] = f'attachment; filename="orders.{fmt}"'
+        return response
     
     @action(detail=True, methods=['post'], url_path='update-status')
     def update_status(self, request, pk=None):
@@ -247,23 +432,47 @@ class OrderViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        order.status = new_status
-        order.save()
+        with transaction.atomic():
+            # Re-read under a row lock so two concurrent updates can't both pass the check
+            order = Order.objects.select_for_update().get(pk=order.pk)
+            if new_status not in ORDER_TRANSITIONS.get(order.status, ()):
+                return Response(
+                    {"error": f"Orders can't be moved from {order.status} to {new_status}"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            order.status = new_status
+            order.save(update_fields=['status', 'updated_at'])
         
         serializer = self.get_serializer(order)
         return Response(serializer.data)
+    
+    @action(detail=False, methods=['post'], url_path='bulk-update-status')
+    def bulk_update_status(self, request):
+        if request.user.role != 'admin':
+            return Response(
+                {"error": "Only administrators can update order status"}, 
+                status=status.HTTP_403_FORBIDDEN
+            )
+        
+        try:
+            result = apply_transitions(parse_transitions(request.data))
+        except OrderStatusError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result)
         
     
     
 #===========================================COUPON & DISCOUNTS=====================================================
 
 
-class CouponViewSet(viewsets.ModelViewSet):
+class CouponViewSet(CachedListMixin, viewsets.ModelViewSet):
     queryset = Coupon.objects.all()
     serializer_class = CouponSerializer
     permission_classes = [IsAdminOrReadOnly]
+    cache_tags = COUPON_LIST_TAGS
     
-    @action(detail=False, methods=['post'])
+    # Any signed-in shopper can check a code; the viewset's admin-only write rule is for managing coupons
+    @action(detail=False, methods=['post'], permission_classes=[IsAuthenticated])
     def validate(self, request):
         self.throttle_classes = [CouponValidationThrottle]
         self.check_throttles(request)
@@ -272,25 +481,22 @@ class CouponViewSet(viewsets.ModelViewSet):
         
         try:
             coupon = Coupon.objects.get(code=code)
-            cart = Cart.objects.get(user=user)
+            cart_backend = get_cart_backend()
+            cart_backend.persist(user)
+            # Raises Cart.DoesNotExist for users who never had a cart
+            Cart.objects.get(user=user)
             
-            # Calculate cart total
-            cart_total = sum(item.quantity * item.product.price for item in cart.items.all())
+            # Same cached quote the cart view and checkout use
+            quote = get_cart_quote(user, cart_backend)
             
-            if coupon.is_valid(user, cart_total):
-                # Calculate discount amount
-                discount_amount = (cart_total * coupon.discount_percent) / 100
-                
-                # Apply max discount cap if set
-                if coupon.max_discount_amount:
-                    discount_amount = min(discount_amount, coupon.max_discount_amount)
-                
+            if coupon.is_valid(user, quote['subtotal']):
+                quote = apply_coupon(quote, coupon)
                 return Response({
                     'valid': True,
                     'coupon': CouponSerializer(coupon).data,
-                    'cart_total':cart_total,
-                    'discount_amount': discount_amount,
-                    'cart_total_after_discount': cart_total - discount_amount 
+                    'cart_total': quote['subtotal'],
+                    'discount_amount': quote['discount'],
+                    'cart_total_after_discount': quote['total'] 
                 })
             else:
                 return Response({
@@ -307,4 +513,75 @@ class CouponViewSet(viewsets.ModelViewSet):
             return Response(
                 {'valid': False, 'message': 'Cart not found.'},
                 status=status.HTTP_404_NOT_FOUND
-            )
\ No newline at end of file
+            )
+
+
+#===========================================REPORTS================================================================
+
+
+class ReportViewSet(viewsets.ViewSet):
+    """Sales reports. Every endpoint reads the rollup tables only, never orders/order_items."""
+    permission_classes = [IsAuthenticated]
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.date_from = self.date_to = None
+
+    def check_report_request(self, request):
+        if request.user.role != 'admin':
+            return Response(
+                {"error": "Only administrators can view reports"},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        for param in ('date_from', 'date_to'):
+            value = request.query_params.get(param)
+            if not value:
+                continue
+            try:
+                day = parse_date(value)
+            except ValueError:
+                day = None
+            if day is None:
+                return Response(
+                    {"error": f"{param} must be a date (YYYY-MM-DD)"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            setattr(self, param, day)
+        return None
+
+    @action(detail=False, methods=['get'])
+    def revenue(self, request):
+        error = self.check_report_request(request)
+        if error:
+            return error
+        days = daily_revenue(self.date_from, self.date_to)
+        return Response({
+            'date_from': self.date_from,
+            'date_to': self.date_to,
+            'orders': sum(day['orders'] for day in days),
+            'units': sum(day['units'] for day in days),
+            'revenue': sum((day['revenue'] for day in days), 0),
+            'days': days,
+        })
+
+    @action(detail=False, methods=['get'], url_path='top-products', url_name='top-products')
+    def top_selling(self, request):
+        error = self.check_report_request(request)
+        if error:
+            return error
+        try:
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), MAX_TOP_PRODUCTS)
+        except ValueError:
+            return Response({"error": "limit must be a number"}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'date_from': self.date_from,
+            'date_to': self.date_to,
+            'results': top_products(self.date_from, self.date_to, limit),
+        })
+
+    @action(detail=False, methods=['get'], url_path='order-status')
+    def order_status(self, request):
+        error = self.check_report_request(request)
+        if error:
+            return error
+        return Response(status_counts())
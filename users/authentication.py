@@ -0,0 +1,127 @@
+import threading
+import time
+from urllib.parse import parse_qs
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+from .models import User
+
+# In-process tier: entries live AUTH_USER_LOCAL_TTL seconds and the whole tier is dropped past this size
+LOCAL_CACHE_SIZE = 10000
+
+_local_users = {}
+_local_lock = threading.Lock()
+
+
+def user_cache_key(user_id):
+    return f'auth_user_{user_id}'
+
+
+def cached_user_fields():
+    # The password hash never goes into the cache; it stays deferred on cached users
+    return [field.attname for field in User._meta.concrete_fields if field.name != 'password']
+
+
+def forget_cached_user(user_id):
+    cache.delete(user_cache_key(user_id))
+    with _local_lock:
+        _local_users.pop(str(user_id), None)
+
+
+def clear_local_user_cache():
+    with _local_lock:
+        _local_users.clear()
+
+
+def get_cached_user(user_id):
+    """
+    The user with `user_id`, or None. Looked up in this process first (kept
+    AUTH_USER_LOCAL_TTL seconds), then the shared cache (AUTH_USER_CACHE_TTL
+    seconds, dropped whenever the user is saved or deleted), then the
+    database. Saving the returned user only writes the fields it was loaded with.
+    """
+    # Token claims carry the id as a string
+    user_id = str(user_id)
+    now = time.monotonic()
+    entry = _local_users.get(user_id)
+    if entry is not None and entry[0] > now:
+        values = entry[1]
+    else:
+        key = user_cache_key(user_id)
+        values = cache.get(key)
+        if values is None:
+            values = User.objects.filter(pk=user_id).values(*cached_user_fields()).first()
+            if values is None:
+                return None
+            cache.set(key, values, getattr(settings, 'AUTH_USER_CACHE_TTL', 60))
+        with _local_lock:
+            if len(_local_users) >= LOCAL_CACHE_SIZE:
+                _local_users.clear()
+            _local_users[user_id] = (now + getattr(settings, 'AUTH_USER_LOCAL_TTL', 5), values)
+    return User.from_db('default', list(values), list(values.values()))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    simplejwt's JWTAuthentication, but the user behind a verified token comes
+    from get_cached_user() instead of a query on every request.
+    """
+
+    def get_user(self, validated_token):
+        if api_settings.CHECK_REVOKE_TOKEN:
+            # Needs the password hash, which isn't cached
+            return super().get_user(validated_token)
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken("Token contained no recognizable user identification")
+
+        user = get_cached_user(user_id)
+        if user is None:
+            raise AuthenticationFailed("User not found", code="user_not_found")
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+        return user
+
+
+#==================================WEBSOCKETS=======================================================================
+
+def token_from_scope(scope):
+    """Access token from ?token=... (browsers can't set websocket headers) or an Authorization: Bearer header."""
+    tokens = parse_qs(scope.get('query_string', b'').decode()).get('token')
+    if tokens:
+        return tokens[0]
+    for name, value in scope.get('headers', ()):
+        if name == b'authorization':
+            parts = value.decode().split()
+            if len(parts) == 2 and parts[0] in api_settings.AUTH_HEADER_TYPES:
+                return parts[1]
+    return None
+
+
+def user_from_token(raw_token):
+    if not raw_token:
+        return AnonymousUser()
+    authentication = CachedJWTAuthentication()
+    try:
+        return authentication.get_user(authentication.get_validated_token(raw_token))
+    except (InvalidToken, AuthenticationFailed):
+        return AnonymousUser()
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Channels middleware that sets scope["user"] from the same access tokens
+    the REST API takes, instead of the session. Sockets without a valid
+    token get AnonymousUser.
+    """
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        scope['user'] = await database_sync_to_async(user_from_token)(token_from_scope(scope))
+        return await super().__call__(scope, receive, send)
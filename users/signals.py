@@ -0,0 +1,10 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import User
+from .authentication import forget_cached_user
+
+
+# Role, is_active etc. must not be served stale from the auth cache after a change
+@receiver([post_save, post_delete], sender=User)
+def forget_user_auth_cache(sender, instance, **kwargs):
+    forget_cached_user(instance.pk)
@@ -1,3 +1,59 @@
+from asgiref.sync import async_to_sync
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
 from django.test import TestCase
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from .authentication import JWTAuthMiddleware, clear_local_user_cache
+from .models import User
 
-# Create your tests here.
+
+class WhoAmIConsumer(AsyncWebsocketConsumer):
+    async def connect(self):
+        await self.accept()
+        user = self.scope["user"]
+        await self.send(text_data=user.username if user.is_authenticated else "anonymous")
+
+
+class CachedJWTAuthenticationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        clear_local_user_cache()
+        self.user = User.objects.create_user(username="token", password="pass", email="token@example.com", role="admin")
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}")
+
+    def test_user_is_loaded_once(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("protect"))
+        self.assertEqual(response.data["user_id"], self.user.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(reverse("protect")).status_code, 200)
+
+    def test_changes_reach_the_next_request(self):
+        self.client.get(reverse("protect"))
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(reverse("protect")).status_code, 401)
+
+    def test_password_is_not_cached(self):
+        self.client.get(reverse("protect"))
+        self.assertFalse(any("pbkdf2" in str(value) for value in cache.get(f"auth_user_{self.user.id}").values()))
+
+    def test_websocket_token(self):
+        def who(path, headers=None):
+            async def scenario():
+                communicator = WebsocketCommunicator(JWTAuthMiddleware(WhoAmIConsumer.as_asgi()), path, headers=headers)
+                await communicator.connect()
+                name = await communicator.receive_from()
+                await communicator.disconnect()
+                return name
+            return async_to_sync(scenario)()
+
+        token = str(AccessToken.for_user(self.user))
+        self.assertEqual(who(f"/ws/orders/?token={token}"), "token")
+        self.assertEqual(who("/ws/orders/", [(b"authorization", f"Bearer {token}".encode())]), "token")
+        self.assertEqual(who("/ws/orders/?token=not-a-token"), "anonymous")
+        self.assertEqual(who("/ws/orders/"), "anonymous")